@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: benchmark-dataflow.py
+
+"""
+Measure the throughput of DataFlow components on synthetic data, over a
+matrix of datapoint sizes and numbers of workers. Each measurement runs in
+a fresh process.
+
+Examples:
+    ./benchmark-dataflow.py -o results.json
+    ./benchmark-dataflow.py --cases BatchData PrefetchDataZMQ --sizes image --workers 1 4
+    ./benchmark-dataflow.py -o new.json --compare results.json
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from tabulate import tabulate
+
+import tensorpack
+from tensorpack.dataflow import (
+    FakeData, BatchData, MapData, ThreadedMapData, PrefetchData, PrefetchDataZMQ,
+    LocallyShuffleData, LMDBDataPoint, RemoteDataZMQ, RepeatedData, FixedSizeData, send_dataflow_zmq)
+from tensorpack.dataflow.dftools import dump_dataflow_to_lmdb
+
+# name -> (shapes, dtypes)
+SIZES = {
+    'small': ([[64], [1]], ['float32', 'int32']),
+    'image': ([[224, 224, 3], [1]], ['uint8', 'int32']),
+    'batch': ([[32, 224, 224, 3], [32]], ['uint8', 'int32']),
+}
+
+
+def fake_data(size, nr=1000000):
+    shapes, dtypes = SIZES[size]
+    return FakeData(shapes, nr, random=False, dtype=dtypes)
+
+
+def case_batch(ds, nr_worker, workdir):
+    return BatchData(ds, 32)
+
+
+def case_map(ds, nr_worker, workdir):
+    return MapData(ds, lambda dp: dp)
+
+
+def case_threaded_map(ds, nr_worker, workdir):
+    return ThreadedMapData(ds, nr_worker, lambda dp: dp)
+
+
+def case_prefetch(ds, nr_worker, workdir):
+    return PrefetchData(ds, 64, nr_worker)
+
+
+def case_prefetch_zmq(ds, nr_worker, workdir):
+    return PrefetchDataZMQ(ds, nr_worker)
+
+
+def case_locally_shuffle(ds, nr_worker, workdir):
+    return LocallyShuffleData(ds, 1000)
+
+
+def case_lmdb(ds, nr_worker, workdir):
+    path = os.path.join(workdir, 'data.lmdb')
+    dump_dataflow_to_lmdb(FixedSizeData(ds, 1000), path)
+    return LMDBDataPoint(path, shuffle=True)
+
+
+def case_remote_zmq(ds, nr_worker, workdir):
+    addr = 'ipc://' + os.path.join(workdir, 'remote-pipe')
+    for _ in range(nr_worker):
+        p = mp.Process(target=send_dataflow_zmq, args=(ds, addr), kwargs={'print_interval': 10 ** 9})
+        p.daemon = True
+        p.start()
+    return RemoteDataZMQ(addr)
+
+
+# name -> (builder, whether it uses workers)
+CASES = {
+    'BatchData': (case_batch, False),
+    'MapData': (case_map, False),
+    'ThreadedMapData': (case_threaded_map, True),
+    'PrefetchData': (case_prefetch, True),
+    'PrefetchDataZMQ': (case_prefetch_zmq, True),
+    'LocallyShuffleData': (case_locally_shuffle, False),
+    'LMDBData': (case_lmdb, False),
+    'RemoteDataZMQ': (case_remote_zmq, True),
+}
+
+
+def datapoint_bytes(size):
+    shapes, dtypes = SIZES[size]
+    return sum(int(np.prod(s)) * np.dtype(t).itemsize for s, t in zip(shapes, dtypes))
+
+
+def run_case(case, size, nr_worker, args, queue):
+    np.random.seed(0)
+    workdir = tempfile.mkdtemp(prefix='tp-bench-')
+    try:
+        ds = CASES[case][0](fake_data(size), nr_worker, workdir)
+        ds.reset_state()
+        itr = RepeatedData(ds, -1).get_data()
+        for _ in range(args.warmup):
+            next(itr)
+        start = time.time()
+        for _ in range(args.number):
+            next(itr)
+        queue.put(time.time() - start)
+    finally:
+        for p in mp.active_children():
+            p.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(case, size, nr_worker, args):
+    queue = mp.Queue()
+    proc = mp.Process(target=run_case, args=(case, size, nr_worker, args, queue))
+    proc.start()
+    try:
+        elapsed = queue.get(timeout=args.timeout)
+    except Exception:
+        elapsed = None
+    proc.join(5)
+    if proc.is_alive():
+        proc.terminate()
+    ret = {'case': case, 'size': size, 'workers': nr_worker, 'number': args.number}
+    if elapsed is None:
+        ret['error'] = 'failed or timed out'
+    else:
+        # BatchData produces batches of 32 input datapoints
+        nr_input = args.number * (32 if case == 'BatchData' else 1)
+        ret['seconds'] = elapsed
+        ret['dp_per_sec'] = nr_input / elapsed
+        ret['mb_per_sec'] = nr_input * datapoint_bytes(size) / elapsed / 1e6
+    return ret
+
+
+def get_meta():
+    return {
+        'tensorpack': getattr(tensorpack, '__version__', None),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': mp.cpu_count(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES.keys()), default=sorted(CASES.keys()))
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES.keys()), default=['small', 'image'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('-n', '--number', help='number of datapoints to measure', type=int, default=2000)
+    parser.add_argument('--warmup', help='number of datapoints to skip', type=int, default=200)
+    parser.add_argument('--timeout', help='timeout in seconds of each measurement', type=int, default=600)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file of previous results to compare against')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for r in json.load(f)['results']:
+                baseline[(r['case'], r['size'], r['workers'])] = r.get('dp_per_sec')
+
+    results = []
+    for case in args.cases:
+        workers = args.workers if CASES[case][1] else [0]
+        for size in args.sizes:
+            for nr_worker in workers:
+                r = measure(case, size, nr_worker, args)
+                results.append(r)
+                print(json.dumps(r))
+
+    table = []
+    for r in results:
+        row = [r['case'], r['size'], r['workers'],
+               '{:.1f}'.format(r['dp_per_sec']) if 'dp_per_sec' in r else r['error'],
+               '{:.1f}'.format(r['mb_per_sec']) if 'mb_per_sec' in r else '']
+        if args.compare:
+            old = baseline.get((r['case'], r['size'], r['workers']))
+            row.append('{:.2f}x'.format(r['dp_per_sec'] / old) if old and 'dp_per_sec' in r else '')
+        table.append(row)
+    headers = ['case', 'size', 'workers', 'dp/s', 'MB/s'] + (['vs. baseline'] if args.compare else [])
+    print(tabulate(table, headers=headers))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': get_meta(), 'results': results}, f, indent=2)
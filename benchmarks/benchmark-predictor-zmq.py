@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: benchmark-predictor-zmq.py
+
+"""
+Measure the throughput and latency of :class:`ZMQPredictServer` serving a
+small MLP to many client processes, each keeping some requests in flight.
+
+Examples:
+    ./benchmark-predictor-zmq.py --clients 8 --inflight 4 --batch-size 32 --max-wait 0.002
+    ./benchmark-predictor-zmq.py --clients 1 --inflight 1 --max-wait 0
+"""
+
+import argparse
+import multiprocessing as mp
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+
+from tensorpack.models import ModelDesc, InputDesc
+from tensorpack.predict import PredictConfig, ZMQPredictServer, ZMQAsyncPredictor
+from tensorpack.utils.concurrency import ensure_proc_terminate
+from tensorpack.utils.stats import LatencyHistogram
+
+
+class Model(ModelDesc):
+    def __init__(self, dim, depth):
+        self.dim = dim
+        self.depth = depth
+
+    def _get_inputs(self):
+        return [InputDesc(tf.float32, [None, self.dim], 'input')]
+
+    def _build_graph(self, inputs):
+        x = inputs[0]
+        rng = np.random.RandomState(0)
+        for k in range(self.depth):
+            W = tf.constant(rng.randn(self.dim, self.dim).astype('float32') / np.sqrt(self.dim))
+            x = tf.nn.relu(tf.matmul(x, W))
+        tf.identity(x, name='output')
+
+
+def run_client(args, start_evt, queue):
+    predictor = ZMQAsyncPredictor(args.addr)
+    predictor.start()
+    dp = [np.random.rand(args.dim).astype('float32')]
+    hist = LatencyHistogram()
+    sem = threading.Semaphore(args.inflight)
+    lock = threading.Lock()
+
+    def make_callback(t):
+        def cb(_):
+            with lock:
+                hist.feed(time.time() - t)
+            sem.release()
+        return cb
+
+    start_evt.wait()
+    for _ in range(args.number):
+        sem.acquire()
+        predictor.put_task(dp, make_callback(time.time()))
+    for _ in range(args.inflight):
+        sem.acquire()
+    queue.put(hist)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--addr', default='ipc://@tensorpack-benchmark-predictor')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--inflight', help='number of requests in flight per client', type=int, default=4)
+    parser.add_argument('-n', '--number', help='number of requests per client', type=int, default=2000)
+    parser.add_argument('--threads', help='number of predictor threads in the server', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-wait', type=float, default=0.002)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--depth', type=int, default=4)
+    args = parser.parse_args()
+
+    config = PredictConfig(model=Model(args.dim, args.depth),
+                           input_names=['input'], output_names=['output'])
+    server = ZMQPredictServer(0, config, args.addr, nr_thread=args.threads,
+                              batch_size=args.batch_size, max_wait=args.max_wait)
+    ensure_proc_terminate(server)
+    server.start()
+
+    start_evt = mp.Event()
+    queue = mp.Queue()
+    clients = [mp.Process(target=run_client, args=(args, start_evt, queue))
+               for _ in range(args.clients)]
+    for c in clients:
+        c.start()
+    time.sleep(5)   # let the server build the graph
+    start = time.time()
+    start_evt.set()
+    hist = LatencyHistogram()
+    for _ in clients:
+        hist.merge(queue.get())
+    elapsed = time.time() - start
+    for c in clients:
+        c.join()
+    server.terminate()
+
+    print("{} requests in {:.2f} sec: {:.1f} requests/s".format(hist.count, elapsed, hist.count / elapsed))
+    print("latency (ms): average={:.3f} p50={:.3f} p90={:.3f} p99={:.3f}".format(
+        hist.average * 1e3, hist.percentile(50) * 1e3, hist.percentile(90) * 1e3, hist.percentile(99) * 1e3))
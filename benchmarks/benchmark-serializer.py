@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: benchmark-serializer.py
+
+import argparse
+import timeit
+import numpy as np
+from tabulate import tabulate
+from tensorpack.utils.serialize import dumps, loads
+
+
+def get_workloads():
+    rng = np.random.RandomState(0)
+    return {
+        'uint8 image': [rng.randint(256, size=(224, 224, 3)).astype('uint8'), np.int32(7)],
+        'uint8 batch': [rng.randint(256, size=(64, 224, 224, 3)).astype('uint8'),
+                        rng.randint(1000, size=(64,)).astype('int32')],
+        'float32 features': [rng.rand(256, 2048).astype('float32'), rng.rand(256).astype('float32')],
+        'mixed scalars': [1, 0.5, 'label', rng.rand(10).astype('float32')],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serializers', nargs='+', default=['msgpack', 'pickle', 'raw'])
+    parser.add_argument('-n', '--number', help='number of runs per measurement', type=int, default=50)
+    args = parser.parse_args()
+
+    table = []
+    for name, dp in sorted(get_workloads().items()):
+        for ser in args.serializers:
+            try:
+                buf = dumps(dp, ser)
+            except ValueError:
+                table.append([name, ser, 'N/A', 'N/A', 'N/A'])
+                continue
+            t_dumps = timeit.timeit(lambda: dumps(dp, ser), number=args.number) / args.number
+            t_loads = timeit.timeit(lambda: loads(buf), number=args.number) / args.number
+            table.append([name, ser, len(buf), '{:.3f}'.format(t_dumps * 1e3), '{:.3f}'.format(t_loads * 1e3)])
+    print(tabulate(table, headers=['datapoint', 'serializer', 'bytes', 'dumps (ms)', 'loads (ms)']))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: input_monitor.py
+
+import time
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+
+from .base import Callback
+from ..dataflow import DataFlow, PrefetchData, PrefetchDataZMQ, ThreadedMapData
+from ..tfutils.common import get_op_or_tensor_by_name
+from ..utils import logger
+
+__all__ = ['InputStallDetector', 'register_tunable', 'find_tunables']
+
+
+# list of (DataFlow class, attribute of the current value, name of the setter, min, max)
+_TUNABLES = []
+
+
+def register_tunable(cls, attr, setter, min_value=1, max_value=None):
+    """
+    Register a runtime-tunable parameter of a type of DataFlow, to be
+    increased by :class:`InputStallDetector` when training is input-bound.
+
+    Args:
+        cls (type): a subclass of :class:`DataFlow`.
+        attr (str): name of the attribute holding the current value.
+        setter (str): name of the method which changes the value while the DataFlow is running.
+        min_value, max_value (int): the range of the value. None means unbounded.
+    """
+    assert issubclass(cls, DataFlow), cls
+    _TUNABLES.append((cls, attr, setter, min_value, max_value))
+
+
+register_tunable(ThreadedMapData, 'nr_thread', 'set_nr_thread', 1, mp.cpu_count() * 2)
+register_tunable(PrefetchDataZMQ, 'hwm', 'set_hwm', 1, 1000)
+
+
+class _Tunable(object):
+    def __init__(self, df, attr, setter, min_value, max_value):
+        self.df = df
+        self.attr = attr
+        self.setter = setter
+        self.min_value = min_value
+        self.max_value = max_value
+
+    @property
+    def name(self):
+        return '{}.{}'.format(type(self.df).__name__, self.attr)
+
+    def get(self):
+        return getattr(self.df, self.attr)
+
+    def increase(self):
+        """
+        Increase the value by 50%. Returns whether it's changed.
+        """
+        old = self.get()
+        new = old + max(old // 2, 1)
+        if self.max_value is not None:
+            new = min(new, self.max_value)
+        if new <= old:
+            return False
+        getattr(self.df, self.setter)(new)
+        return True
+
+
+def find_tunables(ds):
+    """
+    Find the registered tunable parameters in a DataFlow chain, by following
+    the ``.ds`` links. Stages behind :class:`PrefetchData` or
+    :class:`PrefetchDataZMQ` run in other processes and are not included.
+
+    Args:
+        ds (DataFlow): the last DataFlow of the chain.
+
+    Returns:
+        list: tunables from the last stage to the first.
+    """
+    ret = []
+    df = ds
+    while isinstance(df, DataFlow):
+        for cls, attr, setter, min_value, max_value in _TUNABLES:
+            if isinstance(df, cls):
+                ret.append(_Tunable(df, attr, setter, min_value, max_value))
+        if isinstance(df, (PrefetchData, PrefetchDataZMQ)):
+            break
+        df = getattr(df, 'ds', None)
+    return ret
+
+
+class InputStallDetector(Callback):
+    """
+    Detect whether training is bottlenecked by the input pipeline.
+
+    At every step it samples the size of the input queue (see :class:`QueueInput`),
+    the number of elements in the StagingArea (see :class:`StagingInputWrapper`),
+    and measures the time of the step.
+    A step is considered waiting for data if the queue was empty.
+    The waiting time is estimated by how much longer such steps take than
+    the median of the other steps.
+
+    After each epoch it writes the statistics to monitors under ``input_stall/``,
+    and logs whether the epoch is input-bound or compute-bound.
+    With ``tune=True``, when an epoch is input-bound, it increases one of the
+    tunable parameters of the DataFlow (see :func:`register_tunable`).
+    """
+    def __init__(self, threshold=0.1, queue_size_name='input_queue_size:0', tune=False, ds=None):
+        """
+        Args:
+            threshold (float): an epoch is input-bound if more than this ratio of
+                time is spent waiting for data.
+            queue_size_name (str): name of the tensor of the queue size.
+            tune (bool): whether to tune the DataFlow when training is input-bound.
+            ds (DataFlow): the DataFlow to tune. Defaults to the one used by the trainer.
+        """
+        self._threshold = float(threshold)
+        self._queue_size_name = queue_size_name
+        self._tune = tune
+        self._ds = ds
+
+    def _setup_graph(self):
+        fetches = {}
+        try:
+            fetches['queue_size'] = get_op_or_tensor_by_name(self._queue_size_name)
+        except KeyError:
+            logger.warn("[InputStallDetector] Tensor {} not found! "
+                        "Cannot detect waiting for data.".format(self._queue_size_name))
+        get_staging_size = getattr(getattr(self.trainer, '_input_source', None), 'get_staging_size', None)
+        if get_staging_size is not None:
+            fetches['staging_size'] = get_staging_size()
+        self._fetches = tf.train.SessionRunArgs(fetches=fetches) if fetches else None
+
+    def _before_train(self):
+        self._tunables = []
+        if self._tune:
+            ds = self._ds
+            if ds is None:
+                ds = getattr(self.trainer.config, 'dataflow', None)
+            if ds is None:
+                ds = getattr(getattr(self.trainer, '_input_source', None), 'ds', None)
+            self._tunables = find_tunables(ds)
+            if not self._tunables:
+                logger.warn("[InputStallDetector] No tunable DataFlow found!")
+            else:
+                logger.info("[InputStallDetector] Tunable parameters: {}".format(
+                    ', '.join([t.name for t in self._tunables])))
+
+    def _before_epoch(self):
+        self._step_times = []
+        self._values = {'queue_size': [], 'staging_size': []}
+
+    def _before_run(self, _):
+        self._step_start = time.time()
+        return self._fetches
+
+    def _after_run(self, _, run_values):
+        self._step_times.append(time.time() - self._step_start)
+        if run_values.results:
+            for k, v in run_values.results.items():
+                self._values[k].append(v)
+
+    def _trigger_epoch(self):
+        if not self._step_times:
+            return
+        times = np.asarray(self._step_times)
+        total = times.sum()
+        M = self.trainer.monitors
+        M.put_scalar('input_stall/step_time', np.median(times))
+        if self._values['staging_size']:
+            M.put_scalar('input_stall/staging_size', np.mean(self._values['staging_size']))
+        queue_size = self._values['queue_size']
+        if not queue_size:
+            return
+
+        waiting = np.asarray(queue_size) == 0
+        if waiting.all():
+            compute_time = times.min()
+        else:
+            compute_time = np.median(times[~waiting])
+        wait_time = np.maximum(times[waiting] - compute_time, 0).sum()
+        wait_ratio = wait_time / total if total > 0 else 0.
+        M.put_scalar('input_stall/queue_size', np.mean(queue_size))
+        M.put_scalar('input_stall/empty_queue_ratio', waiting.mean())
+        M.put_scalar('input_stall/wait_time', wait_time)
+        M.put_scalar('input_stall/wait_ratio', wait_ratio)
+
+        if wait_ratio > self._threshold:
+            logger.warn("[InputStallDetector] Epoch {} is input-bound: "
+                        "{:.1f} sec ({:.1%}) spent waiting for data.".format(
+                            self.epoch_num, wait_time, wait_ratio))
+            self._tune_once()
+        else:
+            logger.info("[InputStallDetector] Epoch {} is compute-bound: "
+                        "{:.1f} sec ({:.1%}) spent waiting for data.".format(
+                            self.epoch_num, wait_time, wait_ratio))
+
+    def _tune_once(self):
+        for t in self._tunables:
+            old = t.get()
+            if t.increase():
+                logger.info("[InputStallDetector] Changed {} from {} to {}.".format(t.name, old, t.get()))
+                return
@@ -6,12 +6,17 @@ from __future__ import division
 import numpy as np
 from copy import copy
 import itertools
+import array
+import mmap
+import sys
+import tempfile
 from termcolor import colored
-from collections import deque, defaultdict
+from collections import defaultdict
 from six.moves import range, map
 from .base import DataFlow, ProxyDataFlow, RNGDataFlow
 from ..utils import logger, get_tqdm, get_rng
 from ..utils.develop import log_deprecated
+from ..utils.serialize import dumps, loads
 
 __all__ = ['TestDataSpeed', 'PrintData', 'BatchData', 'BatchDataByShape', 'FixedSizeData', 'MapData',
            'MapDataComponent', 'RepeatedData', 'RepeatedDataPoint', 'RandomChooseData',
@@ -63,9 +68,12 @@ class BatchData(ProxyDataFlow):
     each component has one new extra dimension of size ``batch_size``.
     The new component can be a list of the original datapoints, or an ndarray
     of the original datapoints.
+
+    The output arrays are allocated with the shape and dtype of the first datapoint
+    in the batch, and each datapoint is copied directly into its slot.
     """
 
-    def __init__(self, ds, batch_size, remainder=False, use_list=False):
+    def __init__(self, ds, batch_size, remainder=False, use_list=False, nr_buffer=0):
         """
         Args:
             ds (DataFlow): Its components must be either scalars or :class:`np.ndarray`.
@@ -77,6 +85,19 @@ class BatchData(ProxyDataFlow):
             use_list (bool): if True, it will run faster by producing a list
                 of datapoints instead of an ndarray of datapoints, avoiding an
                 extra copy.
+            nr_buffer (int): if positive, recycle this many preallocated
+                batches instead of allocating new arrays for every batch.
+                Only use it when the consumer is done with a batch before
+                ``nr_buffer`` more batches are produced, e.g. when the next
+                DataFlow or :class:`InputSource` copies it.
+                A batch produced ``nr_buffer`` batches ago is overwritten
+                in place, so a consumer which keeps references to older
+                batches (or to views of them) will silently see new data.
+                The default 0 always allocates new arrays.
+
+        A datapoint whose component has a different shape than the first
+        datapoint in the batch, or a dtype which cannot be cast to it
+        (e.g. float into int), raises a ValueError.
         """
         super(BatchData, self).__init__(ds)
         if not remainder:
@@ -87,6 +108,9 @@ class BatchData(ProxyDataFlow):
         self.batch_size = batch_size
         self.remainder = remainder
         self.use_list = use_list
+        self.nr_buffer = nr_buffer
+        self._buffers = []
+        self._buffer_idx = 0
 
     def size(self):
         ds_size = self.ds.size()
@@ -101,44 +125,95 @@ class BatchData(ProxyDataFlow):
         Yields:
             Batched data by stacking each component on an extra 0th dimension.
         """
-        holder = []
-        for data in self.ds.get_data():
-            holder.append(data)
-            if len(holder) == self.batch_size:
+        if self.use_list:
+            holder = []
+            for data in self.ds.get_data():
+                holder.append(data)
+                if len(holder) == self.batch_size:
+                    yield BatchData._aggregate_batch(holder, self.use_list)
+                    del holder[:]
+            if self.remainder and len(holder) > 0:
                 yield BatchData._aggregate_batch(holder, self.use_list)
-                del holder[:]
-        if self.remainder and len(holder) > 0:
-            yield BatchData._aggregate_batch(holder, self.use_list)
+            return
+
+        idx = 0
+        for data in self.ds.get_data():
+            if idx == 0:
+                batch = self._get_batch_buffer(data)
+            BatchData._fill_batch(batch, idx, data)
+            idx += 1
+            if idx == self.batch_size:
+                yield batch
+                idx = 0
+        if self.remainder and idx > 0:
+            yield [x[:idx] for x in batch]
+
+    def _get_batch_buffer(self, dp):
+        spec = BatchData._batch_spec(dp)
+        if self.nr_buffer <= 0:
+            return BatchData._alloc_batch(spec, self.batch_size)
+        if len(self._buffers) < self.nr_buffer:
+            self._buffers.append(BatchData._alloc_batch(spec, self.batch_size))
+            self._buffer_idx = len(self._buffers) - 1
+            return self._buffers[-1]
+        self._buffer_idx = (self._buffer_idx + 1) % self.nr_buffer
+        batch = self._buffers[self._buffer_idx]
+        if [(x.shape[1:], x.dtype) for x in batch] != spec:
+            batch = self._buffers[self._buffer_idx] = BatchData._alloc_batch(spec, self.batch_size)
+        return batch
 
     @staticmethod
-    def _aggregate_batch(data_holder, use_list=False):
-        size = len(data_holder[0])
-        result = []
-        for k in range(size):
-            if use_list:
-                result.append(
-                    [x[k] for x in data_holder])
+    def _batch_spec(dp):
+        """
+        Returns:
+            list of (shape, dtype) for each component.
+        """
+        spec = []
+        for dt in dp:
+            if type(dt) in [int, bool]:
+                spec.append(((), np.dtype('int32')))
+            elif type(dt) == float:
+                spec.append(((), np.dtype('float32')))
             else:
-                dt = data_holder[0][k]
-                if type(dt) in [int, bool]:
-                    tp = 'int32'
-                elif type(dt) == float:
-                    tp = 'float32'
-                else:
-                    try:
-                        tp = dt.dtype
-                    except:
-                        raise TypeError("Unsupported type to batch: {}".format(type(dt)))
                 try:
-                    result.append(
-                        np.asarray([x[k] for x in data_holder], dtype=tp))
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    logger.exception("Cannot batch data. Perhaps they are of inconsistent shape?")
-                    import IPython as IP
-                    IP.embed(config=IP.terminal.ipapp.load_default_config())
-        return result
+                    spec.append((dt.shape, dt.dtype))
+                except AttributeError:
+                    raise TypeError("Unsupported type to batch: {}".format(type(dt)))
+        return spec
+
+    @staticmethod
+    def _alloc_batch(spec, batch_size):
+        return [np.empty((batch_size,) + tuple(shape), dtype=dtype) for shape, dtype in spec]
+
+    @staticmethod
+    def _fill_batch(batch, idx, dp):
+        for k, (arr, x) in enumerate(zip(batch, dp)):
+            shape = getattr(x, 'shape', ())
+            if shape != arr.shape[1:]:
+                raise ValueError(
+                    "Cannot batch data. Component {} of a datapoint has shape {}, "
+                    "but shape {} is expected from the first datapoint in the batch!".format(
+                        k, shape, arr.shape[1:]))
+            dtype = getattr(x, 'dtype', None)
+            if dtype is not None and not np.can_cast(dtype, arr.dtype, 'same_kind'):
+                raise ValueError(
+                    "Cannot batch data. Component {} of a datapoint has dtype {}, "
+                    "but dtype {} is expected from the first datapoint in the batch!".format(
+                        k, dtype, arr.dtype))
+            try:
+                arr[idx] = x
+            except (TypeError, ValueError) as e:
+                raise ValueError("Cannot batch data. Component {} of a datapoint: {}".format(k, e))
+
+    @staticmethod
+    def _aggregate_batch(data_holder, use_list=False):
+        if use_list:
+            size = len(data_holder[0])
+            return [[x[k] for x in data_holder] for k in range(size)]
+        batch = BatchData._alloc_batch(BatchData._batch_spec(data_holder[0]), len(data_holder))
+        for idx, dp in enumerate(data_holder):
+            BatchData._fill_batch(batch, idx, dp)
+        return batch
 
 
 class BatchDataByShape(BatchData):
@@ -496,6 +571,11 @@ class LocallyShuffleData(ProxyDataFlow, RNGDataFlow):
     """ Maintain a pool to buffer datapoints, and shuffle before producing them.
         This can be used as an alternative when a complete random read is too expensive
         or impossible for the data source.
+
+        Each new datapoint replaces a randomly chosen one in the pool, which is then produced.
+        Therefore every datapoint costs O(1), without periodic pauses to shuffle the pool.
+        Every datapoint of ``ds`` is produced exactly ``nr_reuse`` times, but
+        not necessarily within the same epoch: the pool is kept across epochs.
     """
 
     def __init__(self, ds, buffer_size, nr_reuse=1, shuffle_interval=None):
@@ -505,16 +585,15 @@ class LocallyShuffleData(ProxyDataFlow, RNGDataFlow):
             buffer_size (int): size of the buffer.
             nr_reuse (int): reuse each datapoints several times to improve
                 speed, but may hurt your model.
-            shuffle_interval (int): shuffle the buffer after this many
-                datapoints went through it. Frequent shuffle on large buffer
-                may affect speed, but infrequent shuffle may affect
-                randomness. Defaults to buffer_size / 3
+            shuffle_interval: deprecated and ignored. The buffer is now
+                shuffled continuously.
         """
         ProxyDataFlow.__init__(self, ds)
-        self.q = deque(maxlen=buffer_size)
-        if shuffle_interval is None:
-            shuffle_interval = int(buffer_size // 3)
-        self.shuffle_interval = shuffle_interval
+        self.buffer_size = buffer_size
+        self.q = []
+        if shuffle_interval is not None:
+            log_deprecated("LocallyShuffleData(shuffle_interval=)",
+                           "The buffer is now shuffled continuously.")
         self.nr_reuse = nr_reuse
 
     def reset_state(self):
@@ -523,59 +602,136 @@ class LocallyShuffleData(ProxyDataFlow, RNGDataFlow):
         self.ds_itr = RepeatedData(self.ds, -1).get_data()
         self.current_cnt = 0
 
-    def _add_data(self):
-        dp = next(self.ds_itr)
-        for _ in range(self.nr_reuse):
-            self.q.append(dp)
+    def _random_slots(self):
+        # draw random slots in batches, as each numpy rng call has a large overhead
+        while True:
+            for k in self.rng.randint(self.buffer_size, size=1024):
+                yield k
 
     def get_data(self):
-        # fill queue
-        while self.q.maxlen > len(self.q):
-            self._add_data()
-
+        # fill buffer
+        while len(self.q) < self.buffer_size:
+            dp = next(self.ds_itr)
+            self.q.extend([dp] * self.nr_reuse)
+        # the copies which do not fit go into the buffer first
+        overflow = self.q[self.buffer_size:]
+        del self.q[self.buffer_size:]
+
+        slots = self._random_slots()
+        q = self.q
         sz = self.size()
         cnt = 0
         while True:
-            self.rng.shuffle(self.q)
-            for _ in range(self.shuffle_interval):
-                # the inner loop maintains the queue size (almost) unchanged
-                for _ in range(self.nr_reuse):
-                    yield self.q.popleft()
-                cnt += self.nr_reuse
-                if cnt >= sz:
-                    return
-                self._add_data()
+            if overflow:
+                copies, overflow = overflow, None
+            else:
+                copies = [next(self.ds_itr)] * self.nr_reuse
+            for dp in copies:
+                k = next(slots)
+                yield q[k]
+                q[k] = dp
+            # check after all the copies of dp are in the buffer, so that none is lost
+            cnt += len(copies)
+            if cnt >= sz:
+                return
 
 
 class CacheData(ProxyDataFlow):
     """
-    Cache a dataflow completely in memory.
+    Cache a dataflow completely, in memory and optionally on disk.
+
+    The datapoints are cached during the first complete pass of the dataflow.
+    A pass which is interrupted is not used: the next pass starts over from the input.
+    Later passes are produced from the cache.
     """
-    def __init__(self, ds, shuffle=False):
+    def __init__(self, ds, shuffle=False, max_memory=None, spill_dir=None, serializer=None):
         """
         Args:
             ds (DataFlow): input DataFlow.
             shuffle (bool): whether to shuffle the datapoints before producing them.
+            max_memory (int): if not None, keep at most this many bytes of
+                datapoints in memory. Datapoints beyond the budget are serialized
+                to a temporary file, which is memory-mapped when the first pass finishes.
+                ndarrays read back from the file are read-only.
+            spill_dir (str): directory for the temporary file. Defaults to the
+                system temporary directory. Use a local disk.
+            serializer (str): serialization backend for the spilled datapoints.
+                By default, use "raw" for datapoints which are lists of ndarrays and "pickle" otherwise.
         """
         self.shuffle = shuffle
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.serializer = serializer
         super(CacheData, self).__init__(ds)
 
     def reset_state(self):
         super(CacheData, self).reset_state()
         if self.shuffle:
             self.rng = get_rng(self)
+        self._reset_cache()
+
+    def _reset_cache(self):
+        if getattr(self, '_spill_file', None) is not None and self._spill_mmap is None:
+            # left by an interrupted pass
+            self._spill_file.close()
         self.buffer = []
+        self._complete = False
+        self._memory = 0
+        self._spill_file = None
+        self._spill_mmap = None
+        self._spill_offsets = array.array('L')
+        self._spill_sizes = array.array('L')
+        self._spill_offset = 0
+
+    def _dumps(self, dp):
+        if self.serializer is not None:
+            return dumps(dp, self.serializer)
+        try:
+            return dumps(dp, 'raw')
+        except ValueError:
+            return dumps(dp, 'pickle')
+
+    def _add(self, dp):
+        if self.max_memory is not None and self._spill_file is None:
+            self._memory += sum(x.nbytes if isinstance(x, np.ndarray) else sys.getsizeof(x) for x in dp)
+            if self._memory > self.max_memory:
+                self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        if self._spill_file is None:
+            self.buffer.append(dp)
+            return
+        buf = self._dumps(dp)
+        pad = -len(buf) % 64     # keep the arrays aligned
+        self._spill_file.write(buf)
+        self._spill_file.write(b'\x00' * pad)
+        self._spill_offsets.append(self._spill_offset)
+        self._spill_sizes.append(len(buf))
+        self._spill_offset += len(buf) + pad
+
+    def _finish(self):
+        if self._spill_file is not None:
+            self._spill_file.flush()
+            self._spill_mmap = np.frombuffer(mmap.mmap(
+                self._spill_file.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+        self._complete = True
+
+    def _get_spilled(self, k):
+        offset = self._spill_offsets[k]
+        return loads(self._spill_mmap[offset:offset + self._spill_sizes[k]])
 
     def get_data(self):
-        if len(self.buffer):
+        if self._complete:
+            nr_mem = len(self.buffer)
+            idxs = np.arange(nr_mem + len(self._spill_offsets))
             if self.shuffle:
-                self.rng.shuffle(self.buffer)
-            for dp in self.buffer:
-                yield dp
+                self.rng.shuffle(idxs)
+            for k in idxs:
+                yield self.buffer[k] if k < nr_mem else self._get_spilled(k - nr_mem)
         else:
+            self._reset_cache()
             for dp in self.ds.get_data():
                 yield dp
-                self.buffer.append(dp)
+                self._add(dp)
+            self._finish()
 
 
 class PrintData(ProxyDataFlow):
@@ -4,7 +4,9 @@
 
 import sys
 import os
+import array
 import multiprocessing as mp
+import numpy as np
 from six.moves import range
 
 from .base import DataFlow
@@ -14,7 +16,7 @@ from ..utils.serialize import dumps
 from ..utils.fs import mkdir_p
 
 __all__ = ['dump_dataflow_images', 'dump_dataflow_to_process_queue',
-           'dump_dataflow_to_lmdb', 'dump_dataflow_to_tfrecord']
+           'dump_dataflow_to_lmdb', 'dump_dataflow_to_tfrecord', 'dump_dataflow_to_mmap']
 
 
 def dump_dataflow_images(df, dirname, max_count=None, index=0):
@@ -79,7 +81,7 @@ def dump_dataflow_to_process_queue(df, size, nr_consumer):
     return q, proc
 
 
-def dump_dataflow_to_lmdb(df, lmdb_path, write_frequency=5000):
+def dump_dataflow_to_lmdb(df, lmdb_path, write_frequency=5000, serializer=None):
     """
     Dump a Dataflow to a lmdb database, where the keys are indices and values
     are serialized datapoints.
@@ -90,6 +92,8 @@ def dump_dataflow_to_lmdb(df, lmdb_path, write_frequency=5000):
         df (DataFlow): the DataFlow to dump.
         lmdb_path (str): output path. Either a directory or a mdb file.
         write_frequency (int): the frequency to write back data to disk.
+        serializer (str): serialization backend for the datapoints.
+            See :func:`tensorpack.utils.serialize.dumps`.
     """
     assert isinstance(df, DataFlow), type(df)
     isdir = os.path.isdir(lmdb_path)
@@ -112,7 +116,7 @@ def dump_dataflow_to_lmdb(df, lmdb_path, write_frequency=5000):
         # although it has a contextmanager interface
         txn = db.begin(write=True)
         for idx, dp in enumerate(df.get_data()):
-            txn.put(u'{}'.format(idx).encode('ascii'), dumps(dp))
+            txn.put(u'{}'.format(idx).encode('ascii'), dumps(dp, serializer))
             pbar.update()
             if (idx + 1) % write_frequency == 0:
                 txn.commit()
@@ -121,14 +125,79 @@ def dump_dataflow_to_lmdb(df, lmdb_path, write_frequency=5000):
 
         keys = [u'{}'.format(k).encode('ascii') for k in range(idx + 1)]
         with db.begin(write=True) as txn:
-            txn.put(b'__keys__', dumps(keys))
+            txn.put(b'__keys__', dumps(keys, 'msgpack'))
 
         logger.info("Flushing database ...")
         db.sync()
     db.close()
 
 
-def dump_dataflow_to_tfrecord(df, path):
+def dump_dataflow_to_mmap(df, dirname, shard_size=1 << 32, serializer=None):
+    """
+    Dump a Dataflow to a directory of memory-mappable files, which can be read by
+    :class:`tensorpack.dataflow.MmapData` with random access.
+
+    The directory contains ``index.npy``, a structured array of (shard, offset, size)
+    for each datapoint, and one or more shards ``data-xxxxx.bin`` with the serialized
+    datapoints, each aligned to 64 bytes.
+
+    Args:
+        df (DataFlow): the DataFlow to dump.
+        dirname (str): output directory.
+        shard_size (int): start a new shard after this many bytes.
+        serializer (str): serialization backend for the datapoints.
+            By default, use "raw" for datapoints which are lists of ndarrays and "pickle" otherwise,
+            so that :class:`MmapData` can produce ndarrays viewing the mmap without copies.
+    """
+    assert isinstance(df, DataFlow), type(df)
+    mkdir_p(dirname)
+    assert not os.path.isfile(os.path.join(dirname, 'index.npy')), "Index file exists!"
+
+    def dump_fn(dp):
+        if serializer is not None:
+            return dumps(dp, serializer)
+        try:
+            return dumps(dp, 'raw')
+        except ValueError:
+            return dumps(dp, 'pickle')
+
+    df.reset_state()
+    try:
+        sz = df.size()
+    except NotImplementedError:
+        sz = 0
+    shards, offsets, sizes = array.array('L'), array.array('L'), array.array('L')
+    shard_id, offset = 0, 0
+    f = open(os.path.join(dirname, 'data-{:05d}.bin'.format(shard_id)), 'wb')
+    try:
+        with get_tqdm(total=sz) as pbar:
+            for dp in df.get_data():
+                buf = dump_fn(dp)
+                if offset > 0 and offset + len(buf) > shard_size:
+                    f.close()
+                    shard_id, offset = shard_id + 1, 0
+                    f = open(os.path.join(dirname, 'data-{:05d}.bin'.format(shard_id)), 'wb')
+                f.write(buf)
+                shards.append(shard_id)
+                offsets.append(offset)
+                sizes.append(len(buf))
+                offset += len(buf)
+                pad = -offset % 64
+                f.write(b'\x00' * pad)
+                offset += pad
+                pbar.update()
+    finally:
+        f.close()
+
+    index = np.empty(len(shards), dtype=[('shard', '<u4'), ('offset', '<u8'), ('size', '<u8')])
+    index['shard'] = shards
+    index['offset'] = offsets
+    index['size'] = sizes
+    np.save(os.path.join(dirname, 'index.npy'), index)
+    logger.info("Dumped {} datapoints into {} shard(s) in {}.".format(len(index), shard_id + 1, dirname))
+
+
+def dump_dataflow_to_tfrecord(df, path, serializer=None):
     """
     Dump all datapoints of a Dataflow to a TensorFlow TFRecord file,
     using :func:`serialize.dumps` to serialize.
@@ -136,6 +205,7 @@ def dump_dataflow_to_tfrecord(df, path):
     Args:
         df (DataFlow):
         path (str): the output file path
+        serializer (str): serialization backend for the datapoints.
     """
     df.reset_state()
     with tf.python_io.TFRecordWriter(path) as writer:
@@ -145,7 +215,7 @@ def dump_dataflow_to_tfrecord(df, path):
             sz = 0
         with get_tqdm(total=sz) as pbar:
             for dp in df.get_data():
-                writer.write(dumps(dp))
+                writer.write(dumps(dp, serializer))
                 pbar.update()
 
 
@@ -5,6 +5,7 @@
 import numpy as np
 import six
 from six.moves import range
+import mmap
 import os
 
 from ..utils import logger, get_tqdm
@@ -16,7 +17,7 @@ from .base import RNGDataFlow, DataFlow
 from .common import MapData
 
 __all__ = ['HDF5Data', 'LMDBData', 'LMDBDataDecoder', 'LMDBDataPoint',
-           'CaffeLMDB', 'SVMLightData', 'TFRecordData']
+           'CaffeLMDB', 'SVMLightData', 'TFRecordData', 'MmapData']
 
 """
 Adapters for different data format.
@@ -27,41 +28,97 @@ class HDF5Data(RNGDataFlow):
     """
     Zip data from different paths in an HDF5 file.
 
-    Warning:
-        The current implementation will load all data into memory.
+    By default it loads all data into memory. With ``lazy=True``, it reads
+    from the file in chunks instead, which works for files larger than memory:
+    the chunks are visited in a random order, and a window of consecutive
+    chunks is shuffled in memory. The shuffling is therefore only local.
     """
-    # TODO lazy load
 
-    def __init__(self, filename, data_paths, shuffle=True):
+    def __init__(self, filename, data_paths, shuffle=True,
+                 lazy=False, chunk_size=None, buffer_size=None):
         """
         Args:
             filename (str): h5 data file.
             data_paths (list): list of h5 paths to zipped.
                 For example `['images', 'labels']`.
             shuffle (bool): shuffle all data.
+            lazy (bool): read data from the file on demand, rather than
+                loading everything into memory.
+            chunk_size (int): number of datapoints to read at a time in lazy mode.
+                Defaults to the chunk size of the datasets, so that each
+                HDF5 chunk is read and decompressed only once.
+            buffer_size (int): number of datapoints to shuffle in memory in lazy mode.
+                It is rounded to a multiple of ``chunk_size``. Defaults to 10 chunks.
         """
-        self.f = h5py.File(filename, 'r')
-        logger.info("Loading {} to memory...".format(filename))
-        self.dps = [self.f[k].value for k in data_paths]
-        lens = [len(k) for k in self.dps]
+        self._filename = filename
+        self._data_paths = data_paths
+        self.shuffle = shuffle
+        self.lazy = lazy
+
+        f = h5py.File(filename, 'r')
+        lens = [len(f[k]) for k in data_paths]
         assert all([k == lens[0] for k in lens])
         self._size = lens[0]
-        self.shuffle = shuffle
+        if lazy:
+            if chunk_size is None:
+                chunks = [f[k].chunks[0] for k in data_paths if f[k].chunks is not None]
+                chunk_size = max(chunks) if chunks else 1000
+            self._chunk_size = int(chunk_size)
+            if buffer_size is None:
+                buffer_size = self._chunk_size * 10
+            self._nr_chunk_per_buffer = max(int(buffer_size) // self._chunk_size, 1)
+            # h5py file handles cannot be shared with forked processes,
+            # so the file is reopened in reset_state
+            f.close()
+            self.f = None
+        else:
+            self.f = f
+            logger.info("Loading {} to memory...".format(filename))
+            self.dps = [self.f[k][:] for k in data_paths]
+
+    def reset_state(self):
+        super(HDF5Data, self).reset_state()
+        if self.lazy:
+            if self.f is not None:
+                self.f.close()
+            self.f = h5py.File(self._filename, 'r')
 
     def size(self):
         return self._size
 
     def get_data(self):
+        if self.lazy:
+            for dp in self._get_data_lazy():
+                yield dp
+            return
         idxs = list(range(self._size))
         if self.shuffle:
             self.rng.shuffle(idxs)
         for k in idxs:
             yield [dp[k] for dp in self.dps]
 
+    def _get_data_lazy(self):
+        if self.f is None:
+            self.f = h5py.File(self._filename, 'r')
+        dsets = [self.f[k] for k in self._data_paths]
+        starts = np.arange(0, self._size, self._chunk_size)
+        if self.shuffle:
+            self.rng.shuffle(starts)
+        for i in range(0, len(starts), self._nr_chunk_per_buffer):
+            # read the chunks in the window in file order
+            window = sorted(starts[i:i + self._nr_chunk_per_buffer])
+            buf = [np.concatenate([d[s:s + self._chunk_size] for s in window]) for d in dsets]
+            idxs = np.arange(len(buf[0]))
+            if self.shuffle:
+                self.rng.shuffle(idxs)
+            for k in idxs:
+                yield [b[k] for b in buf]
+
 
 class LMDBData(RNGDataFlow):
     """ Read a LMDB database and produce (k,v) pairs """
-    def __init__(self, lmdb_path, shuffle=True, keys=None):
+    def __init__(self, lmdb_path, shuffle=True, keys=None,
+                 block_size=None, buffer_size=None):
         """
         Args:
             lmdb_path (str): a directory or a file.
@@ -74,9 +131,25 @@ class LMDBData(RNGDataFlow):
                 :func:`dump_dataflow_to_lmdb` used to store the list of keys.
                 If still not found, it will iterate over the database to find
                 all the keys.
+            block_size (int): if not None and shuffle is True, split the
+                sorted keys into blocks of this many contiguous keys, and
+                read the blocks in a random order, each with a sequential cursor scan.
+                Only the given keys are produced.
+                This is much faster than one random read per key on HDDs
+                or network storage.
+            buffer_size (int): number of datapoints to shuffle in memory when
+                reading by blocks. It is rounded to a multiple of ``block_size``.
+                Defaults to 10 blocks.
         """
         self._lmdb_path = lmdb_path
         self._shuffle = shuffle
+        self._block_size = block_size
+        if block_size is not None:
+            if buffer_size is None:
+                buffer_size = block_size * 10
+            self._nr_block_per_buffer = max(buffer_size // block_size, 1)
+        self._block_starts = None
+        self._key_set = None
 
         self.open_lmdb()
         self._size = self._txn.stat()['entries']
@@ -107,7 +180,7 @@ class LMDBData(RNGDataFlow):
             else:
                 # check if key-format like '{:0>8d}' was given
                 if isinstance(keys, six.string_types):
-                    self.keys = map(lambda x: keys.format(x), list(np.arange(self._size)))
+                    self.keys = [keys.format(x) for x in range(self._size)]
                 else:
                     self.keys = keys
 
@@ -133,12 +206,41 @@ class LMDBData(RNGDataFlow):
                 k, v = c.item()
                 if k != b'__keys__':
                     yield [k, v]
+        elif self._block_size is not None:
+            for dp in self._get_data_by_blocks():
+                yield dp
         else:
             self.rng.shuffle(self.keys)
             for k in self.keys:
                 v = self._txn.get(k)
                 yield [k, v]
 
+    def _get_data_by_blocks(self):
+        if self._block_starts is None:
+            keys = sorted(k if isinstance(k, bytes) else k.encode('utf-8') for k in self.keys)
+            self._block_starts = keys[::self._block_size]
+            # the scan also finds the keys in the database which are not in self.keys
+            self._key_set = set(keys)
+        starts = self._block_starts
+        key_set = self._key_set
+        c = self._txn.cursor()
+        buf = []
+        for i, b in enumerate(self.rng.permutation(len(starts))):
+            # a block spans all the keys until the next block start
+            end = starts[b + 1] if b + 1 < len(starts) else None
+            if c.set_range(starts[b]):
+                for k, v in c.iternext():
+                    # the end key may not exist in the database
+                    if end is not None and k >= end:
+                        break
+                    if k in key_set:
+                        buf.append([k, v])
+            if (i + 1) % self._nr_block_per_buffer == 0 or i + 1 == len(starts):
+                self.rng.shuffle(buf)
+                for dp in buf:
+                    yield dp
+                buf = []
+
 
 class LMDBDataDecoder(MapData):
     """ Read a LMDB database and produce a decoded output."""
@@ -274,6 +376,71 @@ class TFRecordData(DataFlow):
         for dp in self._gen:
             yield loads(dp)
 
+
+class MmapData(RNGDataFlow):
+    """
+    Produce datapoints from the directory written by
+    :func:`tensorpack.dataflow.dftools.dump_dataflow_to_mmap`.
+
+    The data shards are memory-mapped, and any datapoint can be read in O(1)
+    with ``ds[idx]``. ndarrays stored by the "raw" or "pickle" serializer are
+    read-only views into the mmap rather than copies.
+    Copy them if you need to modify them in place.
+
+    Example:
+        .. code-block:: python
+
+            # in each of the 8 training processes:
+            ds = MmapData('/data/ImageNet-train', shuffle=True, nr_shard=8, shard_id=rank)
+    """
+    def __init__(self, dirname, shuffle=True, nr_shard=1, shard_id=0):
+        """
+        Args:
+            dirname (str): the directory containing ``index.npy`` and the data shards.
+            shuffle (bool): produce datapoints in a random permutation.
+            nr_shard, shard_id (int): only produce the datapoints whose
+                index modulo ``nr_shard`` equals ``shard_id``, e.g. to split
+                the data among workers.
+        """
+        assert 0 <= shard_id < nr_shard, (shard_id, nr_shard)
+        self._dirname = dirname
+        self.shuffle = shuffle
+        self._index = np.load(os.path.join(dirname, 'index.npy'), mmap_mode='r')
+        self._idxs = np.arange(shard_id, len(self._index), nr_shard)
+        self._shards = None
+        logger.info("Found {} entries in {}".format(len(self._index), dirname))
+
+    def _open_shards(self):
+        self._shards = []
+        for k in range(int(self._index['shard'].max()) + 1 if len(self._index) else 0):
+            with open(os.path.join(self._dirname, 'data-{:05d}.bin'.format(k)), 'rb') as f:
+                self._shards.append(np.frombuffer(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8))
+
+    def reset_state(self):
+        super(MmapData, self).reset_state()
+        # reopen, so that processes forked later don't share file positions
+        self._open_shards()
+
+    def size(self):
+        return len(self._idxs)
+
+    def __getitem__(self, idx):
+        """
+        Args:
+            idx (int): global index of the datapoint, regardless of sharding.
+        """
+        if self._shards is None:
+            self._open_shards()
+        shard, offset, size = self._index[idx]
+        return loads(self._shards[shard][offset:offset + size])
+
+    def get_data(self):
+        idxs = self.rng.permutation(self._idxs) if self.shuffle else self._idxs
+        for k in idxs:
+            yield self[k]
+
+
 from ..utils.develop import create_dummy_class   # noqa
 try:
     import h5py
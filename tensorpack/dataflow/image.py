@@ -9,7 +9,8 @@ from .common import MapDataComponent, MapData
 from ..utils import logger
 from ..utils.argtools import shape2d
 
-__all__ = ['ImageFromFile', 'AugmentImageComponent', 'AugmentImageComponents']
+__all__ = ['ImageFromFile', 'AugmentImageComponent', 'AugmentImageComponents',
+           'AugmentImageBatchComponent']
 
 
 class ImageFromFile(RNGDataFlow):
@@ -91,6 +92,54 @@ class AugmentImageComponent(MapDataComponent):
         self.augs.reset_state()
 
 
+class AugmentImageBatchComponent(MapDataComponent):
+    """
+    Apply image augmentors on 1 component of batched datapoints, e.g. after
+    :class:`BatchData`. Each image in the batch gets its own random parameters.
+    Augmentors which implement batched augmentation (e.g. the color
+    augmentors) apply vectorized operations on the whole NHWC batch,
+    the others are applied image by image.
+    """
+    def __init__(self, ds, augmentors, index=0, copy=True):
+        """
+        Args:
+            ds (DataFlow): input DataFlow.
+            augmentors (AugmentorList): a list of :class:`imgaug.ImageAugmentor` to be applied in order.
+            index (int): the index of the image batch component to be augmented.
+            copy (bool): Some augmentors modify the input images. When copy is
+                True, a copy will be made before any augmentors are applied,
+                to keep the original images not modified.
+                Turn it off to save time when you know it's OK.
+        """
+        if isinstance(augmentors, AugmentorList):
+            self.augs = augmentors
+        else:
+            self.augs = AugmentorList(augmentors)
+
+        self._nr_error = 0
+
+        def func(x):
+            try:
+                if copy:
+                    x = np.array(x) if isinstance(x, np.ndarray) else copy_mod.deepcopy(x)
+                ret = self.augs.augment_batch(x)
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                self._nr_error += 1
+                if self._nr_error % 1000 == 0 or self._nr_error < 10:
+                    logger.exception("Got {} augmentation errors.".format(self._nr_error))
+                return None
+            return ret
+
+        super(AugmentImageBatchComponent, self).__init__(
+            ds, func, index)
+
+    def reset_state(self):
+        self.ds.reset_state()
+        self.augs.reset_state()
+
+
 class AugmentImageComponents(MapData):
     """
     Apply image augmentors on several components, with shared augmentation parameters.
@@ -147,3 +196,4 @@ except ImportError:
     ImageFromFile = create_dummy_class('ImageFromFile', 'cv2')  # noqa
     AugmentImageComponent = create_dummy_class('AugmentImageComponent', 'cv2')  # noqa
     AugmentImageComponents = create_dummy_class('AugmentImageComponents', 'cv2')  # noqa
+    AugmentImageBatchComponent = create_dummy_class('AugmentImageBatchComponent', 'cv2')  # noqa
@@ -4,10 +4,12 @@
 
 from abc import abstractmethod, ABCMeta
 from ...utils import get_rng
+import numpy as np
 import six
 from six.moves import zip
+from .transform import AffineTransform
 
-__all__ = ['Augmentor', 'ImageAugmentor', 'AugmentorList']
+__all__ = ['Augmentor', 'ImageAugmentor', 'TransformAugmentorBase', 'AugmentorList']
 
 
 @six.add_metaclass(ABCMeta)
@@ -34,6 +36,21 @@ class Augmentor(object):
         d, params = self._augment_return_params(d)
         return d
 
+    def augment_batch(self, imgs):
+        """
+        Perform augmentation on a batch of data, with independent random
+        parameters for each of them.
+
+        Args:
+            imgs: a NHWC ndarray, or a list of images.
+
+        Returns:
+            the augmented batch. An ndarray if all the outputs have the
+            same shape and dtype, otherwise a list.
+        """
+        imgs, params = self._augment_batch_return_params(imgs)
+        return imgs
+
     def _augment_return_params(self, d):
         """
         Augment the image and return both image and params
@@ -41,6 +58,26 @@ class Augmentor(object):
         prms = self._get_augment_params(d)
         return (self._augment(d, prms), prms)
 
+    def _augment_batch_return_params(self, imgs):
+        """
+        Augment a batch and return both the batch and a list of params.
+        Augmentors which can draw the params for the whole batch at once and
+        apply vectorized operations should override this and
+        :meth:`_augment_batch`. By default it augments the images one by one.
+        """
+        ret, prms = [], []
+        for img in imgs:
+            img, prm = self._augment_return_params(img)
+            ret.append(img)
+            prms.append(prm)
+        return _stack_images(ret), prms
+
+    def _augment_batch(self, imgs, params):
+        """
+        Augment a batch with the given list of params, and return the new batch.
+        """
+        return _stack_images([self._augment(img, prm) for img, prm in zip(imgs, params)])
+
     @abstractmethod
     def _augment(self, d, param):
         """
@@ -61,22 +98,107 @@ class Augmentor(object):
         return self.rng.uniform(low, high, size)
 
 
+def _stack_images(imgs):
+    """ Stack a list of images to an ndarray if they have the same shape and dtype. """
+    if len(imgs) and all(isinstance(x, np.ndarray) for x in imgs):
+        shape, dtype = imgs[0].shape, imgs[0].dtype
+        if all(x.shape == shape and x.dtype == dtype for x in imgs):
+            return np.stack(imgs)
+    return imgs
+
+
+def _batch_param(v, imgs):
+    """ Reshape a vector of per-image params, to broadcast with a NHWC batch. """
+    v = np.asarray(v)
+    if v.dtype == np.float64:
+        v = v.astype('float32')     # don't promote float32 images
+    return v.reshape((len(v),) + (1,) * (imgs.ndim - 1))
+
+
 class ImageAugmentor(Augmentor):
     def _fprop_coord(self, coord, param):
         return coord
 
 
+class TransformAugmentorBase(ImageAugmentor):
+    """
+    Base class of augmentors whose :meth:`_get_augment_params` returns an
+    :class:`ImageTransform`. Its result must only depend on the shape and
+    dtype of the image, so that consecutive such augmentors in
+    :class:`AugmentorList` can be fused into one warp.
+    """
+
+    def _augment(self, img, t):
+        return t.apply_image(img)
+
+    def _fprop_coord(self, coord, t):
+        return t.apply_coords(coord)
+
+
+def _is_fusable(aug):
+    """ Whether the augmentor can be fused, i.e. it doesn't override how the transform is applied. """
+    return isinstance(aug, TransformAugmentorBase) and \
+        six.get_unbound_function(type(aug)._augment) is \
+        six.get_unbound_function(TransformAugmentorBase._augment)
+
+
+def _apply_transforms(img, ts):
+    """
+    Apply a list of :class:`ImageTransform`. When one of them needs a
+    ``cv2.warpAffine`` anyway and all the others are affine, they are fused
+    into that single warp. Otherwise they are applied one by one, because
+    crop, flip and ``cv2.resize`` are cheaper than a warp.
+    """
+    ts = [t for t in ts if not t.is_identity()]
+    if len(ts) > 1 and any(isinstance(t, AffineTransform) for t in ts) \
+            and (img.ndim == 2 or img.shape[2] <= 4):
+        fused = ts[0].to_affine()
+        for t in ts[1:]:
+            if fused is None:
+                break
+            t = t.to_affine()
+            fused = None if t is None else fused.compose(t)
+        if fused is not None:
+            return fused.apply_image(img)
+    for t in ts:
+        img = t.apply_image(img)
+    return img
+
+
+def _shape_placeholder(img, ts):
+    """ An array with the shape of ``img`` after affine transforms ``ts``, without any computation. """
+    shape = img.shape[:2]
+    for t in ts:
+        out_shape = t.to_affine().out_shape
+        if out_shape is not None:   # None keeps the size
+            shape = out_shape
+    return np.broadcast_to(np.zeros((), dtype=img.dtype), shape + img.shape[2:])
+
+
 class AugmentorList(ImageAugmentor):
     """
     Augment by a list of augmentors
     """
 
-    def __init__(self, augmentors):
+    def __init__(self, augmentors, fuse_affine=False):
         """
         Args:
             augmentors (list): list of :class:`ImageAugmentor` instance to be applied.
+            fuse_affine (bool): fuse consecutive :class:`TransformAugmentorBase`
+                (e.g. shift, rotation, and the resize, crop, flip around them)
+                into a single warp, which saves a pass over the image for each
+                of them. The results differ numerically from applying them
+                one by one (e.g. a resize followed by a crop is interpolated
+                once on the final grid), mostly near the borders.
+                Augmentors which override ``_augment`` are not fused.
+                The transforms are computed from the first image, so when
+                used with :class:`AugmentImageComponents`, all the components
+                must have the same size.
+                To use it in :class:`AugmentImageComponent`, pass an
+                ``AugmentorList(augs, fuse_affine=True)`` as the augmentors.
         """
         self.augs = augmentors
+        self.fuse_affine = fuse_affine
         super(AugmentorList, self).__init__()
 
     def _get_augment_params(self, img):
@@ -86,17 +208,62 @@ class AugmentorList(ImageAugmentor):
     def _augment_return_params(self, img):
         assert img.ndim in [2, 3], img.ndim
 
+        if not self.fuse_affine:
+            prms = []
+            for a in self.augs:
+                img, prm = a._augment_return_params(img)
+                prms.append(prm)
+            return img, prms
+
         prms = []
+        pending = []    # transforms not yet applied to img
         for a in self.augs:
-            img, prm = a._augment_return_params(img)
-            prms.append(prm)
-        return img, prms
+            if _is_fusable(a):
+                if pending and pending[-1].to_affine() is None:
+                    img = _apply_transforms(img, pending)
+                    pending = []
+                t = a._get_augment_params(_shape_placeholder(img, pending) if pending else img)
+                pending.append(t)
+                prms.append(t)
+            else:
+                img = _apply_transforms(img, pending)
+                pending = []
+                img, prm = a._augment_return_params(img)
+                prms.append(prm)
+        return _apply_transforms(img, pending), prms
 
     def _augment(self, img, param):
         assert img.ndim in [2, 3], img.ndim
+        if not self.fuse_affine:
+            for aug, prm in zip(self.augs, param):
+                img = aug._augment(img, prm)
+            return img
+
+        pending = []
+        for aug, prm in zip(self.augs, param):
+            if _is_fusable(aug):
+                pending.append(prm)
+            else:
+                img = aug._augment(_apply_transforms(img, pending), prm)
+                pending = []
+        return _apply_transforms(img, pending)
+
+    def _fprop_coord(self, coord, param):
+        for aug, prm in zip(self.augs, param):
+            coord = aug._fprop_coord(coord, prm)
+        return coord
+
+    def _augment_batch_return_params(self, imgs):
+        prms = []
+        for a in self.augs:
+            imgs, prm = a._augment_batch_return_params(imgs)
+            prms.append(prm)
+        return imgs, prms
+
+    def _augment_batch(self, imgs, param):
         for aug, prm in zip(self.augs, param):
-            img = aug._augment(img, prm)
-        return img
+            imgs = aug._augment_batch(imgs, prm)
+        return imgs
 
     def reset_state(self):
         """ Will reset state of each augmentor """
@@ -2,7 +2,8 @@
 # File: crop.py
 # Author: Yuxin Wu <ppwwyyxx@gmail.com>
 
-from .base import ImageAugmentor
+from .base import ImageAugmentor, TransformAugmentorBase
+from .transform import CropTransform
 from ...utils.rect import Rect
 from ...utils.argtools import shape2d
 
@@ -13,7 +14,7 @@ __all__ = ['RandomCrop', 'CenterCrop',
            'perturb_BB', 'RandomCropAroundBox', 'RandomCropRandomShape']
 
 
-class RandomCrop(ImageAugmentor):
+class RandomCrop(TransformAugmentorBase):
     """ Randomly crop the image into a smaller one """
 
     def __init__(self, crop_shape):
@@ -33,17 +34,10 @@ class RandomCrop(ImageAugmentor):
         h0 = 0 if diffh == 0 else self.rng.randint(diffh)
         diffw = orig_shape[1] - self.crop_shape[1]
         w0 = 0 if diffw == 0 else self.rng.randint(diffw)
-        return (h0, w0)
+        return CropTransform(h0, w0, self.crop_shape[0], self.crop_shape[1])
 
-    def _augment(self, img, param):
-        h0, w0 = param
-        return img[h0:h0 + self.crop_shape[0], w0:w0 + self.crop_shape[1]]
 
-    def _fprop_coord(self, coord, param):
-        raise NotImplementedError()
-
-
-class CenterCrop(ImageAugmentor):
+class CenterCrop(TransformAugmentorBase):
     """ Crop the image at the center"""
 
     def __init__(self, crop_shape):
@@ -54,14 +48,11 @@ class CenterCrop(ImageAugmentor):
         crop_shape = shape2d(crop_shape)
         self._init(locals())
 
-    def _augment(self, img, _):
+    def _get_augment_params(self, img):
         orig_shape = img.shape
         h0 = int((orig_shape[0] - self.crop_shape[0]) * 0.5)
         w0 = int((orig_shape[1] - self.crop_shape[1]) * 0.5)
-        return img[h0:h0 + self.crop_shape[0], w0:w0 + self.crop_shape[1]]
-
-    def _fprop_coord(self, coord, param):
-        raise NotImplementedError()
+        return CropTransform(h0, w0, self.crop_shape[0], self.crop_shape[1])
 
 
 def perturb_BB(image_shape, bb, max_perturb_pixel,
@@ -131,7 +122,7 @@ class RandomCropAroundBox(ImageAugmentor):
         raise NotImplementedError()
 
 
-class RandomCropRandomShape(ImageAugmentor):
+class RandomCropRandomShape(TransformAugmentorBase):
     """ Random crop with a random shape"""
 
     def __init__(self, wmin, hmin,
@@ -159,11 +150,7 @@ class RandomCropRandomShape(ImageAugmentor):
         assert diffh >= 0 and diffw >= 0
         y0 = 0 if diffh == 0 else self.rng.randint(diffh)
         x0 = 0 if diffw == 0 else self.rng.randint(diffw)
-        return (y0, x0, h, w)
-
-    def _augment(self, img, param):
-        y0, x0, h, w = param
-        return img[y0:y0 + h, x0:x0 + w]
+        return CropTransform(y0, x0, h, w)
 
 
 if __name__ == '__main__':
@@ -3,7 +3,8 @@
 # File: geometry.py
 # Author: Yuxin Wu <ppwwyyxxc@gmail.com>
 
-from .base import ImageAugmentor
+from .base import ImageAugmentor, TransformAugmentorBase
+from .transform import AffineTransform
 import math
 import cv2
 import numpy as np
@@ -11,7 +12,7 @@ import numpy as np
 __all__ = ['Shift', 'Rotation', 'RotationAndCropValid']
 
 
-class Shift(ImageAugmentor):
+class Shift(TransformAugmentorBase):
     """ Random horizontal and vertical shifts """
 
     def __init__(self, horiz_frac=0, vert_frac=0,
@@ -32,18 +33,12 @@ class Shift(ImageAugmentor):
         max_dy = self.vert_frac * img.shape[0]
         dx = np.round(self._rand_range(-max_dx, max_dx))
         dy = np.round(self._rand_range(-max_dy, max_dy))
-        return np.float32(
-            [[1, 0, dx], [0, 1, dy]])
+        # keep the size of each image, which may differ in AugmentImageComponents
+        return AffineTransform([[1, 0, dx], [0, 1, dy]], None,
+                               border=self.border, border_value=self.border_value)
 
-    def _augment(self, img, shift_m):
-        ret = cv2.warpAffine(img, shift_m, img.shape[1::-1],
-                             borderMode=self.border, borderValue=self.border_value)
-        if img.ndim == 3 and ret.ndim == 2:
-            ret = ret[:, :, np.newaxis]
-        return ret
 
-
-class Rotation(ImageAugmentor):
+class Rotation(TransformAugmentorBase):
     """ Random rotate the image w.r.t a random center"""
 
     def __init__(self, max_deg, center_range=(0, 1),
@@ -70,14 +65,9 @@ class Rotation(ImageAugmentor):
         deg = self._rand_range(-self.max_deg, self.max_deg)
         if self.step_deg:
             deg = deg // self.step_deg * self.step_deg
-        return cv2.getRotationMatrix2D(tuple(center - 0.5), deg, 1)
-
-    def _augment(self, img, rot_m):
-        ret = cv2.warpAffine(img, rot_m, img.shape[1::-1],
-                             flags=self.interp, borderMode=self.border, borderValue=self.border_value)
-        if img.ndim == 3 and ret.ndim == 2:
-            ret = ret[:, :, np.newaxis]
-        return ret
+        return AffineTransform.from_warp_matrix(
+            cv2.getRotationMatrix2D(tuple(center - 0.5), float(deg), 1), None,
+            interp=self.interp, border=self.border, border_value=self.border_value)
 
 
 class RotationAndCropValid(ImageAugmentor):
@@ -2,7 +2,7 @@
 # File: imgproc.py
 # Author: Yuxin Wu <ppwwyyxx@gmail.com>
 
-from .base import ImageAugmentor
+from .base import ImageAugmentor, _batch_param
 import numpy as np
 import cv2
 
@@ -56,6 +56,15 @@ class Brightness(ImageAugmentor):
             img = np.clip(img, 0, 255)
         return img.astype(old_dtype)
 
+    def _augment_batch_return_params(self, imgs):
+        v = self._rand_range(-self.delta, self.delta, size=len(imgs))
+        return self._augment_batch(imgs, v), v
+
+    def _augment_batch(self, imgs, v):
+        if not isinstance(imgs, np.ndarray):
+            return super(Brightness, self)._augment_batch(imgs, v)
+        return self._augment(imgs, _batch_param(v, imgs))
+
 
 class Contrast(ImageAugmentor):
     """
@@ -83,6 +92,23 @@ class Contrast(ImageAugmentor):
             img = np.clip(img, 0, 255)
         return img.astype(old_dtype)
 
+    def _augment_batch_return_params(self, imgs):
+        r = self._rand_range(*self.factor_range, size=len(imgs))
+        return self._augment_batch(imgs, r), r
+
+    def _augment_batch(self, imgs, r):
+        if not isinstance(imgs, np.ndarray):
+            return super(Contrast, self)._augment_batch(imgs, r)
+        old_dtype = imgs.dtype
+        imgs = imgs.astype('float32')
+        mean = np.mean(imgs, axis=(1, 2), keepdims=True)
+        imgs -= mean
+        imgs *= _batch_param(r, imgs)
+        imgs += mean
+        if self.clip or old_dtype == np.uint8:
+            np.clip(imgs, 0, 255, out=imgs)
+        return imgs.astype(old_dtype)
+
 
 class MeanVarianceNormalize(ImageAugmentor):
     """
@@ -112,6 +138,20 @@ class MeanVarianceNormalize(ImageAugmentor):
         img = (img - mean) / std
         return img
 
+    def _augment_batch_return_params(self, imgs):
+        prms = [None] * len(imgs)
+        return self._augment_batch(imgs, prms), prms
+
+    def _augment_batch(self, imgs, prms):
+        if not isinstance(imgs, np.ndarray):
+            return super(MeanVarianceNormalize, self)._augment_batch(imgs, prms)
+        imgs = imgs.astype('float32')
+        axis = tuple(range(1, imgs.ndim)) if self.all_channel else (1, 2)
+        mean = np.mean(imgs, axis=axis, keepdims=True)
+        std = np.std(imgs, axis=axis, keepdims=True)
+        std = np.maximum(std, 1.0 / np.sqrt(np.prod(imgs.shape[1:])))
+        return (imgs - mean) / std
+
 
 class GaussianBlur(ImageAugmentor):
     """ Gaussian blur the image with random window size"""
@@ -157,6 +197,22 @@ class Gamma(ImageAugmentor):
             ret = ret[:, :, np.newaxis]
         return ret
 
+    def _augment_batch_return_params(self, imgs):
+        gamma = self._rand_range(*self.range, size=len(imgs))
+        return self._augment_batch(imgs, gamma), gamma
+
+    def _augment_batch(self, imgs, gamma):
+        if not isinstance(imgs, np.ndarray):
+            return super(Gamma, self)._augment_batch(imgs, gamma)
+        old_dtype = imgs.dtype
+        gamma = np.asarray(gamma, dtype='float32')
+        # one lookup table per image, concatenated
+        base = (np.arange(256, dtype='float32') / 255)[np.newaxis, :]
+        luts = (base ** (1. / (1. + gamma))[:, np.newaxis] * 255).astype('uint8').reshape(-1)
+        idx = np.clip(imgs, 0, 255).astype(np.intp)
+        idx += _batch_param(np.arange(0, 256 * len(imgs), 256), imgs)
+        return luts.take(idx).astype(old_dtype)
+
 
 class Clip(ImageAugmentor):
     """ Clip the pixel values """
@@ -172,6 +228,15 @@ class Clip(ImageAugmentor):
         img = np.clip(img, self.min, self.max)
         return img
 
+    def _augment_batch_return_params(self, imgs):
+        prms = [None] * len(imgs)
+        return self._augment_batch(imgs, prms), prms
+
+    def _augment_batch(self, imgs, prms):
+        if not isinstance(imgs, np.ndarray):
+            return super(Clip, self)._augment_batch(imgs, prms)
+        return np.clip(imgs, self.min, self.max)
+
 
 class Saturation(ImageAugmentor):
     """ Randomly adjust saturation of BGR input.
@@ -197,6 +262,24 @@ class Saturation(ImageAugmentor):
         ret = img * v + (grey * (1 - v))[:, :, np.newaxis]
         return ret.astype(old_dtype)
 
+    def _augment_batch_return_params(self, imgs):
+        v = 1 + self._rand_range(-self.alpha, self.alpha, size=len(imgs))
+        return self._augment_batch(imgs, v), v
+
+    def _augment_batch(self, imgs, v):
+        if not isinstance(imgs, np.ndarray):
+            return super(Saturation, self)._augment_batch(imgs, v)
+        old_dtype = imgs.dtype
+        # same coefficients as cv2.COLOR_BGR2GRAY
+        n, h, w, c = imgs.shape
+        # the batch, viewed as one tall image, is converted with a single call
+        grey = cv2.cvtColor(np.ascontiguousarray(imgs).reshape(n * h, w, c), cv2.COLOR_BGR2GRAY)
+        v = _batch_param(v, imgs)
+        grey = grey.reshape(n, h, w, 1) * (1 - v)
+        ret = imgs * v
+        ret += grey
+        return ret.astype(old_dtype)
+
 
 class Lighting(ImageAugmentor):
     """ Lighting noise, as in the paper
@@ -233,6 +316,21 @@ class Lighting(ImageAugmentor):
             img = np.clip(img, 0, 255)
         return img.astype(old_dtype)
 
+    def _augment_batch_return_params(self, imgs):
+        assert imgs[0].shape[2] == 3
+        v = self.rng.randn(len(imgs), 3) * self.std
+        return self._augment_batch(imgs, v), v
+
+    def _augment_batch(self, imgs, v):
+        if not isinstance(imgs, np.ndarray):
+            return super(Lighting, self)._augment_batch(imgs, v)
+        old_dtype = imgs.dtype
+        inc = np.dot(v * self.eigval, self.eigvec.T).astype('float32')    # N x 3
+        imgs = np.add(imgs, inc[:, np.newaxis, np.newaxis, :])
+        if old_dtype == np.uint8:
+            imgs = np.clip(imgs, 0, 255)
+        return imgs.astype(old_dtype)
+
 
 class MinMaxNormalize(ImageAugmentor):
     """
@@ -259,3 +357,16 @@ class MinMaxNormalize(ImageAugmentor):
             maximum = np.max(img, axis=(0, 1), keepdims=True)
         img = (self.max - self.min) * (img - minimum) / (maximum - minimum) + self.min
         return img
+
+    def _augment_batch_return_params(self, imgs):
+        prms = [None] * len(imgs)
+        return self._augment_batch(imgs, prms), prms
+
+    def _augment_batch(self, imgs, prms):
+        if not isinstance(imgs, np.ndarray):
+            return super(MinMaxNormalize, self)._augment_batch(imgs, prms)
+        imgs = imgs.astype('float32')
+        axis = tuple(range(1, imgs.ndim)) if self.all_channel else (1, 2)
+        minimum = np.min(imgs, axis=axis, keepdims=True)
+        maximum = np.max(imgs, axis=axis, keepdims=True)
+        return (self.max - self.min) * (imgs - minimum) / (maximum - minimum) + self.min
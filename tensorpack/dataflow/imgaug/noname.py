@@ -2,7 +2,8 @@
 # File: noname.py
 # Author: Yuxin Wu <ppwwyyxx@gmail.com>
 
-from .base import ImageAugmentor
+from .base import ImageAugmentor, TransformAugmentorBase
+from .transform import ResizeTransform, FlipTransform
 from ...utils import logger
 from ...utils.argtools import shape2d
 import numpy as np
@@ -11,7 +12,7 @@ import cv2
 __all__ = ['Flip', 'Resize', 'RandomResize', 'ResizeShortestEdge', 'Transpose']
 
 
-class Flip(ImageAugmentor):
+class Flip(TransformAugmentorBase):
     """
     Random flip the image either horizontally or vertically.
     """
@@ -25,32 +26,18 @@ class Flip(ImageAugmentor):
         super(Flip, self).__init__()
         if horiz and vert:
             raise ValueError("Cannot do both horiz and vert. Please use two Flip instead.")
-        elif horiz:
-            self.code = 1
-        elif vert:
-            self.code = 0
-        else:
+        elif not horiz and not vert:
             raise ValueError("Are you kidding?")
+        self.horiz = horiz
         self.prob = prob
         self._init()
 
     def _get_augment_params(self, img):
-        return self._rand_range() < self.prob
+        do = self._rand_range() < self.prob
+        return FlipTransform(img.shape[0], img.shape[1], self.horiz, do)
 
-    def _augment(self, img, do):
-        if do:
-            ret = cv2.flip(img, self.code)
-            if img.ndim == 3 and ret.ndim == 2:
-                ret = ret[:, :, np.newaxis]
-        else:
-            ret = img
-        return ret
-
-    def _fprop_coord(self, coord, param):
-        raise NotImplementedError()
 
-
-class Resize(ImageAugmentor):
+class Resize(TransformAugmentorBase):
     """ Resize image to a target size"""
 
     def __init__(self, shape, interp=cv2.INTER_LINEAR):
@@ -62,16 +49,12 @@ class Resize(ImageAugmentor):
         shape = tuple(shape2d(shape))
         self._init(locals())
 
-    def _augment(self, img, _):
-        ret = cv2.resize(
-            img, self.shape[::-1],
-            interpolation=self.interp)
-        if img.ndim == 3 and ret.ndim == 2:
-            ret = ret[:, :, np.newaxis]
-        return ret
+    def _get_augment_params(self, img):
+        return ResizeTransform(img.shape[0], img.shape[1],
+                               self.shape[0], self.shape[1], self.interp)
 
 
-class ResizeShortestEdge(ImageAugmentor):
+class ResizeShortestEdge(TransformAugmentorBase):
     """
     Resize the shortest edge to a certain number while
     keeping the aspect ratio.
@@ -85,17 +68,13 @@ class ResizeShortestEdge(ImageAugmentor):
         size = size * 1.0
         self._init(locals())
 
-    def _augment(self, img, _):
+    def _get_augment_params(self, img):
         h, w = img.shape[:2]
         scale = self.size / min(h, w)
-        desSize = map(int, [scale * w, scale * h])
-        ret = cv2.resize(img, tuple(desSize), interpolation=self.interp)
-        if img.ndim == 3 and ret.ndim == 2:
-            ret = ret[:, :, np.newaxis]
-        return ret
+        return ResizeTransform(h, w, int(scale * h), int(scale * w), self.interp)
 
 
-class RandomResize(ImageAugmentor):
+class RandomResize(TransformAugmentorBase):
     """ Randomly rescale w and h of the image"""
 
     def __init__(self, xrange, yrange, minimum=(0, 0), aspect_ratio_thres=0.15,
@@ -116,6 +95,7 @@ class RandomResize(ImageAugmentor):
         self._init(locals())
 
     def _get_augment_params(self, img):
+        h, w = img.shape[:2]
         cnt = 0
         while True:
             sx = self._rand_range(*self.xrange)
@@ -129,17 +109,11 @@ class RandomResize(ImageAugmentor):
             newr = destX * 1.0 / destY
             diff = abs(newr - oldr) / oldr
             if diff <= self.aspect_ratio_thres + 1e-5:
-                return (int(destX), int(destY))
+                return ResizeTransform(h, w, int(destY), int(destX), self.interp)
             cnt += 1
             if cnt > 50:
                 logger.warn("RandomResize failed to augment an image")
-                return img.shape[1], img.shape[0]
-
-    def _augment(self, img, dsize):
-        ret = cv2.resize(img, dsize, interpolation=self.interp)
-        if img.ndim == 3 and ret.ndim == 2:
-            ret = ret[:, :, np.newaxis]
-        return ret
+                return ResizeTransform(h, w, h, w, self.interp)
 
 
 class Transpose(ImageAugmentor):
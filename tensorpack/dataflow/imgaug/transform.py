@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+# File: transform.py
+
+"""
+Deterministic image transformations, produced by augmentors with their random parameters.
+Coordinates are Nx2 arrays of (x, y) in the continuous pixel coordinate system,
+where the image covers [0, w] x [0, h].
+"""
+
+import numpy as np
+import cv2
+
+__all__ = ['ImageTransform', 'AffineTransform', 'CropTransform',
+           'ResizeTransform', 'FlipTransform']
+
+
+def _translation(dx, dy):
+    return np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype='float64')
+
+
+def _merge(a, b):
+    """ Merge two requirements, where None means 'no requirement'. Raise ValueError if they conflict. """
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    raise ValueError()
+
+
+class ImageTransform(object):
+    """ Base class for a deterministic image transformation. """
+
+    def apply_image(self, img):
+        raise NotImplementedError()
+
+    def apply_coords(self, coords):
+        raise NotImplementedError()
+
+    def to_affine(self):
+        """
+        Returns:
+            AffineTransform: an equivalent affine transformation,
+                or None if this transformation is not affine.
+        """
+        return None
+
+    def is_identity(self):
+        return False
+
+
+class AffineTransform(ImageTransform):
+    """
+    An affine transformation, applied with a single ``cv2.warpAffine``.
+    """
+    def __init__(self, M, out_shape, interp=None, border=None, border_value=0):
+        """
+        Args:
+            M: a 2x3 or 3x3 matrix mapping the input coordinates to the output coordinates.
+            out_shape: (h, w) of the output, or None to keep the size of the input.
+            interp: cv2 interpolation method. None if the transformation only
+                maps pixels to pixels (e.g. flip, crop, integer shift).
+            border: cv2 border method. None if the transformation never
+                samples outside of the input.
+            border_value: cv2 border value for border=cv2.BORDER_CONSTANT
+        """
+        M = np.asarray(M, dtype='float64')
+        if M.shape == (2, 3):
+            M = np.vstack([M, [0, 0, 1]])
+        self.M = M
+        self.out_shape = None if out_shape is None else tuple(int(k) for k in out_shape)
+        self.interp = interp
+        self.border = border
+        self.border_value = border_value
+
+    @staticmethod
+    def from_warp_matrix(M, out_shape, **kwargs):
+        """
+        Create an AffineTransform from a 2x3 matrix used by ``cv2.warpAffine``,
+        which takes the coordinates of pixel centers.
+        """
+        M = np.vstack([np.asarray(M, dtype='float64'), [0, 0, 1]])
+        return AffineTransform(_translation(0.5, 0.5).dot(M).dot(_translation(-0.5, -0.5)),
+                               out_shape, **kwargs)
+
+    def get_warp_matrix(self):
+        """
+        Returns:
+            the 2x3 matrix for ``cv2.warpAffine``.
+        """
+        return _translation(-0.5, -0.5).dot(self.M).dot(_translation(0.5, 0.5))[:2]
+
+    def compose(self, other):
+        """
+        Args:
+            other (AffineTransform): the transformation to apply after this one.
+
+        Returns:
+            AffineTransform: equivalent to applying this one and then ``other``,
+                or None if the two use different interpolation or border method.
+        """
+        try:
+            interp = _merge(self.interp, other.interp)
+            border = _merge(None if self.border is None else (self.border, self.border_value),
+                            None if other.border is None else (other.border, other.border_value))
+        except ValueError:
+            return None
+        if border is None:
+            border = (None, 0)
+        out_shape = self.out_shape if other.out_shape is None else other.out_shape
+        return AffineTransform(other.M.dot(self.M), out_shape, interp, *border)
+
+    def apply_image(self, img):
+        h, w = img.shape[:2] if self.out_shape is None else self.out_shape
+        interp = cv2.INTER_LINEAR if self.interp is None else self.interp
+        border = cv2.BORDER_REPLICATE if self.border is None else self.border
+        ret = cv2.warpAffine(img, self.get_warp_matrix(), (w, h),
+                             flags=interp, borderMode=border, borderValue=self.border_value)
+        if img.ndim == 3 and ret.ndim == 2:
+            ret = ret[:, :, np.newaxis]
+        return ret
+
+    def apply_coords(self, coords):
+        coords = np.asarray(coords, dtype='float64')
+        return coords.dot(self.M[:2, :2].T) + self.M[:2, 2]
+
+    def to_affine(self):
+        return self
+
+
+class CropTransform(ImageTransform):
+    def __init__(self, h0, w0, h, w):
+        self.h0, self.w0, self.h, self.w = h0, w0, h, w
+
+    def apply_image(self, img):
+        return img[self.h0:self.h0 + self.h, self.w0:self.w0 + self.w]
+
+    def apply_coords(self, coords):
+        return np.asarray(coords, dtype='float64') - [self.w0, self.h0]
+
+    def to_affine(self):
+        return AffineTransform(_translation(-self.w0, -self.h0), (self.h, self.w))
+
+
+class ResizeTransform(ImageTransform):
+    def __init__(self, h, w, newh, neww, interp):
+        self.h, self.w, self.newh, self.neww = h, w, newh, neww
+        self.interp = interp
+
+    def apply_image(self, img):
+        ret = cv2.resize(img, (self.neww, self.newh), interpolation=self.interp)
+        if img.ndim == 3 and ret.ndim == 2:
+            ret = ret[:, :, np.newaxis]
+        return ret
+
+    def apply_coords(self, coords):
+        return np.asarray(coords, dtype='float64') * [self.neww * 1.0 / self.w, self.newh * 1.0 / self.h]
+
+    def to_affine(self):
+        if self.interp == cv2.INTER_AREA:   # not supported by warpAffine
+            return None
+        M = np.diag([self.neww * 1.0 / self.w, self.newh * 1.0 / self.h, 1.0])
+        return AffineTransform(M, (self.newh, self.neww), self.interp)
+
+
+class FlipTransform(ImageTransform):
+    def __init__(self, h, w, horiz=True, do=True):
+        """
+        Args:
+            h, w (int): shape of the image.
+            horiz (bool): flip horizontally or vertically.
+            do (bool): whether to flip at all.
+        """
+        self.h, self.w, self.horiz, self.do = h, w, horiz, do
+
+    def apply_image(self, img):
+        if not self.do:
+            return img
+        ret = cv2.flip(img, 1 if self.horiz else 0)
+        if img.ndim == 3 and ret.ndim == 2:
+            ret = ret[:, :, np.newaxis]
+        return ret
+
+    def apply_coords(self, coords):
+        coords = np.array(coords, dtype='float64')
+        if self.do:
+            if self.horiz:
+                coords[:, 0] = self.w - coords[:, 0]
+            else:
+                coords[:, 1] = self.h - coords[:, 1]
+        return coords
+
+    def to_affine(self):
+        if not self.do:
+            M = np.eye(3)
+        elif self.horiz:
+            M = [[-1, 0, self.w], [0, 1, 0], [0, 0, 1]]
+        else:
+            M = [[1, 0, 0], [0, -1, self.h], [0, 0, 1]]
+        return AffineTransform(M, (self.h, self.w))
+
+    def is_identity(self):
+        return not self.do
@@ -6,21 +6,44 @@ from __future__ import print_function
 import multiprocessing as mp
 import itertools
 from six.moves import range, zip, queue
+from collections import deque, OrderedDict
+import functools
+import weakref
+import tempfile
+import mmap
 import uuid
 import os
+import atexit
+import numpy as np
 import zmq
 
 from .base import ProxyDataFlow
 from .common import RepeatedData
 from ..utils.concurrency import (ensure_proc_terminate,
                                  mask_sigint, start_proc_mask_signal,
-                                 StoppableThread)
+                                 StoppableThread, OrderedContainer)
 from ..utils.serialize import loads, dumps
-from ..utils import logger
+from ..utils import logger, get_rng
+from ..utils.argtools import log_once
 from ..utils.gpu import change_gpu
 
 __all__ = ['PrefetchData', 'PrefetchDataZMQ', 'PrefetchOnGPUs',
-           'ThreadedMapData']
+           'ThreadedMapData', 'MultiProcessMapData']
+
+
+def _get_pipe_name(name):
+    pipedir = os.environ.get('TENSORPACK_PIPEDIR', '.')
+    assert os.path.isdir(pipedir), pipedir
+    return "ipc://{}/{}-".format(pipedir.rstrip('/'), name) + str(uuid.uuid1())[:6]
+
+
+def _unlink_pipes(pipenames):
+    """ Remove the files of ipc pipes, which zmq leaves behind when not closed properly. """
+    for name in pipenames:
+        try:
+            os.unlink(name[len('ipc://'):])
+        except OSError:
+            pass
 
 
 class PrefetchProcess(mp.Process):
@@ -84,11 +107,12 @@ class PrefetchData(ProxyDataFlow):
 
 
 class PrefetchProcessZMQ(mp.Process):
-    def __init__(self, ds, conn_name, hwm):
+    def __init__(self, ds, conn_name, hwm, serializer=None):
         super(PrefetchProcessZMQ, self).__init__()
         self.ds = ds
         self.conn_name = conn_name
         self.hwm = hwm
+        self.serializer = serializer
 
     def run(self):
         self.ds.reset_state()
@@ -98,7 +122,86 @@ class PrefetchProcessZMQ(mp.Process):
         self.socket.connect(self.conn_name)
         while True:
             for dp in self.ds.get_data():
-                self.socket.send(dumps(dp), copy=False)
+                self.socket.send(dumps(dp, self.serializer), copy=False)
+
+
+_SHM_ALIGN = 64
+_SHM_MIN_SLAB_SIZE = 1 << 20
+
+
+def _shm_layout(dp):
+    """
+    Plan how to put a datapoint into a shared memory slab.
+
+    Returns:
+        list: one entry per component. ``[True, offset, dtype, shape]`` for
+            an ndarray to be stored in the slab, ``[False, obj]`` for
+            anything else, which is sent inline.
+        int: the number of bytes needed in the slab.
+    """
+    meta = []
+    nbytes = 0
+    for c in dp:
+        if isinstance(c, np.ndarray) and not c.dtype.hasobject and c.dtype.names is None:
+            meta.append([True, nbytes, c.dtype.str, c.shape])
+            nbytes += (c.nbytes + _SHM_ALIGN - 1) // _SHM_ALIGN * _SHM_ALIGN
+        else:
+            meta.append([False, c])
+    return meta, nbytes
+
+
+def _open_slab(path, size, create=False):
+    with open(path, 'w+b' if create else 'r+b') as f:
+        if create:
+            f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+
+
+class PrefetchProcessZMQShm(PrefetchProcessZMQ):
+    """
+    Worker of :class:`PrefetchDataZMQ` with ``use_shm=True``.
+    It waits for a free slab from the master, copies the ndarray components
+    into it and only sends a small descriptor through the pipe.
+    """
+    def __init__(self, ds, conn_name, hwm, slab_conn_name, slab_prefix, cache_size, serializer=None):
+        super(PrefetchProcessZMQShm, self).__init__(ds, conn_name, hwm, serializer)
+        self.slab_conn_name = slab_conn_name
+        self.slab_prefix = slab_prefix
+        self.cache_size = cache_size
+
+    def _get_slab(self, slab_id, size):
+        slab = self._slabs.pop(slab_id, None)
+        if slab is None:
+            slab = _open_slab(self.slab_prefix + str(slab_id), size)
+            if len(self._slabs) >= self.cache_size:
+                # slabs retired by the master are never sent again
+                self._slabs.popitem(last=False)
+        self._slabs[slab_id] = slab     # keep the most recently used at the end
+        return slab
+
+    def run(self):
+        self.ds.reset_state()
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUSH)
+        self.socket.set_hwm(self.hwm)
+        self.socket.connect(self.conn_name)
+        self.slab_socket = self.context.socket(zmq.PULL)
+        self.slab_socket.connect(self.slab_conn_name)
+        self._slabs = OrderedDict()
+        while True:
+            for dp in self.ds.get_data():
+                slab_id, slab_size = loads(self.slab_socket.recv(copy=False).bytes)
+                meta, nbytes = _shm_layout(dp)
+                if nbytes > slab_size:
+                    # the master will give back a larger slab next time
+                    payload = dumps(dp, self.serializer)
+                    self.socket.send(dumps([slab_id, nbytes, False, payload], 'msgpack'), copy=False)
+                    continue
+                slab = self._get_slab(slab_id, slab_size)
+                for c, m in zip(dp, meta):
+                    if m[0]:
+                        np.copyto(np.ndarray(c.shape, dtype=c.dtype, buffer=slab, offset=m[1]), c)
+                self.socket.send(dumps([slab_id, nbytes, True, meta], 'msgpack'), copy=False)
 
 
 class PrefetchDataZMQ(ProxyDataFlow):
@@ -109,15 +212,30 @@ class PrefetchDataZMQ(ProxyDataFlow):
     A local directory is needed to put the ZMQ pipes.
     You can set this with env var $TENSORPACK_PIPEDIR if you're running on non-local FS such as NFS or GlusterFS.
 
+    With ``use_shm=True``, ndarray components are not serialized. Workers
+    write them into a pool of POSIX shared memory slabs (files under
+    ``/dev/shm``, or $TENSORPACK_SHMDIR), and the master produces
+    ndarrays which are views into these slabs. A slab goes back to the
+    pool once all arrays viewing it are garbage-collected, so downstream
+    DataFlow that copies the data (e.g. :class:`BatchData`) keeps the pool
+    small. If downstream holds on to all the slabs, more will be allocated.
+    The produced arrays are read-only.
+
     Note that this dataflow is not fork-safe. You cannot nest this dataflow
     into another PrefetchDataZMQ or PrefetchData.
     """
-    def __init__(self, ds, nr_proc=1, hwm=50):
+    def __init__(self, ds, nr_proc=1, hwm=50, use_shm=False, shm_pool_size=None, serializer=None):
         """
         Args:
             ds (DataFlow): input DataFlow.
             nr_proc (int): number of processes to use.
             hwm (int): the zmq "high-water mark" for both sender and receiver.
+            use_shm (bool): pass ndarrays through shared memory instead of
+                serializing them. Only available on a single host.
+            shm_pool_size (int): initial number of shared memory slabs.
+                Defaults to ``hwm + nr_proc``.
+            serializer (str): serialization backend used by the workers.
+                See :func:`tensorpack.utils.serialize.dumps`.
         """
         assert os.name != 'nt', "PrefetchDataZMQ doesn't support windows!  Consider PrefetchData instead."
         super(PrefetchDataZMQ, self).__init__(ds)
@@ -126,32 +244,136 @@ class PrefetchDataZMQ(ProxyDataFlow):
         except NotImplementedError:
             self._size = -1
         self.nr_proc = nr_proc
+        self.use_shm = use_shm
+        self.hwm = hwm
 
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.PULL)
 
-        pipedir = os.environ.get('TENSORPACK_PIPEDIR', '.')
-        assert os.path.isdir(pipedir), pipedir
-        self.pipename = "ipc://{}/dataflow-pipe-".format(pipedir.rstrip('/')) + str(uuid.uuid1())[:6]
+        self.pipename = _get_pipe_name('dataflow-pipe')
         self.socket.set_hwm(hwm)
         self.socket.bind(self.pipename)
 
-        self.procs = [PrefetchProcessZMQ(self.ds, self.pipename, hwm)
-                      for _ in range(self.nr_proc)]
+        if use_shm:
+            if shm_pool_size is None:
+                shm_pool_size = hwm + nr_proc
+            self._setup_shm(shm_pool_size)
+            self.procs = [PrefetchProcessZMQShm(self.ds, self.pipename, hwm,
+                                                self.slab_pipename, self._slab_prefix,
+                                                shm_pool_size + 8, serializer)
+                          for _ in range(self.nr_proc)]
+        else:
+            self.procs = [PrefetchProcessZMQ(self.ds, self.pipename, hwm, serializer)
+                          for _ in range(self.nr_proc)]
         self.start_processes()
         # __del__ not guranteed to get called at exit
-        import atexit
         atexit.register(lambda x: x.__del__(), self)
 
+    def _setup_shm(self, pool_size):
+        shmdir = os.environ.get('TENSORPACK_SHMDIR',
+                                '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+        assert os.path.isdir(shmdir), shmdir
+        self._slab_prefix = os.path.join(shmdir, 'tensorpack-shm-{}-'.format(self.pipename[-6:]))
+        self._slab_size = _SHM_MIN_SLAB_SIZE
+        self._slabs = {}            # slab id -> (mmap, size)
+        self._leases = {}           # slab id -> weakref to the array viewing it
+        self._free_slabs = deque()
+        self._released_slabs = deque()  # appended by weakref callbacks, possibly in other threads
+        self._nr_slab_at_worker = 0
+        self._next_slab_id = 0
+
+        self.slab_pipename = self.pipename + '-shm'
+        self.slab_socket = self.context.socket(zmq.PUSH)
+        self.slab_socket.bind(self.slab_pipename)
+        for _ in range(pool_size):
+            self._new_slab()
+
+    def _new_slab(self):
+        slab_id = self._next_slab_id
+        self._next_slab_id += 1
+        self._slabs[slab_id] = (_open_slab(self._slab_prefix + str(slab_id), self._slab_size, create=True),
+                                self._slab_size)
+        self._free_slabs.append(slab_id)
+
+    def _return_slab(self, slab_id):
+        self._leases.pop(slab_id, None)
+        if self._slabs[slab_id][1] >= self._slab_size:
+            self._free_slabs.append(slab_id)
+            return
+        # too small for recent datapoints. Replace it with a larger one
+        del self._slabs[slab_id]
+        os.unlink(self._slab_prefix + str(slab_id))
+        self._new_slab()
+
+    def _send_free_slabs(self):
+        while self._released_slabs:
+            self._return_slab(self._released_slabs.popleft())
+        while self._free_slabs:
+            slab_id = self._free_slabs[0]
+            try:
+                self.slab_socket.send(dumps([slab_id, self._slabs[slab_id][1]], 'msgpack'), zmq.NOBLOCK)
+            except zmq.Again:   # workers are not connected yet
+                return
+            self._free_slabs.popleft()
+            self._nr_slab_at_worker += 1
+
+    def _recv_shm(self):
+        while True:
+            self._send_free_slabs()
+            if self.socket.poll(100):
+                break
+            if not self._free_slabs and self._nr_slab_at_worker == 0:
+                log_once("All shared memory slabs are held by downstream DataFlow! "
+                         "Allocating more ...", 'warn')
+                self._new_slab()
+        slab_id, nbytes, in_shm, payload = loads(self.socket.recv(copy=False).bytes)
+        self._nr_slab_at_worker -= 1
+        if nbytes > self._slab_size:
+            self._slab_size = (int(nbytes * 1.25) // mmap.PAGESIZE + 1) * mmap.PAGESIZE
+        if not in_shm:
+            self._return_slab(slab_id)
+            return loads(payload)
+
+        root = np.frombuffer(self._slabs[slab_id][0], dtype=np.uint8, count=nbytes)
+        root.flags.writeable = False
+        dp = []
+        for m in payload:
+            if m[0]:
+                _, offset, dtype, shape = m
+                dtype = np.dtype(dtype)
+                size = dtype.itemsize * int(np.prod(shape))
+                # views of views still keep ``root`` as their base
+                dp.append(root[offset:offset + size].view(dtype).reshape(shape))
+            else:
+                dp.append(m[1])
+        self._leases[slab_id] = weakref.ref(
+            root, functools.partial(lambda q, slab_id, _: q.append(slab_id), self._released_slabs, slab_id))
+        return dp
+
     def start_processes(self):
         start_proc_mask_signal(self.procs)
 
+    def set_hwm(self, hwm):
+        """
+        Change the high-water mark of the receiving socket, i.e. the number of
+        datapoints buffered on the receiving side. The workers keep their own
+        buffers of the size given in the constructor.
+        Changing it on a running socket requires libzmq>=4.2.
+        """
+        hwm = int(hwm)
+        assert hwm > 0, hwm
+        self.socket.set_hwm(hwm)
+        self.hwm = hwm
+
     def get_data(self):
         try:
             for k in itertools.count():
                 if self._size > 0 and k >= self._size:
                     break
-                dp = loads(self.socket.recv(copy=False).bytes)
+                if self.use_shm:
+                    dp = self._recv_shm()
+                else:
+                    dp = loads(self.socket.recv(copy=False).bytes)
                 yield dp
         except zmq.ContextTerminated:
             logger.info("ContextTerminated in Master Prefetch Process")
@@ -169,6 +391,14 @@ class PrefetchDataZMQ(ProxyDataFlow):
             self.context.destroy(0)
         for x in self.procs:
             x.terminate()
+        _unlink_pipes([self.pipename] + ([self.slab_pipename] if self.use_shm else []))
+        if self.use_shm:
+            for slab_id in list(self._slabs.keys()):
+                try:
+                    os.unlink(self._slab_prefix + str(slab_id))
+                except OSError:
+                    pass
+            self._slabs.clear()
         try:
             # TODO test if logger here would overwrite log file
             print("Prefetch process exited.")
@@ -222,9 +452,14 @@ class ThreadedMapData(ProxyDataFlow):
         def run(self):
             while not self.stopped():
                 dp = self.queue_get_stoppable(self.inq)
+                if self.stopped():
+                    if dp is not None:
+                        self.inq.put(dp)    # leave it to other threads
+                    return
                 dp = self.func(dp)
                 if dp is not None:
-                    self.queue_put_stoppable(self.outq, dp)
+                    # outq is unbounded, so that no result is lost on stop
+                    self.outq.put(dp)
 
     def __init__(self, ds, nr_thread, map_func, buffer_size=200):
         """
@@ -248,16 +483,35 @@ class ThreadedMapData(ProxyDataFlow):
             t.join()
         self._in_queue = queue.Queue()
         self._out_queue = queue.Queue()
-        self._threads = [ThreadedMapData._WorkerThread(
-            self._in_queue, self._out_queue, self.map_func)
-            for _ in range(self.nr_thread)]
-        for t in self._threads:
-            t.start()
+        self._threads = []
+        self._start_threads(self.nr_thread)
 
         # fill the buffer
         self._itr = self.infinite_ds.get_data()
         self._fill_buffer()
 
+    def _start_threads(self, n):
+        for _ in range(n):
+            t = ThreadedMapData._WorkerThread(
+                self._in_queue, self._out_queue, self.map_func)
+            t.start()
+            self._threads.append(t)
+
+    def set_nr_thread(self, nr_thread):
+        """
+        Change the number of threads. Can be called while the DataFlow is running.
+        """
+        nr_thread = int(nr_thread)
+        assert nr_thread > 0, nr_thread
+        if self._threads:
+            if nr_thread > len(self._threads):
+                self._start_threads(nr_thread - len(self._threads))
+            else:
+                for t in self._threads[nr_thread:]:
+                    t.stop()
+                self._threads = self._threads[:nr_thread]
+        self.nr_thread = nr_thread
+
     def _fill_buffer(self):
         n = self.buffer_size - self._in_queue.qsize() - self._out_queue.qsize()
         if n <= 0:
@@ -271,3 +525,122 @@ class ThreadedMapData(ProxyDataFlow):
         for _ in range(sz):
             self._in_queue.put(next(self._itr))
             yield self._out_queue.get()
+
+
+class MultiProcessMapData(ProxyDataFlow):
+    """
+    Same as :class:`MapData`, but start processes to run the mapping function.
+    Unlike :class:`PrefetchDataZMQ`, the input DataFlow is kept in the
+    current process and only the mapping function is parallelized, which is
+    useful when ``ds`` has to be read from a single process, e.g. a
+    sequential LMDB reader.
+
+    Datapoints and results are sent through ZMQ pipes, so they need to be serializable.
+    The processes are forked when calling `reset_state()`. The global
+    ``np.random`` RNG is reseeded in each process, but other RNG states
+    (e.g. of augmentors created outside ``map_func``) are copied by the fork.
+    """
+    class _Worker(mp.Process):
+        def __init__(self, idx, map_func, pipename_in, pipename_out, hwm):
+            super(MultiProcessMapData._Worker, self).__init__()
+            self.daemon = True
+            self.idx = idx
+            self.map_func = map_func
+            self.pipename_in = pipename_in
+            self.pipename_out = pipename_out
+            self.hwm = hwm
+
+        def run(self):
+            np.random.seed((get_rng(self).randint(4294967295) + self.idx) % 4294967295)
+            ctx = zmq.Context()
+            in_socket = ctx.socket(zmq.PULL)
+            in_socket.set_hwm(self.hwm)
+            in_socket.connect(self.pipename_in)
+            out_socket = ctx.socket(zmq.PUSH)
+            out_socket.set_hwm(self.hwm)
+            out_socket.connect(self.pipename_out)
+            while True:
+                idx, dp = loads(in_socket.recv(copy=False).bytes)
+                out_socket.send(dumps([idx, self.map_func(dp)], 'msgpack'), copy=False)
+
+    def __init__(self, ds, nr_proc, map_func, buffer_size=200, ordered=False):
+        """
+        Args:
+            ds (DataFlow): the dataflow to map
+            nr_proc (int): number of processes to use
+            map_func (callable): datapoint -> datapoint | None
+            buffer_size (int): number of datapoints in the buffer
+            ordered (bool): produce results in the same order as ``ds``.
+                Otherwise, results are produced as soon as they are ready.
+        """
+        super(MultiProcessMapData, self).__init__(ds)
+        self.infinite_ds = RepeatedData(ds, -1)
+        self.nr_proc = nr_proc
+        self.map_func = map_func
+        self.buffer_size = buffer_size
+        self.ordered = ordered
+        self._procs = []
+        self._pipenames = []
+        self.context = None
+
+    def reset_state(self):
+        super(MultiProcessMapData, self).reset_state()
+        self._close()
+        self.context = zmq.Context()
+        self.send_socket = self.context.socket(zmq.PUSH)
+        self.send_socket.set_hwm(self.buffer_size * 2)
+        pipename_in = _get_pipe_name('dataflow-map')
+        self.send_socket.bind(pipename_in)
+        self.recv_socket = self.context.socket(zmq.PULL)
+        self.recv_socket.set_hwm(self.buffer_size * 2)
+        pipename_out = _get_pipe_name('dataflow-map-result')
+        self.recv_socket.bind(pipename_out)
+        self._pipenames = [pipename_in, pipename_out]
+        # __del__ is not guaranteed to get called at exit
+        atexit.register(_unlink_pipes, self._pipenames)
+
+        self._procs = [MultiProcessMapData._Worker(
+            k, self.map_func, pipename_in, pipename_out, self.buffer_size)
+            for k in range(self.nr_proc)]
+        ensure_proc_terminate(self._procs)
+        start_proc_mask_signal(self._procs)
+
+        self._itr = self.infinite_ds.get_data()
+        self._nr_sent = 0
+        self._ordered_container = OrderedContainer()
+        for _ in range(self.buffer_size):
+            self._send()
+
+    def _send(self):
+        self.send_socket.send(dumps([self._nr_sent, next(self._itr)], 'msgpack'), copy=False)
+        self._nr_sent += 1
+
+    def _recv(self):
+        if not self.ordered:
+            return loads(self.recv_socket.recv(copy=False).bytes)[1]
+        while not self._ordered_container.has_next():
+            idx, dp = loads(self.recv_socket.recv(copy=False).bytes)
+            self._ordered_container.put(idx, dp)
+        return self._ordered_container.get()[1]
+
+    def get_data(self):
+        for _ in range(self.size()):
+            self._send()
+            dp = self._recv()
+            if dp is not None:
+                yield dp
+
+    def _close(self):
+        if self.context is not None and not self.context.closed:
+            # close the sockets explicitly: at interpreter exit, destroy()
+            # may no longer find them and would block forever in term()
+            self.send_socket.close(0)
+            self.recv_socket.close(0)
+            self.context.destroy(0)
+        for p in self._procs:
+            p.terminate()
+            p.join()
+        _unlink_pipes(self._pipenames)
+
+    def __del__(self):
+        self._close()
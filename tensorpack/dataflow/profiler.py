@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# File: profiler.py
+
+import json
+import timeit
+from tabulate import tabulate
+
+from .base import DataFlow
+from .prefetch import PrefetchData, PrefetchDataZMQ, ThreadedMapData, MultiProcessMapData
+from ..utils import logger
+
+__all__ = ['DataFlowProfiler']
+
+
+class _StageStats(object):
+    def __init__(self, df, depth):
+        self.df = df
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.time = 0.0
+        self.nr_ready = 0
+        self.queue_size = 0
+
+
+def _get_queue_probe(df):
+    """
+    Returns a function which tells how many datapoints are ready in the
+    buffer of a prefetching DataFlow, or None if ``df`` doesn't prefetch.
+    """
+    if isinstance(df, PrefetchDataZMQ):
+        return lambda: df.socket.poll(0)
+    if isinstance(df, MultiProcessMapData):
+        return lambda: df.recv_socket.poll(0)
+    if isinstance(df, PrefetchData):
+        return lambda: df.queue.qsize()
+    if isinstance(df, ThreadedMapData):
+        return lambda: df._out_queue.qsize()
+    return None
+
+
+class DataFlowProfiler(object):
+    """
+    Measure the time spent in each stage of a DataFlow chain.
+
+    It follows the ``.ds`` links from the given DataFlow, and wraps
+    ``get_data`` of each stage to measure the time spent producing each
+    datapoint. The time of a stage excludes the time of the stage it reads from.
+    The overhead is two timer calls per datapoint per stage.
+
+    Stages which prefetch in other processes (:class:`PrefetchData`,
+    :class:`PrefetchDataZMQ`) are measured from the consumer side only,
+    i.e. the time spent waiting for their workers, and the stages behind
+    them are not profiled. For prefetching stages, it also records how often
+    a datapoint was already available when requested ("ready"), and the
+    average number of buffered datapoints when the buffer is a Python queue.
+
+    Example:
+        .. code-block:: python
+
+            ds = BatchData(AugmentImageComponent(LMDBDataPoint(...), augs), 64)
+            prof = DataFlowProfiler(ds)
+            TestDataSpeed(ds, 2000).start()
+            prof.print_report()
+            prof.dump_json('dataflow-profile.json')
+    """
+
+    def __init__(self, ds):
+        """
+        Args:
+            ds (DataFlow): the last DataFlow of the chain.
+        """
+        assert isinstance(ds, DataFlow), type(ds)
+        self._stages = []
+        df, depth = ds, 0
+        while isinstance(df, DataFlow):
+            self._stages.append(_StageStats(df, depth))
+            if isinstance(df, (PrefetchData, PrefetchDataZMQ)):
+                break
+            df, depth = getattr(df, 'ds', None), depth + 1
+        for s in self._stages:
+            self._install(s)
+        self.reset()
+
+    def _install(self, stage):
+        df = stage.df
+        orig_get_data = df.get_data
+        probe = _get_queue_probe(df)
+        timer = timeit.default_timer
+
+        def get_data():
+            itr = orig_get_data()
+            while True:
+                if probe is not None:
+                    n = probe()
+                    stage.queue_size += n
+                    stage.nr_ready += n > 0
+                start = timer()
+                try:
+                    dp = next(itr)
+                except StopIteration:
+                    stage.time += timer() - start
+                    return
+                stage.time += timer() - start
+                stage.count += 1
+                yield dp
+        # shadow the method of this instance
+        df.get_data = get_data
+
+    def remove(self):
+        """ Remove the instrumentation from the DataFlows. """
+        for s in self._stages:
+            if 'get_data' in s.df.__dict__:
+                del s.df.get_data
+
+    def reset(self):
+        """ Clear the statistics. """
+        for s in self._stages:
+            s.reset()
+        self._start_time = timeit.default_timer()
+
+    def get_stats(self):
+        """
+        Returns:
+            list[dict]: statistics of each stage, from the last stage to the first.
+            The time of a stage is in seconds and excludes the time of its input stage.
+        """
+        elapsed = timeit.default_timer() - self._start_time
+        ret = []
+        for idx, s in enumerate(self._stages):
+            child_time = self._stages[idx + 1].time if idx + 1 < len(self._stages) else 0
+            self_time = max(s.time - child_time, 0)
+            stat = {
+                'name': type(s.df).__name__,
+                'depth': s.depth,
+                'count': s.count,
+                'total_time': s.time,
+                'self_time': self_time,
+                'items_per_sec': s.count / elapsed if elapsed > 0 else 0.,
+                'latency_ms': self_time * 1e3 / s.count if s.count else 0.,
+            }
+            if _get_queue_probe(s.df) is not None:
+                stat['ready_ratio'] = s.nr_ready * 1.0 / s.count if s.count else 0.
+                if not isinstance(s.df, (PrefetchDataZMQ, MultiProcessMapData)):
+                    stat['queue_size'] = s.queue_size * 1.0 / s.count if s.count else 0.
+            ret.append(stat)
+        return ret
+
+    def get_report(self):
+        """
+        Returns:
+            str: a table of the statistics.
+        """
+        stats = self.get_stats()
+        total = stats[0]['total_time'] if stats else 0
+        data = []
+        for s in stats:
+            data.append([
+                '  ' * s['depth'] + s['name'], s['count'],
+                '{:.1f}'.format(s['items_per_sec']),
+                '{:.3f}'.format(s['latency_ms']),
+                '{:.1f}'.format(s['self_time'] * 100.0 / total) if total > 0 else '-',
+                '{:.1f}'.format(s['ready_ratio'] * 100) if 'ready_ratio' in s else '',
+                '{:.1f}'.format(s['queue_size']) if 'queue_size' in s else ''])
+        return tabulate(data, headers=['stage', 'items', 'items/s', 'ms/item', 'time %', 'ready %', 'queue'])
+
+    def print_report(self):
+        logger.info("DataFlow profile:\n" + self.get_report())
+
+    def dump_json(self, fname):
+        """
+        Write the statistics to a JSON file.
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.get_stats(), f, indent=2)
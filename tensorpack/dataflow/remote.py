@@ -3,7 +3,11 @@
 # File: remote.py
 # Author: Yuxin Wu <ppwwyyxxc@gmail.com>
 
+import binascii
 import time
+import threading
+import zlib
+import six
 from collections import deque
 from .base import DataFlow
 from ..utils import logger, get_tqdm
@@ -17,102 +21,473 @@ else:
     __all__ = ['send_dataflow_zmq', 'RemoteDataZMQ']
 
 
-def send_dataflow_zmq(df, addr, hwm=50, print_interval=100, format=None):
+def _get_codec(name):
+    """
+    Returns:
+        (name, compress_fn, decompress_fn) of a compression codec.
+        "auto" picks the first available one among lz4, zstd and zlib.
+    """
+    if name == 'auto':
+        for name in ['lz4', 'zstd']:
+            try:
+                return _get_codec(name)
+            except ImportError:
+                pass
+        name = 'zlib'
+    if name == 'lz4':
+        import lz4.block
+        return name, lz4.block.compress, lz4.block.decompress
+    if name == 'zstd':
+        import zstandard
+        return name, zstandard.ZstdCompressor(level=1).compress, zstandard.ZstdDecompressor().decompress
+    if name == 'zlib':
+        return name, lambda buf: zlib.compress(buf, 1), zlib.decompress
+    raise ValueError("Unknown compression codec: {}".format(name))
+
+
+# Datapoints serialized into one message are padded to this alignment
+_MSG_ALIGN = 64
+
+
+def _encode_message(bufs, codec=None):
+    """
+    Pack serialized datapoints into a two-part message: a header of
+    [codec, sizes], and the (optionally compressed) concatenation of them.
+    """
+    parts = []
+    for buf in bufs:
+        parts.append(buf)
+        parts.append(b'\x00' * (-len(buf) % _MSG_ALIGN))
+    payload = b''.join(parts)
+    if codec is not None:
+        payload = codec[1](payload)
+    return [dumps([None if codec is None else codec[0], [len(b) for b in bufs]], 'msgpack'), payload]
+
+
+def _decode_message(frames, decompressors):
+    """
+    Decode a message produced by :func:`send_dataflow_zmq`.
+
+    Returns:
+        list of datapoints.
+    """
+    if len(frames) == 1:
+        return [loads(frames[0].buffer)]
+    codec, sizes = loads(frames[0].buffer)
+    buf = frames[1].buffer
+    if codec is not None:
+        if isinstance(codec, bytes):
+            codec = codec.decode('ascii')
+        if codec not in decompressors:
+            decompressors[codec] = _get_codec(codec)[2]
+        buf = memoryview(decompressors[codec](buf))
+    ret = []
+    offset = 0
+    for size in sizes:
+        ret.append(loads(buf[offset:offset + size]))
+        offset += size + (-size % _MSG_ALIGN)
+    return ret
+
+
+def _bind_or_connect(socket, addr, bind):
+    """
+    Bind or connect a socket to an address prefixed by ``@`` (bind) or ``>`` (connect).
+    Without a prefix, bind if ``bind`` is True, otherwise connect.
+    """
+    if addr.startswith('@'):
+        socket.bind(addr[1:])
+    elif addr.startswith('>'):
+        socket.connect(addr[1:])
+    elif bind:
+        socket.bind(addr)
+    else:
+        socket.connect(addr)
+
+
+# message types of the credit-based protocol
+_MSG_HELLO = b'hello'
+_MSG_DATA = b'data'
+_MSG_CREDIT = b'credit'
+# a producer without credits says hello again after this many seconds
+_HELLO_INTERVAL = 1.0
+
+
+class _CreditSender(object):
+    """
+    Send messages through DEALER sockets connected to one or more consumers.
+    A consumer grants credits to each producer, and a producer only sends
+    a message to a consumer after it has received a credit from it.
+    """
+    def __init__(self, ctx, addrs, hwm):
+        self.sockets = []
+        self.poller = zmq.Poller()
+        for addr in addrs:
+            socket = ctx.socket(zmq.DEALER)
+            socket.set_hwm(hwm)
+            _bind_or_connect(socket, addr, False)
+            self.poller.register(socket, zmq.POLLIN)
+            self.sockets.append(socket)
+        self.credits = dict((s, 0) for s in self.sockets)
+        self._hello()
+
+    def _hello(self):
+        for s in self.sockets:
+            if self.credits[s] == 0:
+                try:
+                    s.send(_MSG_HELLO, zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+
+    def _recv_credits(self, timeout):
+        evts = self.poller.poll(timeout)
+        for s, _ in evts:
+            while True:
+                try:
+                    frames = s.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if frames[0] == _MSG_CREDIT:
+                    self.credits[s] += int(frames[1])
+        return len(evts)
+
+    def send_multipart(self, frames, copy=True):
+        self._recv_credits(0)
+        while True:
+            # send to the consumer with the most credits
+            socket = max(self.sockets, key=lambda s: self.credits[s])
+            if self.credits[socket] > 0:
+                break
+            if not self._recv_credits(int(_HELLO_INTERVAL * 1000)):
+                # a restarted consumer doesn't know us, or our credits were lost
+                self._hello()
+        socket.send_multipart([_MSG_DATA] + frames, copy=copy)
+        self.credits[socket] -= 1
+
+    def close(self):
+        for s in self.sockets:
+            s.setsockopt(zmq.LINGER, 0)
+            s.close()
+
+
+def send_dataflow_zmq(df, addr, hwm=50, print_interval=100, format=None, serializer=None,
+                      batch_size=1, compress=None, threaded=False, credit=False):
     """
     Run DataFlow and send data to a ZMQ socket addr.
     It will dump and send each datapoint to this addr with a PUSH socket.
 
     Args:
         df (DataFlow): Will infinitely loop over the DataFlow.
-        addr: a ZMQ socket addr.
+        addr: a ZMQ socket addr to connect to. Prefix it with ``@`` to bind
+            to it instead, e.g. ``@tcp://*:8877``, for a :class:`RemoteDataZMQ`
+            which connects to producers with ``>tcp://host:8877``.
+            With ``credit=True``, it can be a list of addrs of several consumers.
         hwm (int): high water mark
+        serializer (str): serialization backend.
+            See :func:`tensorpack.utils.serialize.dumps`.
+        batch_size (int): send this many datapoints in each message, which
+            saves per-message overhead for small datapoints.
+        compress (str): compress the messages with "lz4", "zstd", "zlib", or
+            "auto" (the first one installed among them). None to disable compression.
+        threaded (bool): produce and serialize datapoints in a separate thread,
+            so that it overlaps with sending.
+        credit (bool): use credit-based flow control over DEALER sockets,
+            for a :class:`RemoteDataZMQ` created with ``credits``.
+            Each message is sent to a consumer which has granted credits for it,
+            so that faster consumers get more data.
+
+    :class:`RemoteDataZMQ` unpacks batched and compressed messages transparently.
+    With the default ``batch_size=1`` and no compression, each message
+    is a single serialized datapoint as before.
     """
     # format (str): The serialization format. ZMQ Op is still not publicly usable now
     #     Default format would use :mod:`tensorpack.utils.serialize`.
-    dump_fn = dumps if format is None else dumps_for_tfop
+    if format is None:
+        def dump_fn(dp):
+            return dumps(dp, serializer)
+    else:
+        assert batch_size == 1 and compress is None, \
+            "Batching and compression are not supported with format={}".format(format)
+        dump_fn = dumps_for_tfop
+    codec = None if compress is None else _get_codec(compress)
+
+    def get_messages():
+        # yield (number of datapoints, list of frames)
+        bufs = []
+        while True:
+            for dp in df.get_data():
+                bufs.append(dump_fn(dp))
+                if len(bufs) == batch_size:
+                    if batch_size == 1 and codec is None:
+                        yield 1, bufs
+                    else:
+                        yield len(bufs), _encode_message(bufs, codec)
+                    bufs = []
+
+    def get_messages_threaded():
+        queue = six.moves.queue.Queue(maxsize=hwm)
+
+        def produce():
+            # errors are raised in the main loop
+            try:
+                for msg in get_messages():
+                    queue.put(msg)
+            except Exception as e:
+                queue.put(e)
+        th = threading.Thread(target=produce)
+        th.daemon = True
+        th.start()
+        while True:
+            msg = queue.get()
+            if isinstance(msg, Exception):
+                raise msg
+            yield msg
+
     ctx = zmq.Context()
-    socket = ctx.socket(zmq.PUSH)
-    socket.set_hwm(hwm)
-    socket.connect(addr)
+    if credit:
+        socket = _CreditSender(ctx, [addr] if isinstance(addr, six.string_types) else addr, hwm)
+    else:
+        socket = ctx.socket(zmq.PUSH)
+        socket.set_hwm(hwm)
+        _bind_or_connect(socket, addr, False)
     try:
         df.reset_state()
         logger.info("Serving data to {} ...".format(addr))
+        messages = get_messages_threaded() if threaded else get_messages()
+
         q = deque(maxlen=print_interval)
         with get_tqdm(total=0) as pbar:
-            while True:
-                for dp in df.get_data():
-                    start = time.time()
-                    socket.send(dump_fn(dp), copy=False)
-                    q.append(time.time() - start)
-                    pbar.update(1)
-                    if pbar.n % print_interval == 0:
-                        pbar.write("Avg send time @{}: {}".format(pbar.n, sum(q) / len(q)))
+            for cnt, (nr_dp, frames) in enumerate(messages):
+                start = time.time()
+                socket.send_multipart(frames, copy=False)
+                q.append(time.time() - start)
+                pbar.update(nr_dp)
+                if (cnt + 1) % print_interval == 0:
+                    pbar.write("Avg send time @{}: {}".format(pbar.n, sum(q) / len(q)))
     finally:
-        socket.setsockopt(zmq.LINGER, 0)
-        socket.close()
+        if credit:
+            socket.close()
+        else:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()
         if not ctx.closed:
             ctx.destroy(0)
 
 
+class _SourceStats(object):
+    # a gap longer than this between two messages counts as a stall
+    STALL_THRESHOLD = 1.0
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.count = 0
+        self.nbytes = 0
+        self.max_gap = 0.
+        self.stall_time = 0.
+        self.last_time = None
+        self.inflight = 0   # credits granted but not used yet
+        self.hello_time = None
+
+    def update(self, count, nbytes, now):
+        self.count += count
+        self.nbytes += nbytes
+        if self.last_time is not None:
+            gap = now - self.last_time
+            self.max_gap = max(self.max_gap, gap)
+            if gap > self.STALL_THRESHOLD:
+                self.stall_time += gap
+        self.last_time = now
+
+
 class RemoteDataZMQ(DataFlow):
     """
     Produce data from ZMQ PULL socket(s).
 
+    Each address is a ZMQ endpoint to bind to, e.g. ``tcp://*:8877``.
+    The prefix ``@`` (e.g. ``@tcp://*:8877``) also means to bind.
+    Prefix it with ``>`` to connect to it instead, e.g. ``>tcp://host1:8877``,
+    so that one consumer can pull from several data-serving hosts, each
+    running ``send_dataflow_zmq(df, '@tcp://*:8877')``.
+    Datapoints are decoded directly from the received ZMQ frames without
+    copying them to bytes first. Messages batched or compressed by
+    :func:`send_dataflow_zmq` are unpacked transparently.
+
+    With ``credits``, it uses ROUTER sockets and a credit-based protocol
+    with producers started by ``send_dataflow_zmq(..., credit=True)``:
+    each producer may only have this many messages in flight, and a credit
+    is returned only after the datapoints in a message have been consumed.
+    This bounds the memory used by the consumer, and lets several consumers
+    share a pool of producers according to how fast they consume.
+
+    :meth:`get_stats` reports statistics per address. Without ``credits``,
+    messages carry no identity of their producer, so several producers
+    pushing to one bound address cannot be told apart. Use ``credits`` (or
+    one address per producer) to find a slow producer: with ``credits``,
+    :meth:`get_producer_stats` reports statistics per producer.
+
     Attributes:
         cnt1, cnt2 (int): number of data points received from addr1 and addr2
+        wait_time (float): total time in seconds spent waiting for data.
     """
-    def __init__(self, addr1, addr2=None):
+    def __init__(self, addr1, addr2=None, hwm=50, rcvbuf=None, credits=None):
         """
         Args:
-            addr1,addr2 (str): addr of the socket to connect to.
-                Use both if you need two protocols (e.g. both IPC and TCP).
-                I don't think you'll ever need 3.
+            addr1 (str or list[str]): one or a list of addresses.
+            addr2 (str): another address. Same as passing ``[addr1, addr2]``.
+            hwm (int): high water mark of each socket.
+            rcvbuf (int): size of the kernel receive buffer of each socket in bytes,
+                or None to use the OS default.
+            credits (int): if not None, use credit-based flow control,
+                and grant this many credits to each producer.
         """
         assert addr1
-        self._addr1 = addr1
-        self._addr2 = addr2
+        self._addrs = [addr1] if isinstance(addr1, six.string_types) else list(addr1)
+        if addr2 is not None:
+            self._addrs.append(addr2)
+        self._hwm = hwm
+        self._rcvbuf = rcvbuf
+        self._credits = credits
+        self._decompressors = {}
+        self.reset_state()
 
     def reset_state(self):
-        self.cnt1 = 0
-        self.cnt2 = 0
+        self._stats = [_SourceStats(addr) for addr in self._addrs]
+        self._producers = {}
+        self._start_time = time.time()
+        self.wait_time = 0.
+
+    @property
+    def inflight(self):
+        """ Number of messages the producers are allowed to send but not yet consumed. """
+        return sum(p.inflight for p in self._producers.values())
+
+    @property
+    def cnt1(self):
+        return self._stats[0].count
+
+    @property
+    def cnt2(self):
+        return self._stats[1].count if len(self._stats) > 1 else 0
+
+    def _create_socket(self, ctx, addr):
+        socket = ctx.socket(zmq.PULL if self._credits is None else zmq.ROUTER)
+        socket.set_hwm(self._hwm)
+        if self._rcvbuf is not None:
+            socket.setsockopt(zmq.RCVBUF, self._rcvbuf)
+        _bind_or_connect(socket, addr, True)
+        return socket
+
+    def _recv(self, socket, stat):
+        frames = socket.recv_multipart(copy=False)
+        dps = _decode_message(frames, self._decompressors)
+        stat.update(len(dps), sum(len(f) for f in frames), time.time())
+        return dps
+
+    def _grant(self, socket, ident, producer, n):
+        socket.send_multipart([ident, _MSG_CREDIT, str(n).encode('ascii')])
+        producer.inflight += n
+
+    def _get_data_credit(self, sockets):
+        poller = zmq.Poller()
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
+        stats = dict(zip(sockets, self._stats))
+        while True:
+            start = time.time()
+            evts = poller.poll()
+            self.wait_time += time.time() - start
+            for sock, evt in evts:
+                frames = sock.recv_multipart(copy=False)
+                ident, kind = frames[0].bytes, frames[1].bytes
+                producer = self._producers.get(ident)
+                if producer is None:
+                    producer = _SourceStats('{}/{}'.format(stats[sock].addr, binascii.hexlify(ident).decode()))
+                    self._producers[ident] = producer
+                if kind == _MSG_HELLO:
+                    # A producer only says hello when it has no credits: it is new,
+                    # or the credits granted to it were lost. Hellos it repeated
+                    # while we were not reading are answered only once.
+                    now = time.time()
+                    if producer.hello_time is None or now - producer.hello_time > _HELLO_INTERVAL / 2:
+                        producer.hello_time = now
+                        producer.inflight = 0
+                        self._grant(sock, ident, producer, self._credits)
+                    continue
+                producer.inflight = max(producer.inflight - 1, 0)
+                dps = _decode_message(frames[2:], self._decompressors)
+                now = time.time()
+                nbytes = sum(len(f) for f in frames[2:])
+                stats[sock].update(len(dps), nbytes, now)
+                producer.update(len(dps), nbytes, now)
+                for dp in dps:
+                    yield dp
+                self._grant(sock, ident, producer, 1)
 
     def get_data(self):
         try:
             ctx = zmq.Context()
-            if self._addr2 is None:
-                socket = ctx.socket(zmq.PULL)
-                socket.set_hwm(50)
-                socket.bind(self._addr1)
-
-                while True:
-                    dp = loads(socket.recv(copy=False).bytes)
+            sockets = [self._create_socket(ctx, addr) for addr in self._addrs]
+            if self._credits is not None:
+                for dp in self._get_data_credit(sockets):
                     yield dp
-                    self.cnt1 += 1
+            elif len(sockets) == 1:
+                socket, stat = sockets[0], self._stats[0]
+                while True:
+                    start = time.time()
+                    dps = self._recv(socket, stat)
+                    self.wait_time += time.time() - start
+                    for dp in dps:
+                        yield dp
             else:
-                socket1 = ctx.socket(zmq.PULL)
-                socket1.set_hwm(50)
-                socket1.bind(self._addr1)
-
-                socket2 = ctx.socket(zmq.PULL)
-                socket2.set_hwm(50)
-                socket2.bind(self._addr2)
-
                 poller = zmq.Poller()
-                poller.register(socket1, zmq.POLLIN)
-                poller.register(socket2, zmq.POLLIN)
+                for socket in sockets:
+                    poller.register(socket, zmq.POLLIN)
+                stats = dict(zip(sockets, self._stats))
 
                 while True:
+                    start = time.time()
                     evts = poller.poll()
+                    self.wait_time += time.time() - start
                     for sock, evt in evts:
-                        dp = loads(sock.recv(copy=False).bytes)
-                        yield dp
-                        if sock == socket1:
-                            self.cnt1 += 1
-                        else:
-                            self.cnt2 += 1
+                        for dp in self._recv(sock, stats[sock]):
+                            yield dp
         finally:
             ctx.destroy(linger=0)
 
+    def get_stats(self):
+        """
+        Returns:
+            list[dict]: statistics of each address, including the number of
+            datapoints and bytes received and the rates, the longest gap between
+            two messages, and the total time of gaps longer than 1 second (stalls).
+        """
+        elapsed = max(time.time() - self._start_time, 1e-6)
+        return [{'addr': s.addr, 'count': s.count, 'bytes': s.nbytes,
+                 'dp_per_sec': s.count / elapsed, 'mb_per_sec': s.nbytes / elapsed / 1e6,
+                 'max_gap': s.max_gap, 'stall_time': s.stall_time} for s in self._stats]
+
+    def get_producer_stats(self):
+        """
+        Returns:
+            list[dict]: with ``credits``, statistics of each producer, including
+            the number of datapoints and bytes received, their fraction of the total,
+            and the number of messages in flight.
+        """
+        total = max(sum(p.count for p in self._producers.values()), 1)
+        return [{'producer': p.addr, 'count': p.count, 'bytes': p.nbytes,
+                 'fraction': p.count * 1.0 / total, 'inflight': p.inflight,
+                 'max_gap': p.max_gap, 'stall_time': p.stall_time}
+                for p in self._producers.values()]
+
+    def print_stats(self):
+        """ Log the statistics of each address and producer. """
+        for s in self.get_stats():
+            logger.info("{addr}: {count} dps, {dp_per_sec:.1f} dp/s, {mb_per_sec:.1f} MB/s, "
+                        "max gap {max_gap:.3f}s, stalled {stall_time:.1f}s".format(**s))
+        for s in self.get_producer_stats():
+            logger.info("Producer {producer}: {count} dps ({fraction:.1%}), {inflight} in flight, "
+                        "max gap {max_gap:.3f}s".format(**s))
+        logger.info("Total time waiting for data: {:.1f}s".format(self.wait_time))
+
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -124,8 +499,7 @@ if __name__ == '__main__':
     """
     parser = ArgumentParser()
     parser.add_argument('-t', '--task', choices=['send', 'recv'], required=True)
-    parser.add_argument('-a', '--addr1', required=True)
-    parser.add_argument('-b', '--addr2', default=None)
+    parser.add_argument('-a', '--addr', nargs='+', required=True)
     args = parser.parse_args()
 
     # tcp addr like "tcp://127.0.0.1:8877"
@@ -133,8 +507,8 @@ if __name__ == '__main__':
     if args.task == 'send':
         # use random=True to make it slow and cpu-consuming
         ds = FakeData([(128, 244, 244, 3)], 1000, random=True)
-        send_dataflow_zmq(ds, args.addr1)
+        send_dataflow_zmq(ds, args.addr[0])
     else:
-        ds = RemoteDataZMQ(args.addr1, args.addr2)
+        ds = RemoteDataZMQ(args.addr)
         logger.info("Each DP is 73.5MB")
         TestDataSpeed(ds).start_test()
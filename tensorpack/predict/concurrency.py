@@ -4,12 +4,16 @@
 # Author: Yuxin Wu <ppwwyyxxc@gmail.com>
 
 import multiprocessing
+import time
+from collections import defaultdict
+import numpy as np
 import six
-from six.moves import queue, range
+from six.moves import queue
 import tensorflow as tf
 
 from ..utils import logger
 from ..utils.concurrency import DIE, StoppableThread, ShareSessionThread
+from ..utils.stats import LatencyHistogram
 from ..tfutils.model_utils import describe_model
 from .base import OnlinePredictor, OfflinePredictor, AsyncPredictorBase
 
@@ -74,20 +78,99 @@ class MultiProcessQueuePredictWorker(MultiProcessPredictWorker):
                 self.outqueue.put((tid, self.predictor(dp)))
 
 
+class _BatchBuffer(object):
+    """
+    Preallocated arrays to hold a batch, one for each input.
+    Requests are copied in as they arrive.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.arrays = None
+        self.size = 0
+
+    def compatible(self, dp):
+        """ Whether the datapoint has the same shapes and dtypes as the arrays. """
+        if self.arrays is None or len(dp) != len(self.arrays):
+            return False
+        for arr, v in zip(self.arrays, dp):
+            v = np.asarray(v)
+            if v.shape != arr.shape[1:] or v.dtype != arr.dtype:
+                return False
+        return True
+
+    def add(self, dp):
+        """ Add a datapoint. It must be compatible unless the buffer is empty. """
+        if self.size == 0 and not self.compatible(dp):
+            # (re)allocate for the new shapes
+            dp = [np.asarray(v) for v in dp]
+            self.arrays = [np.empty((self.capacity,) + v.shape, dtype=v.dtype) for v in dp]
+        for arr, v in zip(self.arrays, dp):
+            arr[self.size] = v
+        self.size += 1
+
+    def get(self, size=None):
+        """
+        Returns:
+            list[np.ndarray]: contiguous arrays of the first ``size`` elements,
+            where the elements after the added ones are copies of the last one.
+        """
+        if size is None:
+            size = self.size
+        for arr in self.arrays:
+            arr[self.size:size] = arr[self.size - 1]
+        return [arr[:size] for arr in self.arrays]
+
+
 class PredictorWorkerThread(StoppableThread, ShareSessionThread):
-    def __init__(self, queue, pred_func, id, batch_size=5):
+    def __init__(self, queue, pred_func, id, batch_size=5, max_wait=0, bucket_sizes=None,
+                 copy_outputs=True):
+        """
+        Args:
+            queue: the queue of (dp, future, time of the request).
+            pred_func: the predictor to run on a batch.
+            id (int): id of the thread.
+            batch_size (int): the maximum batch size.
+            max_wait (float): seconds to wait for more requests after the first
+                request of a batch arrives. 0 means to only take the requests
+                already in the queue.
+            bucket_sizes (list[int]): if given, pad each batch to the smallest
+                size in the list that fits it, by repeating the last request.
+                This limits the number of different shapes the predictor runs with.
+            copy_outputs (bool): give each request a compact copy of its outputs.
+                Otherwise give views into the batched outputs, which saves a copy
+                but keeps the whole batch alive as long as any of the results.
+        """
         super(PredictorWorkerThread, self).__init__()
         self.name = "PredictorWorkerThread-{}".format(id)
         self.queue = queue
         self.func = pred_func
         self.daemon = True
         self.batch_size = batch_size
+        self.max_wait = max_wait
+        if bucket_sizes is not None:
+            bucket_sizes = sorted(bucket_sizes)
+            assert bucket_sizes[-1] >= batch_size, \
+                "The largest bucket size has to be >= batch_size!"
+        self.bucket_sizes = bucket_sizes
+        self.copy_outputs = copy_outputs
         self.id = id
 
+        self._buffer = _BatchBuffer(batch_size if bucket_sizes is None else bucket_sizes[-1])
+        # a request which didn't fit into the previous batch
+        self._pending = None
+
+        # latency of each request, from put_task to the start of its batch
+        self.queue_latency = LatencyHistogram()
+        # latency of each request spent in the predictor
+        self.compute_latency = LatencyHistogram()
+        # batch size -> number of batches
+        self.batch_size_counts = defaultdict(int)
+
     def run(self):
         with self.default_sess():
             while not self.stopped():
                 batched, futures = self.fetch_batch()
+                start = time.time()
                 try:
                     outputs = self.func(batched)
                 except tf.errors.CancelledError:
@@ -95,34 +178,70 @@ class PredictorWorkerThread(StoppableThread, ShareSessionThread):
                         f.cancel()
                     logger.warn("In PredictorWorkerThread id={}, call was cancelled.".format(self.id))
                     return
+                except Exception as e:
+                    # e.g. a bad request. Fail the requests instead of the thread.
+                    logger.exception("Exception in PredictorWorkerThread id={}:".format(self.id))
+                    for f in futures:
+                        f.set_exception(e)
+                    continue
+                nr_req = len(futures)
+                self.compute_latency.feed(time.time() - start, nr_req)
+                self.batch_size_counts[nr_req] += 1
                 # print "Worker {} batched {} Queue {}".format(
                 #         self.id, len(futures), self.queue.qsize())
-                #  debug, for speed testing
-                # if not hasattr(self, 'xxx'):
-                    # self.xxx = outputs = self.func(batched)
-                # else:
-                    # outputs = [[self.xxx[0][0]] * len(batched[0]), [self.xxx[1][0]] * len(batched[0])]
 
-                for idx, f in enumerate(futures):
-                    f.set_result([k[idx] for k in outputs])
+                if self.copy_outputs:
+                    for idx, f in enumerate(futures):
+                        f.set_result([np.array(k[idx]) for k in outputs])
+                else:
+                    for idx, f in enumerate(futures):
+                        f.set_result([k[idx] for k in outputs])
 
     def fetch_batch(self):
-        """ Fetch a batch of data without waiting"""
-        inp, f = self.queue.get()
-        nr_input_var = len(inp)
-        batched, futures = [[] for _ in range(nr_input_var)], []
-        for k in range(nr_input_var):
-            batched[k].append(inp[k])
-        futures.append(f)
+        """
+        Fetch a batch of data, waiting at most ``max_wait`` seconds after the first request.
+
+        Returns:
+            list[np.ndarray], list[Future]: the batched inputs, which are views of
+            a buffer reused in the next call, and the futures of the requests.
+        """
+        if self._pending is not None:
+            (inp, f, t), self._pending = self._pending, None
+        else:
+            inp, f, t = self.queue.get()
+        buf = self._buffer
+        buf.size = 0
+        buf.add(inp)
+        futures, put_times = [f], [t]
+        deadline = time.time() + self.max_wait
         while len(futures) < self.batch_size:
             try:
-                inp, f = self.queue.get_nowait()
-                for k in range(nr_input_var):
-                    batched[k].append(inp[k])
-                futures.append(f)
+                if self.max_wait > 0:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    inp, f, t = self.queue.get(timeout=timeout)
+                else:
+                    inp, f, t = self.queue.get_nowait()
             except queue.Empty:
-                break   # do not wait
-        return batched, futures
+                break
+            if not buf.compatible(inp):
+                # a different shape cannot be batched together, leave it to the next batch
+                self._pending = (inp, f, t)
+                break
+            buf.add(inp)
+            futures.append(f)
+            put_times.append(t)
+        now = time.time()
+        for t in put_times:
+            self.queue_latency.feed(now - t)
+
+        size = None
+        if self.bucket_sizes is not None:
+            for size in self.bucket_sizes:
+                if size >= buf.size:
+                    break
+        return buf.get(size), futures
 
 
 class MultiThreadAsyncPredictor(AsyncPredictorBase):
@@ -131,11 +250,18 @@ class MultiThreadAsyncPredictor(AsyncPredictorBase):
     It would do an extra batching internally.
     """
 
-    def __init__(self, predictors, batch_size=5):
+    def __init__(self, predictors, batch_size=5, max_wait=0, bucket_sizes=None, copy_outputs=True):
         """
         Args:
             predictors (list): a list of OnlinePredictor avaiable to use.
             batch_size (int): the maximum of an internal batch.
+            max_wait (float): seconds to wait for more requests to form a batch,
+                e.g. 0.002. A larger value gives larger batches and higher
+                throughput under light load, at the cost of latency.
+            bucket_sizes (list[int]): pad each batch to one of these sizes.
+                See :class:`PredictorWorkerThread`.
+            copy_outputs (bool): whether the results are compact copies or views
+                into the batched outputs. See :class:`PredictorWorkerThread`.
         """
         assert len(predictors)
         self._need_default_sess = False
@@ -148,7 +274,9 @@ class MultiThreadAsyncPredictor(AsyncPredictorBase):
         self.input_queue = queue.Queue(maxsize=len(predictors) * 100)
         self.threads = [
             PredictorWorkerThread(
-                self.input_queue, f, id, batch_size=batch_size)
+                self.input_queue, f, id, batch_size=batch_size,
+                max_wait=max_wait, bucket_sizes=bucket_sizes,
+                copy_outputs=copy_outputs)
             for id, f in enumerate(predictors)]
 
         if six.PY2:
@@ -172,9 +300,30 @@ class MultiThreadAsyncPredictor(AsyncPredictorBase):
         f = Future()
         if callback is not None:
             f.add_done_callback(callback)
-        self.input_queue.put((dp, f))
+        self.input_queue.put((dp, f, time.time()))
         return f
 
+    def get_latency_stats(self):
+        """
+        Returns:
+            dict: percentiles and average (in seconds) of the queueing and
+            compute latency of the requests so far, and the number of batches of each size.
+        """
+        ret = {}
+        for name in ['queue_latency', 'compute_latency']:
+            hist = LatencyHistogram()
+            for t in self.threads:
+                hist.merge(getattr(t, name))
+            if hist.count:
+                ret[name] = {'p50': float(hist.percentile(50)), 'p90': float(hist.percentile(90)),
+                             'p99': float(hist.percentile(99)), 'average': float(hist.average)}
+        batch_sizes = defaultdict(int)
+        for t in self.threads:
+            for k, v in list(t.batch_size_counts.items()):
+                batch_sizes[k] += v
+        ret['batch_size'] = dict(batch_sizes)
+        return ret
+
 
 try:
     if six.PY2:
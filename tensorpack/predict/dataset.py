@@ -5,17 +5,23 @@
 
 from six.moves import range, zip
 from abc import ABCMeta, abstractmethod
+import itertools
 import multiprocessing
 import os
+import threading
+import numpy as np
 import six
+from six.moves import queue
+import zmq
 
-from ..dataflow import DataFlow
-from ..dataflow.dftools import dump_dataflow_to_process_queue
-from ..utils.concurrency import ensure_proc_terminate, OrderedResultGatherProc, DIE
+from ..dataflow import DataFlow, BatchData, PrefetchDataZMQ
+from ..dataflow.prefetch import _get_pipe_name
+from ..utils.concurrency import ensure_proc_terminate, OrderedContainer
+from ..utils.serialize import dumps, loads
 from ..utils import logger, get_tqdm
 from ..utils.gpu import change_gpu
 
-from .concurrency import MultiProcessQueuePredictWorker
+from .concurrency import MultiProcessPredictWorker
 from .config import PredictConfig
 from .base import OfflinePredictor
 
@@ -56,35 +62,225 @@ class DatasetPredictorBase(object):
         return list(self.get_result())
 
 
+def _split_batch_outputs(outputs, nr):
+    """ Split batched outputs into the outputs of each datapoint, as compact copies. """
+    return [[np.array(o[k]) for o in outputs] for k in range(nr)]
+
+
+def _iter_in_thread(itr, buffer_size):
+    """ Run an iterator in a background thread and yield from it.
+        The thread is stopped when the generator is closed.
+    """
+    q = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def put(x):
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            for x in itr:
+                put((True, x))
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    th = threading.Thread(target=run, name='SimpleDatasetPredictorPrefetch')
+    th.daemon = True
+    th.start()
+    try:
+        while True:
+            ok, x = q.get()
+            if ok:
+                yield x
+            elif x is not None:
+                raise x
+            else:
+                return
+    finally:
+        stop.set()
+        # unblock a producer waiting on the full queue
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        # a producer blocked in the iterator exits once it returns
+        th.join(1)
+
+
 class SimpleDatasetPredictor(DatasetPredictorBase):
     """
     Simply create one predictor and run it on the DataFlow.
     """
-    def __init__(self, config, dataset):
+    def __init__(self, config, dataset, batch_size=None, prefetch=None):
+        """
+        Args:
+            config, dataset: same as in :class:`DatasetPredictorBase`.
+            batch_size (int): if not None, run the predictor on batches of this
+                many datapoints, and produce the output of each datapoint.
+                The datapoints must not be batched, and the inputs of the
+                model must have a batch dimension.
+            prefetch (str): None, 'thread' or 'process'. Run the DataFlow (and
+                the batching) in a background thread or process, to overlap
+                with the prediction. 'process' requires the DataFlow to have a size,
+                and produces nothing if the size is 0.
+        """
         super(SimpleDatasetPredictor, self).__init__(config, dataset)
+        assert prefetch in [None, 'thread', 'process'], prefetch
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        ds = dataset
+        if batch_size is not None:
+            ds = BatchData(ds, batch_size, remainder=True)
+        if prefetch == 'process':
+            try:
+                sz = dataset.size()
+            except NotImplementedError:
+                raise ValueError("prefetch='process' needs a DataFlow with a size!")
+            # PrefetchDataZMQ would loop forever on an empty DataFlow
+            # start the process before the session is created
+            ds = PrefetchDataZMQ(ds, 1) if sz > 0 else None
+        self._ds = ds
         self.predictor = OfflinePredictor(config)
 
     def get_result(self):
-        self.dataset.reset_state()
+        if self._ds is None:
+            return
+        self._ds.reset_state()
         try:
             sz = self.dataset.size()
         except NotImplementedError:
             sz = 0
+        itr = self._ds.get_data()
+        if self.prefetch == 'thread':
+            itr = _iter_in_thread(itr, 50)
         with get_tqdm(total=sz, disable=(sz == 0)) as pbar:
-            for dp in self.dataset.get_data():
+            for dp in itr:
                 res = self.predictor(dp)
-                yield res
-                pbar.update()
+                if self.batch_size is None:
+                    yield res
+                    pbar.update()
+                    continue
+                outputs = res[1] if self.predictor.return_input else res
+                nr_dp = len(dp[0])
+                # copy each datapoint out of the batch, to not keep the whole batch alive
+                outputs = _split_batch_outputs(outputs, nr_dp)
+                if self.predictor.return_input:
+                    outputs = list(zip(_split_batch_outputs(dp, nr_dp), outputs))
+                for output in outputs:
+                    yield output
+                pbar.update(nr_dp)
+
+
+class _ChunkFeederProc(multiprocessing.Process):
+    """
+    Send chunks of datapoints from a DataFlow to the workers, keeping at most
+    ``window`` chunks not yet consumed by the master. The master returns a
+    credit for every consumed chunk, and the feeder exits after receiving all of them.
+    """
+    def __init__(self, ds, chunk_size, window, task_pipe, credit_pipe, result_pipe):
+        super(_ChunkFeederProc, self).__init__()
+        self.ds = ds
+        self.chunk_size = chunk_size
+        self.window = window
+        self.task_pipe = task_pipe
+        self.credit_pipe = credit_pipe
+        self.result_pipe = result_pipe
+
+    def run(self):
+        self.ds.reset_state()
+        context = zmq.Context()
+        task_socket = context.socket(zmq.PUSH)
+        task_socket.set_hwm(1)
+        task_socket.bind(self.task_pipe)
+        credit_socket = context.socket(zmq.PULL)
+        credit_socket.connect(self.credit_pipe)
+        result_socket = context.socket(zmq.PUSH)
+        result_socket.connect(self.result_pipe)
+
+        credits = self.window
+        nr_chunk = 0
+        itr = self.ds.get_data()
+        while True:
+            chunk = list(itertools.islice(itr, self.chunk_size))
+            if not chunk:
+                break
+            while credits == 0:
+                credit_socket.recv()
+                credits += 1
+            task_socket.send(dumps([nr_chunk, chunk], 'msgpack'), copy=False)
+            nr_chunk += 1
+            credits -= 1
+        # tell the master how many chunks to expect
+        result_socket.send(dumps([-1, nr_chunk], 'msgpack'))
+        # chunks still queued to the workers are lost if the feeder exits,
+        # so wait until the master has consumed all of them
+        while credits < self.window:
+            credit_socket.recv()
+            credits += 1
+        result_socket.close()
+        context.destroy(0)
+
+
+class _ChunkPredictWorker(MultiProcessPredictWorker):
+    """
+    Pull chunks of datapoints, and push the chunks of results to the master.
+    """
+    def __init__(self, idx, config, task_pipe, result_pipe, batch_chunks=False):
+        super(_ChunkPredictWorker, self).__init__(idx, config)
+        self.task_pipe = task_pipe
+        self.result_pipe = result_pipe
+        self.batch_chunks = batch_chunks
+
+    def _predict_chunk(self, chunk):
+        if self.batch_chunks:
+            try:
+                batch = [np.stack(x) for x in zip(*chunk)]
+            except ValueError:
+                batch = None    # datapoints of different shapes cannot be stacked
+            if batch is not None:
+                res = self.predictor(batch)
+                return_input = self.predictor.return_input
+                outputs = _split_batch_outputs(res[1] if return_input else res, len(chunk))
+                return list(zip(chunk, outputs)) if return_input else outputs
+        return [self.predictor(dp) for dp in chunk]
+
+    def run(self):
+        self._init_runtime()
+        context = zmq.Context()
+        task_socket = context.socket(zmq.PULL)
+        task_socket.set_hwm(1)
+        task_socket.connect(self.task_pipe)
+        result_socket = context.socket(zmq.PUSH)
+        result_socket.connect(self.result_pipe)
+        while True:
+            idx, chunk = loads(task_socket.recv(copy=False).buffer)
+            outputs = self._predict_chunk(chunk)
+            result_socket.send(dumps([idx, outputs], 'msgpack'), copy=False)
 
 
 class MultiProcessDatasetPredictor(DatasetPredictorBase):
     """
     Run prediction in multiprocesses, on either CPU or GPU.
-    Each process fetch datapoints as tasks and run predictions independently.
+    Each process pulls chunks of datapoints as tasks and runs predictions independently.
+    Datapoints and results are sent in chunks over ZMQ.
+
+    By default the predictor is still called once per datapoint, because each
+    datapoint is fed to the model as is, and is often a batch already. With
+    ``batch_chunks=True``, each chunk is stacked into one batch instead.
     """
-    # TODO allow unordered
 
-    def __init__(self, config, dataset, nr_proc, use_gpu=True, ordered=True):
+    def __init__(self, config, dataset, nr_proc, use_gpu=True, ordered=True,
+                 chunk_size=16, window=None, batch_chunks=False):
         """
         Args:
             config: same as in :class:`DatasetPredictorBase`.
@@ -94,8 +290,17 @@ class MultiProcessDatasetPredictor(DatasetPredictorBase):
                 If GPU, then ``nr_proc`` cannot be more than what's in
                 CUDA_VISIBLE_DEVICES.
             ordered (bool): produce outputs in the original order of the
-                datapoints. This will be a bit slower. Otherwise, :meth:`get_result` will produce
+                datapoints. Otherwise, :meth:`get_result` will produce
                 outputs in any order.
+            chunk_size (int): number of datapoints in each task.
+            window (int): the maximum number of chunks which are sent to
+                the workers but not yet produced by :meth:`get_result`.
+                It bounds the memory used to reorder the results. Defaults to ``4 * nr_proc``.
+            batch_chunks (bool): stack the datapoints of each chunk and run the
+                predictor once on the batch, then split the outputs.
+                The datapoints must not be batched, and the inputs of the model
+                must have a batch dimension. A chunk whose datapoints have
+                different shapes is predicted one datapoint at a time.
         """
         if config.return_input:
             logger.warn("Using the option `return_input` in MultiProcessDatasetPredictor might be slow")
@@ -104,9 +309,21 @@ class MultiProcessDatasetPredictor(DatasetPredictorBase):
 
         self.nr_proc = nr_proc
         self.ordered = ordered
+        if window is None:
+            window = 4 * nr_proc
+        assert window >= 1, window
 
-        self.inqueue, self.inqueue_proc = dump_dataflow_to_process_queue(
-            self.dataset, nr_proc * 2, self.nr_proc)    # put (idx, dp) to inqueue
+        task_pipe = _get_pipe_name('predict-task')
+        result_pipe = _get_pipe_name('predict-result')
+        credit_pipe = _get_pipe_name('predict-credit')
+        self.context = zmq.Context()
+        self.result_socket = self.context.socket(zmq.PULL)
+        self.result_socket.bind(result_pipe)
+        self.credit_socket = self.context.socket(zmq.PUSH)
+        self.credit_socket.setsockopt(zmq.LINGER, 0)
+        self.credit_socket.bind(credit_pipe)
+        self.feeder_proc = _ChunkFeederProc(
+            self.dataset, chunk_size, window, task_pipe, credit_pipe, result_pipe)
 
         if use_gpu:
             try:
@@ -119,14 +336,11 @@ class MultiProcessDatasetPredictor(DatasetPredictorBase):
                 gpus = list(range(self.nr_proc))
         else:
             gpus = ['-1'] * self.nr_proc
-        # worker produces (idx, result) to outqueue
-        self.outqueue = multiprocessing.Queue()
-        self.workers = [MultiProcessQueuePredictWorker(
-            i, self.inqueue, self.outqueue, self.config)
-            for i in range(self.nr_proc)]
-
-        # start inqueue and workers
-        self.inqueue_proc.start()
+        self.workers = [_ChunkPredictWorker(i, self.config, task_pipe, result_pipe, batch_chunks)
+                        for i in range(self.nr_proc)]
+
+        # start the feeder and workers
+        self.feeder_proc.start()
         for p, gpuid in zip(self.workers, gpus):
             if gpuid == '-1':
                 logger.info("Worker {} uses CPU".format(p.idx))
@@ -134,37 +348,46 @@ class MultiProcessDatasetPredictor(DatasetPredictorBase):
                 logger.info("Worker {} uses GPU {}".format(p.idx, gpuid))
             with change_gpu(gpuid):
                 p.start()
+        ensure_proc_terminate(self.workers + [self.feeder_proc])
 
-        if ordered:
-            self.result_queue = OrderedResultGatherProc(
-                self.outqueue, nr_producer=self.nr_proc)
-            self.result_queue.start()
-            ensure_proc_terminate(self.result_queue)
-        else:
-            self.result_queue = self.outqueue
-        ensure_proc_terminate(self.workers + [self.inqueue_proc])
+    def _send_credit(self):
+        # the feeder may not be connected yet, but it waits for every credit
+        # until it exits
+        while self.feeder_proc.is_alive():
+            if self.credit_socket.poll(100, zmq.POLLOUT):
+                try:
+                    self.credit_socket.send(b'', zmq.NOBLOCK)
+                    return
+                except zmq.Again:
+                    pass
 
     def get_result(self):
         try:
             sz = self.dataset.size()
         except NotImplementedError:
             sz = 0
+        container = OrderedContainer()
+        nr_chunk, nr_received = None, 0
         with get_tqdm(total=sz, disable=(sz == 0)) as pbar:
-            die_cnt = 0
-            while True:
-                res = self.result_queue.get()
-                pbar.update()
-                if res[0] != DIE:
-                    yield res[1]
+            while nr_chunk is None or nr_received < nr_chunk:
+                idx, outputs = loads(self.result_socket.recv(copy=False).buffer)
+                if idx == -1:
+                    nr_chunk = outputs
+                    continue
+                nr_received += 1
+                if self.ordered:
+                    container.put(idx, outputs)
+                    chunks = []
+                    while container.has_next():
+                        chunks.append(container.get()[1])
                 else:
-                    die_cnt += 1
-                    if die_cnt == self.nr_proc:
-                        break
-        self.inqueue_proc.join()
-        self.inqueue_proc.terminate()
-        if self.ordered:    # if ordered, than result_queue is a Process
-            self.result_queue.join()
-            self.result_queue.terminate()
+                    chunks = [outputs]
+                for outputs in chunks:
+                    for res in outputs:
+                        yield res
+                    pbar.update(len(outputs))
+                    self._send_credit()
+        self.feeder_proc.join()
         for p in self.workers:
-            p.join()
             p.terminate()
+            p.join()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: remote.py
+
+import itertools
+import struct
+import threading
+import six
+import zmq
+
+from ..utils import logger
+from ..utils.serialize import dumps, loads
+from .base import AsyncPredictorBase
+from .concurrency import MultiProcessPredictWorker, MultiThreadAsyncPredictor
+
+__all__ = ['ZMQPredictServer', 'ZMQAsyncPredictor']
+
+_STATUS_OK = b'0'
+_STATUS_ERROR = b'1'
+
+
+class ZMQPredictServer(MultiProcessPredictWorker):
+    """
+    A process which serves an :class:`OfflinePredictor` to other processes.
+    It receives requests from any number of :class:`ZMQAsyncPredictor` over a
+    ZMQ ROUTER socket, and batches them together with :class:`MultiThreadAsyncPredictor`.
+
+    Example:
+        .. code-block:: python
+
+            server = ZMQPredictServer(0, PredictConfig(...), 'ipc://@predictor',
+                                      batch_size=32, max_wait=0.002)
+            ensure_proc_terminate(server)
+            server.start()
+
+            # in any client process:
+            predictor = ZMQAsyncPredictor('ipc://@predictor')
+            predictor.start()
+            future = predictor.put_task([state])
+    """
+
+    def __init__(self, idx, config, addr, nr_thread=1,
+                 batch_size=16, max_wait=0.002, bucket_sizes=None):
+        """
+        Args:
+            idx, config: same as in :class:`MultiProcessPredictWorker`.
+            addr (str): the ZMQ address to bind.
+            nr_thread (int): number of threads to run the predictor.
+            batch_size, max_wait, bucket_sizes: the batching options of
+                :class:`MultiThreadAsyncPredictor`.
+        """
+        super(ZMQPredictServer, self).__init__(idx, config)
+        self.name = "ZMQPredictServer-{}".format(idx)
+        self.addr = addr
+        self.nr_thread = nr_thread
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.bucket_sizes = bucket_sizes
+
+    def run(self):
+        self._init_runtime()
+        predictor = MultiThreadAsyncPredictor(
+            [self.predictor] * self.nr_thread, batch_size=self.batch_size,
+            max_wait=self.max_wait, bucket_sizes=self.bucket_sizes)
+        predictor.start()
+
+        context = zmq.Context()
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(self.addr)
+        # results come back from the predictor threads through this pipe,
+        # because the ROUTER socket can only be used in this thread
+        result_pipe = 'inproc://predict-results'
+        backend = context.socket(zmq.PULL)
+        backend.set_hwm(0)
+        backend.bind(result_pipe)
+        local = threading.local()
+
+        def make_callback(ident, req_id):
+            def cb(fut):
+                try:
+                    msg = [ident, req_id, _STATUS_OK, dumps(fut.result(), 'msgpack')]
+                except Exception as e:
+                    msg = [ident, req_id, _STATUS_ERROR, dumps(str(e), 'msgpack')]
+                sock = getattr(local, 'socket', None)
+                if sock is None:
+                    sock = local.socket = context.socket(zmq.PUSH)
+                    sock.set_hwm(0)
+                    sock.connect(result_pipe)
+                sock.send_multipart(msg, copy=False)
+            return cb
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        logger.info("{} serving at {} ...".format(self.name, self.addr))
+        while True:
+            for sock, _ in poller.poll():
+                if sock is frontend:
+                    frames = frontend.recv_multipart(copy=False)
+                    if len(frames) != 3:
+                        logger.error("Dropped a malformed request with {} frames.".format(len(frames)))
+                        continue
+                    ident, req_id, payload = frames
+                    try:
+                        dp = loads(payload.buffer)
+                    except Exception as e:
+                        # a bad request must not stop the server for the other clients
+                        msg = "Cannot decode the request: {}".format(e)
+                        logger.error(msg)
+                        frontend.send_multipart([ident, req_id, _STATUS_ERROR, dumps(msg, 'msgpack')], copy=False)
+                        continue
+                    predictor.put_task(dp, make_callback(ident.bytes, req_id.bytes))
+                else:
+                    frontend.send_multipart(backend.recv_multipart(copy=False), copy=False)
+
+
+class ZMQAsyncPredictor(AsyncPredictorBase):
+    """
+    The client of :class:`ZMQPredictServer`.
+    :meth:`put_task` can be called from any thread.
+    """
+
+    def __init__(self, addr):
+        """
+        Args:
+            addr (str): the address of the server.
+        """
+        self.addr = addr
+        self.return_input = False
+        self._context = zmq.Context()
+        self._pipe = 'inproc://predict-client-{}'.format(id(self))
+        self._local = threading.local()
+        self._futures = {}
+        self._counter = itertools.count()
+        self._thread = None
+
+    def start(self):
+        # requests go through this pipe to the IO thread, which owns the DEALER socket
+        self._pipe_socket = self._context.socket(zmq.PULL)
+        self._pipe_socket.set_hwm(0)
+        self._pipe_socket.bind(self._pipe)
+        self._thread = threading.Thread(target=self._io_loop, name='ZMQAsyncPredictor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get_socket(self):
+        sock = getattr(self._local, 'socket', None)
+        if sock is None:
+            sock = self._local.socket = self._context.socket(zmq.PUSH)
+            sock.set_hwm(0)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self._pipe)
+        return sock
+
+    def put_task(self, dp, callback=None):
+        """
+        Same as in :meth:`AsyncPredictorBase.put_task`.
+        """
+        assert self._thread is not None, "ZMQAsyncPredictor.start() has to be called first!"
+        f = Future()
+        if callback is not None:
+            f.add_done_callback(callback)
+        req_id = next(self._counter)
+        self._futures[req_id] = f
+        self._get_socket().send_multipart([struct.pack('<Q', req_id), dumps(dp, 'msgpack')], copy=False)
+        return f
+
+    def close(self):
+        """
+        Stop the IO thread, cancel the pending requests, and close the sockets.
+        It should not be called together with :meth:`put_task` in other threads.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._get_socket().send(b'')
+            self._thread.join()
+        if not self._context.closed:
+            # also closes the sockets created by put_task in each thread
+            self._context.destroy(0)
+
+    def __del__(self):
+        self.close()
+
+    def _io_loop(self):
+        dealer = self._context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(self.addr)
+        poller = zmq.Poller()
+        poller.register(self._pipe_socket, zmq.POLLIN)
+        poller.register(dealer, zmq.POLLIN)
+        try:
+            while True:
+                for sock, _ in poller.poll():
+                    if sock is dealer:
+                        req_id, status, payload = dealer.recv_multipart(copy=False)
+                        f = self._futures.pop(struct.unpack('<Q', req_id.bytes)[0])
+                        if status.bytes == _STATUS_OK:
+                            f.set_result(loads(payload.buffer))
+                        else:
+                            f.set_exception(RuntimeError(
+                                "Error in ZMQPredictServer: {}".format(loads(payload.buffer))))
+                    else:
+                        frames = self._pipe_socket.recv_multipart(copy=False)
+                        if len(frames) == 1:    # close
+                            return
+                        dealer.send_multipart(frames, copy=False)
+        finally:
+            dealer.close()
+            self._pipe_socket.close()
+            for f in list(self._futures.values()):
+                f.cancel()
+            self._futures.clear()
+
+
+try:
+    if six.PY2:
+        from tornado.concurrent import Future
+    else:
+        from concurrent.futures import Future
+except ImportError:
+    from ..utils.develop import create_dummy_class
+    ZMQAsyncPredictor = create_dummy_class('ZMQAsyncPredictor', 'tornado.concurrent')  # noqa
@@ -9,13 +9,16 @@ try:
 except ImportError:
     pass
 
+import time
+import threading
+import numpy as np
 from itertools import chain
 from abc import ABCMeta, abstractmethod
 import six
 from six.moves import range, zip
 
 from .utils import get_placeholders_by_names, get_tensors_inputs
-from ..dataflow import DataFlow, RepeatedData
+from ..dataflow import DataFlow, ProxyDataFlow, RepeatedData
 from ..tfutils.summary import add_moving_summary
 from ..tfutils import get_op_tensor_name
 from ..tfutils.tower import get_current_tower_context
@@ -168,9 +171,42 @@ class FeedfreeInput(InputSource):
         return {}
 
 
-# TODO enqueu_many? https://github.com/tensorflow/tensorflow/issues/7817#issuecomment-282053155
+class _SharedDataFlow(ProxyDataFlow):
+    """
+    Let several threads pull datapoints from one infinite iterator over a DataFlow.
+    """
+    def __init__(self, ds):
+        super(_SharedDataFlow, self).__init__(ds)
+        self._lock = threading.Lock()
+        self._itr = None
+
+    def reset_state(self):
+        # only the first call resets the underlying DataFlow
+        with self._lock:
+            if self._itr is None:
+                self.ds.reset_state()
+                self._itr = RepeatedData(self.ds, -1).get_data()
+
+    def get_data(self):
+        while True:
+            with self._lock:
+                dp = next(self._itr)
+            yield dp
+
+
 class EnqueueThread(ShareSessionThread):
-    def __init__(self, queue, ds, placehdrs):
+    def __init__(self, queue, ds, placehdrs, enqueue_many=1, share_ops_with=None):
+        """
+        Args:
+            queue (tf.QueueBase):
+            ds (DataFlow):
+            placehdrs (list[tf.Tensor]): placeholders of one queue element.
+            enqueue_many (int): the maximum number of datapoints to push with one
+                ``enqueue_many`` call. The actual number is adjusted at runtime.
+                See :meth:`_adjust_nr_many`.
+            share_ops_with (EnqueueThread): reuse the ops created by another
+                thread of the same queue, instead of creating new ones.
+        """
         super(EnqueueThread, self).__init__()
         self.name = 'EnqueueThread'
         self.daemon = True
@@ -179,22 +215,41 @@ class EnqueueThread(ShareSessionThread):
         self.queue = queue
 
         self.placehdrs = placehdrs
-
-        self.op = self.queue.enqueue(self.placehdrs)
-        self.close_op = self.queue.close(cancel_pending_enqueues=True)
-        self.size_op = self.queue.size()
-        add_moving_summary(tf.cast(
-            self.size_op, tf.float32, name='input_queue_size'))
+        self.max_enqueue_many = int(enqueue_many)
+        assert self.max_enqueue_many >= 1, self.max_enqueue_many
+
+        if share_ops_with is not None:
+            other = share_ops_with
+            assert other.queue is queue and other.max_enqueue_many == self.max_enqueue_many
+            self.op, self.close_op, self.size_op = other.op, other.close_op, other.size_op
+            if self.max_enqueue_many > 1:
+                self.many_placehdrs, self.many_op = other.many_placehdrs, other.many_op
+        else:
+            self.op = self.queue.enqueue(self.placehdrs)
+            self.close_op = self.queue.close(cancel_pending_enqueues=True)
+            self.size_op = self.queue.size()
+            add_moving_summary(tf.cast(
+                self.size_op, tf.float32, name='input_queue_size'))
+
+            if self.max_enqueue_many > 1:
+                self.many_placehdrs = [tf.placeholder(
+                    dtype=p.dtype, shape=tf.TensorShape([None]).concatenate(p.get_shape()),
+                    name=get_op_tensor_name(p.name)[0] + '-many') for p in self.placehdrs]
+                self.many_op = self.queue.enqueue_many(self.many_placehdrs)
+        # the number of datapoints to push in one call, adjusted at runtime
+        self.nr_many = 1
 
     def run(self):
         with self.default_sess():
             try:
                 self.dataflow.reset_state()
-                while True:
-                    for dp in self.dataflow.get_data():
-                        feed = dict(zip(self.placehdrs, dp))
-                        # print 'qsize:', self.sess.run([self.op, self.size_op], feed_dict=feed)[1]
-                        self.op.run(feed_dict=feed)
+                if self.max_enqueue_many > 1:
+                    self._run_many()
+                else:
+                    while True:
+                        for dp in self.dataflow.get_data():
+                            feed = dict(zip(self.placehdrs, dp))
+                            self.op.run(feed_dict=feed)
             except (tf.errors.CancelledError, tf.errors.OutOfRangeError):
                 pass
             except Exception:
@@ -204,7 +259,45 @@ class EnqueueThread(ShareSessionThread):
                     self.close_op.run()
                 except Exception:
                     pass
-                logger.info("EnqueueThread Exited.")
+                logger.info("{} Exited.".format(self.name))
+
+    def _run_many(self):
+        sess = tf.get_default_session()
+        buf = []
+        gather_start = time.time()
+        for dp in RepeatedData(self.dataflow, -1).get_data():
+            buf.append(dp)
+            if len(buf) < self.nr_many:
+                continue
+            gather_time = time.time() - gather_start
+            try:
+                feed = dict(zip(self.many_placehdrs, [np.stack(x) for x in zip(*buf)]))
+            except ValueError:
+                # datapoints of different shapes cannot be stacked
+                for x in buf:
+                    self.op.run(feed_dict=dict(zip(self.placehdrs, x)))
+                feed = None
+            if feed is not None:
+                run_start = time.time()
+                size = sess.run([self.many_op, self.size_op], feed_dict=feed)[1]
+                self._adjust_nr_many(size, gather_time, time.time() - run_start)
+            buf = []
+            gather_start = time.time()
+
+    def _adjust_nr_many(self, queue_size, gather_time, run_time):
+        """
+        Only adjust when the queue is (almost) drained, i.e. when the consumer
+        is waiting for this thread. If the ``session.run`` call takes longer than
+        gathering the datapoints, the enqueue overhead is the bottleneck and
+        more datapoints are pushed at a time. Otherwise the DataFlow is the
+        bottleneck, and fewer datapoints are held back before being enqueued.
+        """
+        if queue_size > self.nr_many:
+            return
+        if run_time > gather_time:
+            self.nr_many = min(self.nr_many * 2, self.max_enqueue_many)
+        else:
+            self.nr_many = max(self.nr_many // 2, 1)
 
 
 class QueueInput(FeedfreeInput):
@@ -212,7 +305,7 @@ class QueueInput(FeedfreeInput):
         And the model receives dequeued tensors.
     """
 
-    def __init__(self, ds, queue=None, names=None):
+    def __init__(self, ds, queue=None, names=None, enqueue_many=1, nr_enqueue_threads=1):
         """
         Args:
             ds(DataFlow): the input DataFlow.
@@ -220,11 +313,21 @@ class QueueInput(FeedfreeInput):
                 should match the corresponding InputDesc of the model.
                 Defaults to a FIFO queue of size 50.
             names(list[str]): list of input names corresponding to the dataflow.
+            enqueue_many (int): if larger than 1, gather up to this number of
+                datapoints and push them to the queue with one ``enqueue_many``,
+                to save the overhead of ``session.run`` for small datapoints.
+            nr_enqueue_threads (int): number of threads to enqueue. They pull
+                datapoints from the same iterator of ``ds``, and closing the queue
+                stops all of them. Use it when a single thread cannot keep up with
+                ``ds``. The order of datapoints is not preserved.
         """
         assert isinstance(ds, DataFlow), ds
         self.queue = queue
         self.ds = ds
         self._names = names
+        self._enqueue_many = enqueue_many
+        self._nr_enqueue_threads = int(nr_enqueue_threads)
+        assert self._nr_enqueue_threads >= 1, nr_enqueue_threads
 
     def size(self):
         return self.ds.size()
@@ -243,11 +346,21 @@ class QueueInput(FeedfreeInput):
             self.queue = tf.FIFOQueue(
                 50, [x.dtype for x in self._queue_feedpoint],
                 name='input_queue')
-        self.thread = EnqueueThread(self.queue, self.ds, self._queue_feedpoint)
+        if self._nr_enqueue_threads == 1:
+            self.threads = [EnqueueThread(self.queue, self.ds, self._queue_feedpoint, self._enqueue_many)]
+        else:
+            ds = _SharedDataFlow(self.ds)
+            self.threads = []
+            for k in range(self._nr_enqueue_threads):
+                th = EnqueueThread(self.queue, ds, self._queue_feedpoint, self._enqueue_many,
+                                   share_ops_with=self.threads[0] if k > 0 else None)
+                th.name = 'EnqueueThread-{}'.format(k)
+                self.threads.append(th)
+        self.thread = self.threads[0]
 
     def setup_training(self, trainer):
         super(QueueInput, self).setup_training(trainer)
-        cb = StartProcOrThread(self.thread)
+        cb = StartProcOrThread(self.threads)
         cb.chief_only = False
         trainer.register_callback(cb)
 
@@ -270,7 +383,7 @@ class BatchQueueInput(FeedfreeInput):
         And the model receives batches formed by concatenating
         dequeued tensors.
     """
-    def __init__(self, ds, batch_size, queue=None):
+    def __init__(self, ds, batch_size, queue=None, enqueue_many=1):
         """
         Args:
             ds(DataFlow): the input DataFlow.
@@ -278,11 +391,13 @@ class BatchQueueInput(FeedfreeInput):
             queue (tf.QueueBase): A :class:`tf.QueueBase` whose type
                 should match the corresponding InputDesc of the model.
                 Defaults to a FIFO queue of size 3000.
+            enqueue_many (int): same as in :class:`QueueInput`.
         """
         assert isinstance(ds, DataFlow), ds
         self.queue = queue
         self.ds = ds
         self.batch_size = int(batch_size)
+        self._enqueue_many = enqueue_many
 
     def size(self):
         return self.ds.size() // self.batch_size
@@ -316,7 +431,7 @@ class BatchQueueInput(FeedfreeInput):
         for shp in self.queue.shapes:
             assert shp.is_fully_defined(), shape_err
 
-        self.thread = EnqueueThread(self.queue, self.ds, placehdrs_nobatch)
+        self.thread = EnqueueThread(self.queue, self.ds, placehdrs_nobatch, self._enqueue_many)
 
     def setup_training(self, trainer):
         super(BatchQueueInput, self).setup_training(trainer)
@@ -416,6 +531,7 @@ class ZMQInput(TensorInput):
 class StagingInputWrapper(FeedfreeInput):
     """
     A wrapper around a feedfree input, to prefetch it in StagingArea (usually on GPUs).
+    The devices can also be CPUs.
     """
     class StagingCallback(Callback):
         """
@@ -427,26 +543,47 @@ class StagingInputWrapper(FeedfreeInput):
             self.stage_op = stage_op
             self.fetches = tf.train.SessionRunArgs(
                 fetches=[stage_op, unstage_op])
+            # to shrink the staging area by one element
+            self.fetches_unstage_only = tf.train.SessionRunArgs(
+                fetches=[unstage_op])
+            self._nr_staged = 0
+
+        def _fill(self):
+            while self._nr_staged < self.nr_stage:
+                self.stage_op.run()
+                self._nr_staged += 1
 
         def _before_train(self):
             # pre-fill the staging area
-            for k in range(self.nr_stage):
-                self.stage_op.run()
+            self._fill()
 
         def _before_run(self, ctx):
+            if self._nr_staged > self.nr_stage:
+                self._nr_staged -= 1
+                return self.fetches_unstage_only
+            self._fill()
             return self.fetches
 
-    def __init__(self, input, devices, nr_stage=5):
+    def __init__(self, input, devices, nr_stage=5, max_bytes=None):
         """
         Args:
             input: a :class:`FeedfreeInput`
             devices: list of devices to be used for each training tower
-            nr_stage: number of elements to prefetch
+            nr_stage: number of elements to prefetch. If None, use as many as
+                ``max_bytes`` allows.
+            max_bytes (int): memory budget in bytes of the staging area on each device.
+                The number of elements is capped by this budget,
+                computed from the static shapes of the inputs.
         """
         assert isinstance(input, FeedfreeInput), input
+        assert nr_stage is not None or max_bytes is not None, \
+            "StagingInputWrapper needs either nr_stage or max_bytes!"
         self._input = input
         self._devices = devices
         self._nr_stage = nr_stage
+        self._max_bytes = max_bytes
+        self._element_bytes = None
+        self._callback = None
         self._areas = []
         self._stage_ops = []
         self._unstage_ops = []
@@ -458,14 +595,18 @@ class StagingInputWrapper(FeedfreeInput):
     def setup_training(self, trainer):
         self._input.setup_training(trainer)
         self.setup_staging_areas()
+        add_moving_summary(tf.cast(
+            self.get_staging_size(), tf.float32, name='staging_size'))
 
-        trainer.register_callback(
-            StagingInputWrapper.StagingCallback(
-                self.get_stage_op(), self.get_unstage_op(), self._nr_stage))
+        self._callback = StagingInputWrapper.StagingCallback(
+            self.get_stage_op(), self.get_unstage_op(), self.nr_stage)
+        trainer.register_callback(self._callback)
 
     def setup_staging_areas(self):
-        logger.info("Setting up StagingArea for GPU prefetching ...")
-        for idx, device in enumerate(self._devices):
+        logger.info("Setting up StagingArea for prefetching on {} ...".format(
+            ', '.join(map(str, self._devices))))
+        element_bytes = []
+        for device in self._devices:
             with tf.device(device):
                 inputs = self._input.get_input_tensors()
                 dtypes = [x.dtype for x in inputs]
@@ -479,6 +620,45 @@ class StagingInputWrapper(FeedfreeInput):
                     vout.set_shape(vin.get_shape())
                 self._unstage_ops.append(outputs)
 
+                if all([x.get_shape().is_fully_defined() for x in inputs]):
+                    element_bytes.append(sum(
+                        [x.get_shape().num_elements() * x.dtype.size for x in inputs]))
+        if len(element_bytes) == len(self._devices):
+            self._element_bytes = max(element_bytes)
+        if self._max_bytes is not None:
+            if self._element_bytes is None:
+                logger.warn("Shapes of the inputs are not fully defined. "
+                            "max_bytes of StagingInputWrapper is ignored!")
+                if self._nr_stage is None:
+                    self._nr_stage = 5
+            else:
+                logger.info("Each element in the StagingArea takes {:.2f} MB.".format(
+                    self._element_bytes / 1024.0 ** 2))
+        self._nr_stage = self._clip_nr_stage(self._nr_stage)
+
+    def _clip_nr_stage(self, nr_stage):
+        if self._max_bytes is not None and self._element_bytes:
+            nr_max = max(int(self._max_bytes // self._element_bytes), 1)
+            nr_stage = nr_max if nr_stage is None else min(nr_stage, nr_max)
+        return nr_stage
+
+    @property
+    def nr_stage(self):
+        """ The number of elements to prefetch on each device. """
+        return self._nr_stage
+
+    def set_nr_stage(self, nr_stage):
+        """
+        Change the number of elements to prefetch. Can be called during training:
+        the staging area grows before the next step, or shrinks by one
+        element in each step. The value is capped by ``max_bytes``.
+        """
+        nr_stage = int(nr_stage)
+        assert nr_stage > 0, nr_stage
+        self._nr_stage = self._clip_nr_stage(nr_stage)
+        if self._callback is not None:
+            self._callback.nr_stage = self._nr_stage
+
     def size(self):
         return self._input.size()
 
@@ -500,6 +680,14 @@ class StagingInputWrapper(FeedfreeInput):
         all_outputs = list(chain.from_iterable(self._unstage_ops))
         return tf.group(*all_outputs)
 
+    @memoized
+    def get_staging_size(self):
+        """
+        Returns:
+            tf.Tensor: a int32 scalar, the total number of elements in the staging areas.
+        """
+        return tf.add_n([area.size() for area in self._areas])
+
 
 class ReorderInputSource(FeedfreeInput):
     """
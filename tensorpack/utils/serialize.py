@@ -6,8 +6,10 @@
 import msgpack
 import msgpack_numpy
 
+import os
 import struct
 import numpy as np
+from six.moves import cPickle as pickle
 from tensorflow.core.framework.tensor_pb2 import TensorProto
 from tensorflow.core.framework import types_pb2 as DataType
 # have to import like this: https://github.com/tensorflow/tensorflow/commit/955f038afbeb81302cea43058078e68574000bce
@@ -15,26 +17,178 @@ from tensorflow.core.framework import types_pb2 as DataType
 msgpack_numpy.patch()
 
 
-__all__ = ['loads', 'dumps', 'dumps_for_tfop', 'dump_tensor_protos',
+__all__ = ['loads', 'dumps', 'register_serializer', 'dumps_for_tfop', 'dump_tensor_protos',
            'to_tensor_proto']
 
+# Serialization backends.
+# The default backend is msgpack, whose output is untagged for backward compatibility.
+# Output of other backends start with _TAG_PREFIX plus one byte identifying the backend,
+# so loads() can always detect the format.
+# No valid msgpack output starts with _TAG_PREFIX.
 
-def dumps(obj):
+_TAG_PREFIX = b'\x00TPK'
+_TAG_LEN = len(_TAG_PREFIX) + 1
+_ALIGN = 64
+
+_SERIALIZERS = {}       # name -> (tag, dumps, loads)
+_TAG_TO_LOADS = {}      # tag -> loads
+
+
+def register_serializer(name, tag, dumps_fn, loads_fn):
+    """
+    Register a serialization backend, to be used by :func:`dumps` and :func:`loads`.
+
+    Args:
+        name (str): name of the backend.
+        tag (int): a unique integer in [1, 255] written into the output to identify the backend.
+        dumps_fn (obj -> bytes):
+        loads_fn (buffer -> obj): takes the serialized data after the tag.
+    """
+    assert 0 < tag < 256, tag
+    assert tag not in _TAG_TO_LOADS, "Tag {} is already registered!".format(tag)
+    tag = _TAG_PREFIX + struct.pack('B', tag)
+    _SERIALIZERS[name] = (tag, dumps_fn, loads_fn)
+    _TAG_TO_LOADS[tag] = loads_fn
+
+
+def dumps(obj, serializer=None):
     """
     Serialize an object.
 
+    Args:
+        serializer (str): name of the backend. One of "msgpack", "pickle",
+            "raw", or any backend registered by :func:`register_serializer`.
+            Defaults to env var $TENSORPACK_SERIALIZE, or "msgpack" if not set.
+            Messages internal to tensorpack (e.g. indices and headers sent
+            along with datapoints) should pass "msgpack" explicitly, so that
+            the env var only changes how datapoints are serialized.
+
     Returns:
         str
     """
-    return msgpack.dumps(obj, use_bin_type=True)
+    if serializer is None:
+        serializer = os.environ.get('TENSORPACK_SERIALIZE', 'msgpack')
+    if serializer == 'msgpack':
+        return msgpack.dumps(obj, use_bin_type=True)
+    tag, dumps_fn, _ = _SERIALIZERS[serializer]
+    return b''.join([tag] + dumps_fn(obj))
 
 
 def loads(buf):
     """
     Args:
-        buf (str): serialized object.
+        buf (str): serialized object, produced by any backend.
+            It can also be a buffer, e.g. ``memoryview``, in which case
+            ndarrays produced by "pickle" and "raw" backend will share memory with it.
+    """
+    view = memoryview(buf)
+    tag = view[:_TAG_LEN].tobytes()
+    if tag[:len(_TAG_PREFIX)] != _TAG_PREFIX:
+        return msgpack.loads(buf)
+    return _TAG_TO_LOADS[tag](view[_TAG_LEN:])
+
+
+def _padding(offset):
+    """
+    Padding needed after ``offset`` bytes of payload, so that the next buffer
+    is aligned relative to the beginning of the output (including the tag).
+    """
+    return -(offset + _TAG_LEN) % _ALIGN
+
+
+def _pickle_dumps(obj):
+    """
+    [#buffers(uint32)][size of pickle(uint64)][size of buffer(uint64) x #buffers]
+    [pickle][pad][buffer1][pad][buffer2]...
+    """
+    buffers = []
+    if pickle.HIGHEST_PROTOCOL >= 5:
+        # large ndarrays are kept out-of-band and not copied by pickle
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+    else:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sizes = [len(data)] + [b.nbytes for b in buffers]
+    header = struct.pack('<I{}Q'.format(len(sizes)), len(buffers), *sizes)
+    ret = [header, data]
+    offset = len(header) + len(data)
+    for b in buffers:
+        ret.append(b'\x00' * _padding(offset))
+        offset += _padding(offset)
+        ret.append(b)
+        offset += b.nbytes
+    return ret
+
+
+def _pickle_loads(buf):
+    nr_buf, = struct.unpack_from('<I', buf, 0)
+    sizes = struct.unpack_from('<{}Q'.format(nr_buf + 1), buf, 4)
+    offset = 4 + 8 * len(sizes)
+    data = buf[offset:offset + sizes[0]]
+    offset += sizes[0]
+    buffers = []
+    for size in sizes[1:]:
+        offset += _padding(offset)
+        buffers.append(buf[offset:offset + size])
+        offset += size
+    if nr_buf:
+        return pickle.loads(data, buffers=buffers)
+    return pickle.loads(data.tobytes())
+
+
+def _raw_dumps(dp):
+    """
+    Only for a list of ndarrays.
+    [#arrays(uint32)]
+    (array1)[len(dtype)(uint8)][dtype][ndim(uint8)][shape(uint64 x ndim)]
+    (array2)...
+    [pad][data1][pad][data2]...
     """
-    return msgpack.loads(buf)
+    header = [struct.pack('<I', len(dp))]
+    arrs = []
+    for arr in dp:
+        if isinstance(arr, np.generic):
+            arr = np.asarray(arr)
+        if not isinstance(arr, np.ndarray) or arr.dtype.hasobject or arr.dtype.names is not None:
+            raise ValueError("The 'raw' serializer only supports a list of numerical ndarrays! "
+                             "Got {}".format(type(arr)))
+        dtype = arr.dtype.str.encode('ascii')
+        shape = struct.pack('<B{}Q'.format(arr.ndim), arr.ndim, *arr.shape)
+        header.append(struct.pack('<B', len(dtype)) + dtype + shape)
+        arrs.append(np.ascontiguousarray(arr).reshape(-1).view(np.uint8).data)
+    ret = header
+    offset = sum(map(len, header))
+    for arr in arrs:
+        ret.append(b'\x00' * _padding(offset))
+        offset += _padding(offset)
+        ret.append(arr)
+        offset += arr.nbytes
+    return ret
+
+
+def _raw_loads(buf):
+    nr_arr, = struct.unpack_from('<I', buf, 0)
+    offset = 4
+    specs = []
+    for _ in range(nr_arr):
+        len_dtype, = struct.unpack_from('<B', buf, offset)
+        dtype = np.dtype(buf[offset + 1:offset + 1 + len_dtype].tobytes().decode('ascii'))
+        offset += 1 + len_dtype
+        ndim, = struct.unpack_from('<B', buf, offset)
+        shape = struct.unpack_from('<{}Q'.format(ndim), buf, offset + 1)
+        offset += 1 + 8 * ndim
+        specs.append((dtype, shape))
+    ret = []
+    for dtype, shape in specs:
+        offset += _padding(offset)
+        size = dtype.itemsize * int(np.prod(shape))
+        ret.append(np.frombuffer(buf[offset:offset + size], dtype=dtype).reshape(shape))
+        offset += size
+    return ret
+
+
+register_serializer('pickle', 1, _pickle_dumps, _pickle_loads)
+register_serializer('raw', 2, _raw_dumps, _raw_loads)
 
 
 _DTYPE_DICT = {
@@ -4,7 +4,7 @@
 import numpy as np
 
 __all__ = ['StatCounter', 'BinaryStatistics', 'RatioCounter', 'Accuracy',
-           'OnlineMoments']
+           'OnlineMoments', 'LatencyHistogram']
 
 
 class StatCounter(object):
@@ -178,3 +178,68 @@ class OnlineMoments(object):
     @property
     def std(self):
         return np.sqrt(self.variance)
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of latencies with logarithmic bins, to compute percentiles
+    in constant memory. Values are in seconds.
+    """
+
+    def __init__(self, min_value=1e-5, max_value=100., bins_per_decade=20):
+        """
+        Args:
+            min_value, max_value (float): the range of the bins. Values
+                outside of the range are counted in the first or the last bin.
+            bins_per_decade (int): the resolution of the bins.
+        """
+        self._min = float(min_value)
+        self._bpd = int(bins_per_decade)
+        nr_bins = int(np.ceil(np.log10(max_value / self._min) * self._bpd)) + 1
+        # bin i > 0 covers [edge[i-1], edge[i]), bin 0 covers [0, min_value)
+        self._edges = self._min * 10 ** (np.arange(nr_bins) * 1.0 / self._bpd)
+        self.reset()
+
+    def reset(self):
+        self._counts = np.zeros((len(self._edges) + 1,), dtype='int64')
+        self._sum = 0.
+
+    def feed(self, v, count=1):
+        """
+        Args:
+            v (float): the value.
+            count (int): number of times to count the value.
+        """
+        idx = min(np.searchsorted(self._edges, v, side='right'), len(self._edges))
+        self._counts[idx] += count
+        self._sum += v * count
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bins.
+        """
+        assert np.array_equal(self._edges, other._edges)
+        self._counts += other._counts
+        self._sum += other._sum
+
+    @property
+    def count(self):
+        return int(self._counts.sum())
+
+    @property
+    def average(self):
+        assert self.count
+        return self._sum / self.count
+
+    def percentile(self, q):
+        """
+        Args:
+            q (float): in [0, 100].
+
+        Returns:
+            float: an upper bound of the percentile, with the precision of the bins.
+        """
+        assert self.count
+        cum = np.cumsum(self._counts)
+        idx = np.searchsorted(cum, q / 100.0 * cum[-1])
+        return self._edges[min(idx, len(self._edges) - 1)]
@@ -0,0 +1,488 @@
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+import six
+import zmq
+
+from tensorpack.dataflow import (
+    DataFlow, DataFromList, MapData, BatchData, PrefetchDataZMQ, MultiProcessMapData,
+    HDF5Data, LMDBData, LMDBDataPoint, LocallyShuffleData, CacheData, RemoteDataZMQ,
+    send_dataflow_zmq)
+from tensorpack.dataflow.dftools import dump_dataflow_to_lmdb
+from tensorpack.utils.serialize import dumps
+
+
+class CountingData(DataFlow):
+    """ Produces [i * ones(shape), i] for i = 0, 1, ..., size - 1. """
+    def __init__(self, size, shape=(16, 16)):
+        self._size = size
+        self.shape = shape
+
+    def size(self):
+        return self._size
+
+    def get_data(self):
+        for i in range(self._size):
+            yield [np.full(self.shape, i, dtype='float32'), i]
+
+
+class PrefetchShmTest(unittest.TestCase):
+
+    def test_kept_datapoint_unchanged(self):
+        ds = PrefetchDataZMQ(CountingData(1000), nr_proc=1, hwm=2, use_shm=True, shm_pool_size=4)
+        ds.reset_state()
+        itr = ds.get_data()
+        kept = next(itr)
+        # derived views which no longer reference the original array
+        derived = [kept[0][1:].reshape(-1), np.asarray(kept[0]).T, kept[0][::2, 1]]
+        expected = [d.copy() for d in derived]
+        kept_array = kept[0]
+        del kept
+        # much more datapoints than the slabs in the pool
+        for _ in range(50):
+            dp = next(itr)
+            self.assertTrue((dp[0] == dp[1]).all())
+        for d, e in zip(derived, expected):
+            self.assertTrue(np.array_equal(d, e))
+        self.assertTrue((kept_array == kept_array.flat[0]).all())
+        del ds
+
+
+class UniqueData(DataFlow):
+    """ Produces [i] with a unique i, increasing across epochs. """
+    def __init__(self, size):
+        self._size = size
+        self.next_id = 0
+
+    def size(self):
+        return self._size
+
+    def get_data(self):
+        for _ in range(self._size):
+            self.next_id += 1
+            yield [self.next_id - 1]
+
+
+class BatchDataTest(unittest.TestCase):
+
+    def test_values(self):
+        ds = BatchData(CountingData(10, (2,)), 4, remainder=True)
+        ds.reset_state()
+        batches = list(ds.get_data())
+        self.assertEqual([len(b[1]) for b in batches], [4, 4, 2])
+        self.assertEqual(np.concatenate([b[1] for b in batches]).tolist(), list(range(10)))
+        self.assertEqual(batches[2][0].shape, (2, 2))
+        self.assertTrue((batches[1][0][:, 0] == [4, 5, 6, 7]).all())
+
+    def test_inconsistent_shape(self):
+        ds = DataFromList([[np.zeros((3,))], [np.zeros((4,))]], shuffle=False)
+        ds = BatchData(ds, 2)
+        ds.reset_state()
+        with six.assertRaisesRegex(self, ValueError, 'shape'):
+            next(ds.get_data())
+
+    def test_inconsistent_dtype(self):
+        ds = DataFromList([[np.zeros((3,), dtype='int32')],
+                           [np.full((3,), 0.5, dtype='float32')]], shuffle=False)
+        ds = BatchData(ds, 2)
+        ds.reset_state()
+        with six.assertRaisesRegex(self, ValueError, 'dtype'):
+            next(ds.get_data())
+
+    def test_buffers(self):
+        ds = BatchData(CountingData(40, (2,)), 4, nr_buffer=3)
+        ds.reset_state()
+        itr = ds.get_data()
+        held = [next(itr) for _ in range(3)]
+        # the last nr_buffer batches are all intact
+        for k, b in enumerate(held):
+            self.assertEqual(b[1].tolist(), list(range(4 * k, 4 * k + 4)))
+        # the oldest one is reused for the next batch
+        b = next(itr)
+        self.assertIs(b[1], held[0][1])
+        self.assertEqual(held[0][1].tolist(), [12, 13, 14, 15])
+        self.assertEqual(held[1][1].tolist(), [4, 5, 6, 7])
+
+    def test_no_buffers(self):
+        ds = BatchData(CountingData(40, (2,)), 4)
+        ds.reset_state()
+        held = list(ds.get_data())
+        for k, b in enumerate(held):
+            self.assertEqual(b[1].tolist(), list(range(4 * k, 4 * k + 4)))
+
+
+def add_random(dp):
+    return [dp[1], np.random.randint(1 << 30)]
+
+
+class MultiProcessMapDataTest(unittest.TestCase):
+
+    def test_ordered(self):
+        ds = MultiProcessMapData(CountingData(100, (2,)), 3, add_random, buffer_size=10, ordered=True)
+        ds.reset_state()
+        self.assertEqual([dp[0] for dp in ds.get_data()], list(range(100)))
+        # a second epoch
+        self.assertEqual([dp[0] for dp in ds.get_data()], list(range(100)))
+
+    def test_random_state(self):
+        ds = MultiProcessMapData(CountingData(100, (2,)), 4, add_random, buffer_size=10)
+        ds.reset_state()
+        values = [dp[1] for dp in ds.get_data()]
+        self.assertEqual(len(set(values)), len(values))
+
+    def test_exit(self):
+        code = '\n'.join([
+            'from tensorpack.dataflow import MultiProcessMapData, DataFromList',
+            'ds = MultiProcessMapData(DataFromList([[k] for k in range(10)]), 2, lambda dp: dp)',
+            'ds.reset_state()',
+            'print(len(list(ds.get_data())))'])
+        p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+        try:
+            out, _ = p.communicate(timeout=60) if six.PY3 else p.communicate()
+        finally:
+            if p.poll() is None:
+                p.kill()
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(out.strip(), b'10')
+
+    def test_pipes_removed(self):
+        pipedir = tempfile.mkdtemp()
+        try:
+            code = '\n'.join([
+                'from tensorpack.dataflow import MultiProcessMapData, PrefetchDataZMQ, DataFromList',
+                'ds = MultiProcessMapData(DataFromList([[k] for k in range(10)]), 2, lambda dp: dp)',
+                'ds.reset_state()',
+                'ds.reset_state()',     # creates new pipes
+                'print(len(list(ds.get_data())))',
+                'ds = PrefetchDataZMQ(DataFromList([[k] for k in range(10)]), use_shm=True)',
+                'print(len(list(ds.get_data())))'])
+            env = dict(os.environ, TENSORPACK_PIPEDIR=pipedir)
+            p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, env=env)
+            try:
+                out, _ = p.communicate(timeout=60) if six.PY3 else p.communicate()
+            finally:
+                if p.poll() is None:
+                    p.kill()
+            self.assertEqual(out.split()[:2], [b'10', b'10'])
+            self.assertEqual(os.listdir(pipedir), [])
+        finally:
+            shutil.rmtree(pipedir)
+
+
+class HDF5DataTest(unittest.TestCase):
+
+    def setUp(self):
+        import h5py
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'data.h5')
+        with h5py.File(self.filename, 'w') as f:
+            f.create_dataset('x', data=np.arange(100 * 3).reshape(100, 3), chunks=(8, 3))
+            f.create_dataset('y', data=np.arange(100))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lazy(self):
+        ds = HDF5Data(self.filename, ['x', 'y'], lazy=True, buffer_size=20)
+        ds.reset_state()
+        for _ in range(2):
+            dps = list(ds.get_data())
+            self.assertEqual(sorted(dp[1] for dp in dps), list(range(100)))
+            for x, y in dps:
+                self.assertEqual(x.tolist(), [3 * y, 3 * y + 1, 3 * y + 2])
+
+    def test_reset_closes_file(self):
+        ds = HDF5Data(self.filename, ['x', 'y'], lazy=True)
+        ds.reset_state()
+        f = ds.f
+        ds.reset_state()
+        self.assertFalse(f)     # closed
+        self.assertTrue(ds.f)
+        self.assertEqual(len(list(ds.get_data())), 100)
+
+
+class LMDBDataTest(unittest.TestCase):
+
+    def setUp(self):
+        import lmdb
+        self.dir = tempfile.mkdtemp()
+        self.keys = ['{:0>4d}'.format(k).encode('ascii') for k in range(100)]
+        db = lmdb.open(self.dir, map_size=1 << 24)
+        with db.begin(write=True) as txn:
+            for k in self.keys:
+                txn.put(k, k + b'-value')
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_once(self, ds, keys):
+        ds.reset_state()
+        dps = list(ds.get_data())
+        self.assertEqual(sorted(dp[0] for dp in dps), sorted(keys))
+        for k, v in dps:
+            self.assertEqual(v, k + b'-value')
+
+    def test_blocks(self):
+        ds = LMDBData(self.dir, shuffle=True, keys=self.keys, block_size=7, buffer_size=20)
+        self.check_once(ds, self.keys)
+        self.check_once(ds, self.keys)
+
+    def test_blocks_missing_keys(self):
+        # block boundaries which are not in the database
+        keys = self.keys + [b'0006a', b'0013a', b'0020a']
+        ds = LMDBData(self.dir, shuffle=True, keys=keys, block_size=7)
+        self.check_once(ds, self.keys)
+
+    def test_blocks_subset(self):
+        # keys outside the subset, between and after the blocks, are skipped
+        keys = self.keys[10:50:3] + self.keys[60:70]
+        ds = LMDBData(self.dir, shuffle=True, keys=keys, block_size=4, buffer_size=8)
+        self.check_once(ds, keys)
+
+
+class LocallyShuffleDataTest(unittest.TestCase):
+
+    def check_exactly_once(self, nr_reuse, buffer_size=30):
+        src = UniqueData(100)
+        ds = LocallyShuffleData(src, buffer_size, nr_reuse=nr_reuse)
+        ds.reset_state()
+        outputs = []
+        for _ in range(3):
+            epoch = [dp[0] for dp in ds.get_data()]
+            # each datapoint is produced nr_reuse times in a row, so an epoch ends between them
+            self.assertTrue(100 <= len(epoch) < 100 + nr_reuse)
+            outputs.extend(epoch)
+        # what's not produced yet is still in the buffer
+        remaining = [dp[0] for dp in ds.q]
+        counts = np.bincount(outputs + remaining)
+        self.assertEqual(len(counts), src.next_id)
+        self.assertTrue((counts == nr_reuse).all())
+        self.assertNotEqual(outputs[:100], sorted(outputs[:100]))
+
+    def test_exactly_once(self):
+        self.check_exactly_once(1)
+
+    def test_reuse(self):
+        self.check_exactly_once(3)
+
+    def test_reuse_not_dividing_buffer(self):
+        self.check_exactly_once(4, buffer_size=30)
+
+
+class CacheDataTest(unittest.TestCase):
+
+    def check_pass(self, ds, size, shuffle=False):
+        dps = list(ds.get_data())
+        ids = [dp[1] for dp in dps]
+        if shuffle:
+            ids = sorted(ids)
+        self.assertEqual(ids, list(range(size)))
+        for dp in dps:
+            self.assertTrue((dp[0] == dp[1]).all())
+
+    def test_memory_limit(self):
+        src = UniqueData(50)
+        # each datapoint is 1KB, so most of them are spilled to disk
+        ds = CacheData(MapData(src, lambda dp: [np.full((256,), dp[0], dtype='float32'), dp[0]]),
+                       max_memory=10000)
+        ds.reset_state()
+        self.check_pass(ds, 50)
+        self.assertTrue(0 < len(ds.buffer) < 50)
+        self.assertEqual(len(ds.buffer) + len(ds._spill_offsets), 50)
+        for _ in range(2):
+            self.check_pass(ds, 50)
+        self.assertEqual(src.next_id, 50)     # read only once
+
+    def test_memory_limit_shuffle(self):
+        ds = CacheData(CountingData(50, (256,)), shuffle=True, max_memory=10000)
+        ds.reset_state()
+        for _ in range(3):
+            self.check_pass(ds, 50, shuffle=True)
+
+    def test_pickle_spill(self):
+        ds = CacheData(DataFromList([[k, 'str{}'.format(k)] for k in range(20)], shuffle=False),
+                       max_memory=500)
+        ds.reset_state()
+        first = list(ds.get_data())
+        self.assertTrue(len(ds._spill_offsets) > 0)
+        self.assertEqual(list(ds.get_data()), first)
+
+    def test_partial_pass(self):
+        src = UniqueData(50)
+        ds = CacheData(MapData(src, lambda dp: [np.full((256,), dp[0], dtype='float32'), dp[0]]),
+                       max_memory=10000)
+        ds.reset_state()
+        itr = ds.get_data()
+        for _ in range(40):     # past the memory limit
+            next(itr)
+        del itr
+        self.assertFalse(ds._complete)
+        # the next pass starts over from the input, which continues from 50
+        dps = list(ds.get_data())
+        self.assertEqual([dp[1] for dp in dps], list(range(40, 90)))
+        self.assertEqual([dp[1] for dp in ds.get_data()], list(range(40, 90)))
+        self.assertEqual(src.next_id, 90)
+
+
+class RemoteDataZMQTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.procs = []
+
+    def tearDown(self):
+        for p in self.procs:
+            p.terminate()
+        shutil.rmtree(self.dir)
+
+    def start_producer(self, addr, **kwargs):
+        kwargs.setdefault('print_interval', 10 ** 9)
+        p = mp.Process(target=send_dataflow_zmq, args=(CountingData(10, (2,)), addr), kwargs=kwargs)
+        p.daemon = True
+        p.start()
+        self.procs.append(p)
+
+    def receive(self, ds, n):
+        itr = ds.get_data()
+        return [next(itr) for _ in range(n)]
+
+    def test_bind(self):
+        addr = 'ipc://' + os.path.join(self.dir, 'pipe')
+        ds = RemoteDataZMQ(addr)
+        self.start_producer(addr)
+        dps = self.receive(ds, 30)
+        self.assertEqual([dp[1] for dp in dps], list(range(10)) * 3)
+        self.assertEqual(ds.cnt1, 30)
+
+    def test_connect(self):
+        # the consumer connects to several producers which bind
+        addrs = ['ipc://' + os.path.join(self.dir, 'pipe{}'.format(k)) for k in range(2)]
+        for addr in addrs:
+            self.start_producer('@' + addr)
+        ds = RemoteDataZMQ(['>' + addr for addr in addrs])
+        itr = ds.get_data()
+        for k in range(10000):
+            dp = next(itr)
+            self.assertEqual(dp[0][0], dp[1])
+            if ds.cnt1 > 0 and ds.cnt2 > 0:
+                break
+        # data comes from both producers
+        self.assertTrue(ds.cnt1 > 0 and ds.cnt2 > 0)
+        self.assertEqual(ds.cnt1 + ds.cnt2, k + 1)
+
+    def test_hello_resets_credits(self):
+        addr = 'ipc://' + os.path.join(self.dir, 'pipe')
+        ds = RemoteDataZMQ(addr, credits=2)
+        itr = ds.get_data()
+        context = zmq.Context()
+        try:
+            # a producer which ignores its credits
+            sock = context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(addr)
+
+            def recv_credits():
+                credits = []
+                while sock.poll(500):
+                    credits.append(int(sock.recv_multipart()[1]))
+                return credits
+
+            # a repeated hello is answered only once
+            sock.send(b'hello')
+            sock.send(b'hello')
+            sock.send_multipart([b'data', dumps([0])])
+            self.assertEqual(next(itr), [0])
+            self.assertEqual(recv_credits(), [2])
+            # the producer lost its credits and says hello again
+            time.sleep(1)
+            sock.send(b'hello')
+            sock.send_multipart([b'data', dumps([1])])
+            self.assertEqual(next(itr), [1])
+            self.assertEqual(recv_credits(), [1, 2])
+        finally:
+            context.destroy(0)
+
+    def test_threaded_error(self):
+        class FailingData(DataFlow):
+            def get_data(self):
+                yield [1]
+                raise KeyError('data')
+        addr = 'ipc://' + os.path.join(self.dir, 'pipe')
+        with self.assertRaises(KeyError):
+            send_dataflow_zmq(FailingData(), addr, threaded=True, print_interval=10 ** 9)
+
+
+def to_arrays(dp):
+    # the 'raw' serializer only supports ndarrays
+    return [dp[0], np.asarray(dp[1])]
+
+
+class SerializerEnvTest(unittest.TestCase):
+    """ $TENSORPACK_SERIALIZE must only change how datapoints are serialized. """
+
+    def setUp(self):
+        self.env = os.environ.get('TENSORPACK_SERIALIZE')
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if self.env is None:
+            os.environ.pop('TENSORPACK_SERIALIZE', None)
+        else:
+            os.environ['TENSORPACK_SERIALIZE'] = self.env
+        shutil.rmtree(self.dir)
+
+    def check(self, make_ds, nr, shape=(2,)):
+        for serializer in ['raw', 'pickle']:
+            os.environ['TENSORPACK_SERIALIZE'] = serializer
+            ds = make_ds(MapData(CountingData(nr, shape), to_arrays))
+            ds.reset_state()
+            itr = ds.get_data()
+            dps = [next(itr) for _ in range(nr)]
+            self.assertEqual(sorted(int(dp[1]) for dp in dps), list(range(nr)))
+            for dp in dps:
+                self.assertTrue((dp[0] == dp[1]).all())
+            del itr, ds
+
+    def test_prefetch_shm(self):
+        # the first datapoints do not fit into the initial slabs
+        self.check(lambda ds: PrefetchDataZMQ(ds, use_shm=True), 20, (600, 600))
+
+    def test_map(self):
+        self.check(lambda ds: MultiProcessMapData(ds, 2, lambda dp: dp, buffer_size=5, ordered=True), 20)
+
+    def test_remote(self):
+        procs = []
+
+        def make_ds(ds):
+            addr = 'ipc://' + os.path.join(self.dir, 'pipe{}'.format(len(procs)))
+            p = mp.Process(target=send_dataflow_zmq, args=(ds, addr),
+                           kwargs={'batch_size': 3, 'print_interval': 10 ** 9})
+            p.daemon = True
+            procs.append(p)
+            ret = RemoteDataZMQ(addr)
+            p.start()
+            return ret
+        try:
+            self.check(make_ds, 20)
+        finally:
+            for p in procs:
+                p.terminate()
+
+    def test_lmdb(self):
+        def make_ds(ds):
+            path = os.path.join(self.dir, '{}.lmdb'.format(os.environ['TENSORPACK_SERIALIZE']))
+            ds.reset_state()
+            dump_dataflow_to_lmdb(ds, path)
+            return LMDBDataPoint(path, shuffle=False)
+        self.check(make_ds, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+
+from tensorpack.dataflow import DataFromList, AugmentImageComponents
+from tensorpack.dataflow import imgaug
+
+
+def random_image(h, w):
+    return np.random.randint(0, 256, size=(h, w, 3)).astype('uint8')
+
+
+class AugmentorListTest(unittest.TestCase):
+
+    def test_no_fusion_by_default(self):
+        augs = [imgaug.Rotation(10), imgaug.Resize((40, 50)), imgaug.CenterCrop(30)]
+        img = random_image(60, 80)
+        out, prms = imgaug.AugmentorList(augs)._augment_return_params(img)
+        expected = img
+        for aug, prm in zip(augs, prms):
+            expected = aug._augment(expected, prm)
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_fused(self):
+        augs = imgaug.AugmentorList([imgaug.Rotation(10), imgaug.Resize((40, 50)),
+                                     imgaug.Flip(horiz=True)], fuse_affine=True)
+        out = augs.augment(random_image(60, 80))
+        self.assertEqual(out.shape, (40, 50, 3))
+
+    def test_custom_augment_not_fused(self):
+        class Inverted(imgaug.Resize):
+            def _augment(self, img, t):
+                return 255 - super(Inverted, self)._augment(img, t)
+
+        img = random_image(60, 80)
+        augs = imgaug.AugmentorList([imgaug.Shift(0.1, 0.1), Inverted((30, 40))], fuse_affine=True)
+        out, prms = augs._augment_return_params(img)
+        expected = augs.augs[1]._augment(prms[0].apply_image(img), prms[1])
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_components_of_different_size(self):
+        img, label = random_image(60, 80), random_image(30, 40)[:, :, 0]
+        ds = AugmentImageComponents(DataFromList([[img, label]]), [imgaug.Resize((20, 30))])
+        ds.reset_state()
+        dp = next(ds.get_data())
+        self.assertEqual(dp[0].shape, (20, 30, 3))
+        self.assertEqual(dp[1].shape, (20, 30))
+
+    def test_warp_components_of_different_size(self):
+        img, mask = random_image(60, 80), random_image(30, 40)[:, :, 0]
+        for aug in [imgaug.Shift(0.2, 0.2), imgaug.Rotation(20)]:
+            ds = AugmentImageComponents(DataFromList([[img, mask]]), [aug])
+            ds.reset_state()
+            aug.rng = np.random.RandomState(0)
+            dp = next(ds.get_data())
+            # each component is warped at its own size, with the same matrix
+            self.assertEqual(dp[0].shape, (60, 80, 3))
+            self.assertEqual(dp[1].shape, (30, 40))
+            aug.rng = np.random.RandomState(0)
+            t = aug._get_augment_params(img)
+            self.assertTrue(np.array_equal(dp[1], t.apply_image(mask)))
+
+
+if __name__ == '__main__':
+    unittest.main()
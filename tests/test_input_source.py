@@ -0,0 +1,82 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+
+from tensorpack.dataflow import DataFlow
+from tensorpack.train.input_source import EnqueueThread
+
+
+class CountingData(DataFlow):
+    """ Produces [i * ones(length), i] for i = 0, 1, ..., size - 1. """
+    def __init__(self, size, varying_length=False):
+        self._size = size
+        self.varying_length = varying_length
+
+    def size(self):
+        return self._size
+
+    def get_data(self):
+        for i in range(self._size):
+            length = 1 + i % 3 if self.varying_length else 2
+            yield [np.full((length,), i, dtype='float32'), i]
+
+
+class EnqueueThreadTest(unittest.TestCase):
+
+    def dequeue_values(self, ds, nr, enqueue_many):
+        """ Run an EnqueueThread on ds, and dequeue nr datapoints. """
+        with tf.Graph().as_default():
+            placehdrs = [tf.placeholder(tf.float32, [None], name='x'),
+                         tf.placeholder(tf.int32, [], name='y')]
+            queue = tf.FIFOQueue(20, [tf.float32, tf.int32], name='input_queue')
+            thread = EnqueueThread(queue, ds, placehdrs, enqueue_many=enqueue_many)
+            dequeue_op = queue.dequeue()
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                with sess.as_default():
+                    thread.start()
+                ret = [sess.run(dequeue_op) for _ in range(nr)]
+                sess.run(queue.close(cancel_pending_enqueues=True))
+                thread.join()
+        return ret, thread
+
+    def check_values(self, ret, size):
+        self.assertEqual([int(y) for _, y in ret], [k % size for k in range(len(ret))])
+        for x, y in ret:
+            self.assertTrue((x == y).all())
+
+    def test_enqueue(self):
+        ret, _ = self.dequeue_values(CountingData(10), 35, 1)
+        self.check_values(ret, 10)
+
+    def test_enqueue_many(self):
+        ret, thread = self.dequeue_values(CountingData(10), 200, 8)
+        self.check_values(ret, 10)
+        self.assertTrue(1 <= thread.nr_many <= 8)
+
+    def test_enqueue_many_varying_shape(self):
+        # cannot be stacked, so they are enqueued one by one
+        ret, _ = self.dequeue_values(CountingData(10, varying_length=True), 35, 8)
+        self.check_values(ret, 10)
+        self.assertEqual([len(x) for x, _ in ret[:4]], [1, 2, 3, 1])
+
+    def test_adjust_nr_many(self):
+        with tf.Graph().as_default():
+            placehdrs = [tf.placeholder(tf.float32, [2]), tf.placeholder(tf.int32, [])]
+            queue = tf.FIFOQueue(20, [tf.float32, tf.int32])
+            thread = EnqueueThread(queue, CountingData(10), placehdrs, enqueue_many=4)
+        # enqueue is slower than the dataflow: push more at a time, up to the maximum
+        for expected in [2, 4, 4]:
+            thread._adjust_nr_many(0, gather_time=0.1, run_time=0.2)
+            self.assertEqual(thread.nr_many, expected)
+        # the queue is not drained: no change
+        thread._adjust_nr_many(10, gather_time=0.2, run_time=0.1)
+        self.assertEqual(thread.nr_many, 4)
+        # the dataflow is slower
+        for expected in [2, 1, 1]:
+            thread._adjust_nr_many(0, gather_time=0.2, run_time=0.1)
+            self.assertEqual(thread.nr_many, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
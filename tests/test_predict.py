@@ -0,0 +1,139 @@
+import itertools
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import tensorflow as tf
+import zmq
+
+from tensorpack.dataflow import DataFromList
+from tensorpack.models import ModelDesc, InputDesc
+from tensorpack.predict import PredictConfig, SimpleDatasetPredictor, ZMQPredictServer, ZMQAsyncPredictor
+from tensorpack.predict.dataset import _iter_in_thread, _split_batch_outputs
+
+
+class IterInThreadTest(unittest.TestCase):
+
+    def prefetch_threads(self):
+        return [th for th in threading.enumerate() if th.name == 'SimpleDatasetPredictorPrefetch']
+
+    def test_values(self):
+        self.assertEqual(list(_iter_in_thread(iter(range(100)), 5)), list(range(100)))
+
+    def test_exception(self):
+        def gen():
+            yield 1
+            raise KeyError('data')
+        itr = _iter_in_thread(gen(), 5)
+        self.assertEqual(next(itr), 1)
+        with self.assertRaises(KeyError):
+            next(itr)
+
+    def test_early_stop(self):
+        # the producer blocks on the full queue of an infinite iterator
+        itr = _iter_in_thread(itertools.count(), 2)
+        self.assertEqual([next(itr) for _ in range(3)], [0, 1, 2])
+        itr.close()
+        self.assertEqual(self.prefetch_threads(), [])
+
+    def test_early_stop_slow(self):
+        # the producer is blocked in the iterator
+        def gen():
+            yield 0
+            time.sleep(5)
+            yield 1
+        itr = _iter_in_thread(gen(), 2)
+        self.assertEqual(next(itr), 0)
+        time.sleep(0.1)
+        start = time.time()
+        itr.close()
+        self.assertLess(time.time() - start, 3)
+
+
+class SplitBatchOutputsTest(unittest.TestCase):
+
+    def test_copies(self):
+        batch = [np.arange(12).reshape(4, 3), np.arange(4)]
+        outputs = _split_batch_outputs(batch, 4)
+        self.assertEqual(len(outputs), 4)
+        self.assertTrue(np.array_equal(outputs[2][0], [6, 7, 8]))
+        self.assertEqual(outputs[2][1], 2)
+        self.assertFalse(np.may_share_memory(outputs[2][0], batch[0]))
+
+
+class DoubleModel(ModelDesc):
+    def _get_inputs(self):
+        return [InputDesc(tf.float32, [None, 3], 'input')]
+
+    def _build_graph(self, inputs):
+        tf.identity(inputs[0] * 2, name='output')
+
+
+class SimpleDatasetPredictorTest(unittest.TestCase):
+
+    def test_empty_process_prefetch(self):
+        config = PredictConfig(model=DoubleModel(), input_names=['input'], output_names=['output'])
+        pred = SimpleDatasetPredictor(config, DataFromList([]), prefetch='process')
+        self.assertEqual(pred.get_all_result(), [])
+
+
+class ZMQPredictServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addr = 'ipc://' + os.path.join(self.dir, 'pipe')
+        config = PredictConfig(model=DoubleModel(), input_names=['input'], output_names=['output'])
+        self.server = ZMQPredictServer(0, config, self.addr, batch_size=4)
+        self.server.daemon = True
+        self.server.start()
+
+    def tearDown(self):
+        self.server.terminate()
+        shutil.rmtree(self.dir)
+
+    def predict(self, predictor, value):
+        return predictor.put_task([np.full((3,), value, dtype='float32')]).result(timeout=60)
+
+    def test_malformed_request(self):
+        context = zmq.Context()
+        try:
+            sock = context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self.addr)
+            sock.send_multipart([b'too', b'many', b'frames'])
+            sock.send_multipart([struct.pack('<Q', 7), b'\x00TPK\xffnot a datapoint'])
+            # the undecodable request gets an error reply
+            req_id, status, _ = sock.recv_multipart()
+            self.assertEqual(struct.unpack('<Q', req_id)[0], 7)
+            self.assertNotEqual(status, b'0')
+        finally:
+            context.destroy(0)
+        # the server still serves the other clients
+        predictor = ZMQAsyncPredictor(self.addr)
+        predictor.start()
+        self.assertTrue(np.array_equal(self.predict(predictor, 1)[0], [2, 2, 2]))
+        predictor.close()
+
+    def test_close(self):
+        predictor = ZMQAsyncPredictor(self.addr)
+        predictor.start()
+        # sockets created in several threads
+        results = []
+        threads = [threading.Thread(target=lambda k=k: results.append(self.predict(predictor, k)))
+                   for k in range(3)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(sorted(float(r[0][0]) for r in results), [0, 2, 4])
+        predictor.close()
+        self.assertTrue(predictor._context.closed)
+        predictor.close()   # no-op
+
+
+if __name__ == '__main__':
+    unittest.main()